@@ -1,5 +1,4 @@
 # An example for running MSM_Alignment.py
-import numpy as np
 import nibabel as nib
 import os
 
@@ -22,6 +21,7 @@ os.environ[
 sys.path.append("/mnt/e/Ecole Polytechnique/Parietal/code/msm_on_ibc")
 
 from msm import model  # noqa: E402
+from msm import utils  # noqa: E402
 
 # %% Define model
 msm = model.MSM()
@@ -50,15 +50,9 @@ target_data = [
 # model.fit(source_data, target_data, mesh="./data/lh.sphere.gii")
 
 # making a ndarray of data
-source_array = np.stack(
-    [nib.load(source).darrays[0].data for source in source_data],
-    axis=0,
-)
+source_array = utils.load_contrasts(source_data, n_jobs=len(source_data))
 
-target_array = np.stack(
-    [nib.load(target).darrays[0].data for target in target_data],
-    axis=0,
-)
+target_array = utils.load_contrasts(target_data, n_jobs=len(target_data))
 
 # msm.fit(
 #     source_array,
@@ -7,6 +7,7 @@ from scipy import stats
 
 import nibabel as nib
 import matplotlib.pyplot as plt
+from msm.catalog import Catalog
 from msm.run import run_msm, prepare_darrays
 
 dotenv.load_dotenv()
@@ -34,33 +35,15 @@ sessions = [
     ["ses-00", "ses-01", "ses-02"],
 ]
 
+catalog = Catalog.scan(data_path, index_path="./catalog.csv")
+
 for session in sessions:
     # data - dictionary of type: input_fname -> reference_fname
 
-    data = {}
-
-    data_input = [
-        os.path.join(data_path, file)
-        for file in os.listdir(data_path)
-        if subject_input in file
-        and "lh" in file
-        and (any(ses in file for ses in session))
-    ]
-
-    data_reference = [
-        os.path.join(data_path, file)
-        for file in os.listdir(data_path)
-        if subject_reference in file
-        and "lh" in file
-        and (any(ses in file for ses in session))
-    ]
-
-    for input_fname in data_input:
-        for reference_fname in data_reference:
-            reference_contrast = reference_fname.split(subject_reference)[1]
-            input_contrast = input_fname.split(subject_input)[1]
-            if reference_contrast == input_contrast:
-                data[input_fname] = reference_fname
+    pairs = catalog.pairs(
+        subject_input, subject_reference, hemisphere="lh", sessions=session
+    )
+    data = dict(zip(pairs["source_path"], pairs["target_path"]))
 
     print(len(data))
     # split data to train and test
@@ -1,8 +1,6 @@
 import os
-import json
 import sys
 import matplotlib.pyplot as plt
-import nibabel as nib
 import numpy as np
 import random
 
@@ -10,6 +8,8 @@ import random
 # sys.path.append("/storage/store2/work/athual/repo/msm_on_ibc_wingrune")
 sys.path.append("/mnt/e/Ecole Polytechnique/Parietal/code/msm_on_ibc")
 
+from msm.catalog import Catalog  # noqa: E402
+from msm import data as data_store  # noqa: E402
 from msm import model  # noqa: E402
 from msm import utils  # noqa: E402
 
@@ -34,93 +34,51 @@ train_mode = True
 
 # data - dictionary of type: source_fname -> target_fname
 
-data = {}
 sessions = ["ses-00", "ses-01", "ses-02", "ses-04"]
-data_source = [
-    os.path.join(data_path, file)
-    for file in os.listdir(data_path)
-    if subject_source in file
-    and "lh" in file
-    and (any(ses in file for ses in sessions))
-]
-
-data_target = [
-    os.path.join(data_path, file)
-    for file in os.listdir(data_path)
-    if subject_target in file
-    and "lh" in file
-    and (any(ses in file for ses in sessions))
-]
-
-for source_fname in data_source:
-    for target_fname in data_target:
-        target_contrast = target_fname.split(subject_target)[1]
-        source_contrast = source_fname.split(subject_source)[1]
-        if target_contrast == source_contrast:
-            data[source_fname] = target_fname
+catalog = Catalog.scan(data_path, index_path="./catalog.csv")
+pairs = catalog.pairs(subject_source, subject_target, hemisphere="lh", sessions=sessions)
+data = dict(zip(pairs["source_path"], pairs["target_path"]))
+contrast_names = dict(zip(pairs["source_path"], pairs["contrast"]))
 
 # Split data to train and test
+# Contrast maps are stored with train maps first,
+# such that train and test sets are memory-mapped views of the store
+
+store = data_store.FeatureStore("./features")
 
 if new_split:
-    train_data_source = random.sample(list(data.keys()), int(len(data) * 0.8))
-
-    train_data = {
-        "source": np.stack(
-            [
-                nib.load(source_fname).darrays[0].data
-                for source_fname in train_data_source
-            ],
-            axis=0,
-        ),
-        "target": np.stack(
-            [
-                nib.load(data[source_fname]).darrays[0].data
-                for source_fname in train_data_source
-            ],
-            axis=0,
-        ),
-    }
-
-    test_data = {
-        "source": np.stack(
-            [
-                nib.load(source_fname).darrays[0].data
-                for source_fname in data
-                if source_fname not in train_data_source
-            ],
-            axis=0,
-        ),
-        "target": np.stack(
-            [
-                nib.load(data[source_fname]).darrays[0].data
-                for source_fname in data
-                if source_fname not in train_data_source
-            ],
-            axis=0,
+    source_fnames = random.sample(list(data.keys()), len(data))
+    n_train = int(len(data) * 0.8)
+    contrasts = [contrast_names[source_fname] for source_fname in source_fnames]
+
+    store.add(
+        subject_source,
+        "lh",
+        utils.load_contrasts(source_fnames, mesh=spherical_mesh, n_jobs=8),
+        contrasts,
+        n_train=n_train,
+    )
+    store.add(
+        subject_target,
+        "lh",
+        utils.load_contrasts(
+            [data[source_fname] for source_fname in source_fnames],
+            mesh=spherical_mesh,
+            n_jobs=8,
         ),
-    }
-
-    with open("train.json", "w") as outfile:
-        train_data["source"] = train_data["source"].tolist()
-        train_data["target"] = train_data["target"].tolist()
-        json.dump(train_data, outfile)
-
-    with open("test.json", "w") as outfile:
-        test_data["source"] = test_data["source"].tolist()
-        test_data["target"] = test_data["target"].tolist()
-        json.dump(test_data, outfile)
-else:
-    train_data_fname = "train.json"
-    test_data_fname = "test.json"
-    with open(train_data_fname) as json_file:
-        train_data = json.load(json_file)
-        train_data["source"] = np.asarray(train_data["source"])
-        train_data["target"] = np.asarray(train_data["target"])
-
-    with open(test_data_fname) as json_file:
-        test_data = json.load(json_file)
-        test_data["source"] = np.asarray(test_data["source"])
-        test_data["target"] = np.asarray(test_data["target"])
+        contrasts,
+        n_train=n_train,
+    )
+
+n_train = store.metadata(subject_source, "lh")["metadata"]["n_train"]
+train_data = {
+    "source": store.get(subject_source, "lh", rows=slice(None, n_train)),
+    "target": store.get(subject_target, "lh", rows=slice(None, n_train)),
+}
+test_data = {
+    "source": store.get(subject_source, "lh", rows=slice(n_train, None)),
+    "target": store.get(subject_target, "lh", rows=slice(n_train, None)),
+}
 
 epsilons = [0.01, 0.1, 1, 10, 100, 1000]
 
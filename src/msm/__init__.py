@@ -0,0 +1,32 @@
+import importlib
+
+# Submodules are only imported when first accessed as attributes
+# of the package (eg. msm.model), so that importing msm itself,
+# or lightweight submodules such as msm.utils, does not pull in
+# heavy dependencies of others.
+_submodules = [
+    "batch",
+    "catalog",
+    "data",
+    "evaluate",
+    "geometry",
+    "index",
+    "model",
+    "model_selection",
+    "run",
+    "scheduler",
+    "serve",
+    "shared",
+    "smoothing",
+    "utils",
+]
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted([*globals(), *_submodules])
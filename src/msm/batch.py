@@ -0,0 +1,299 @@
+"""Run a batch of MSM registrations described in a manifest file.
+
+Usage::
+
+    python -m msm.batch manifest.yaml [--n-jobs N] [--summary summary.json]
+
+The manifest (YAML, which requires pyyaml, or JSON) lists jobs
+to run, and optionally default values shared by all jobs::
+
+    n_jobs: 4
+    defaults:
+      mesh: ./data/lh.sphere.gii
+      epsilon: 0.1
+    jobs:
+      - source: [./data/sub-04_a_lh.gii, ./data/sub-04_b_lh.gii]
+        target: [./data/sub-07_a_lh.gii, ./data/sub-07_b_lh.gii]
+        output: ./outputs/sub-04_to_sub-07.surf.gii
+        iterations: 5
+
+Each job fits a registration of source contrast maps onto target
+contrast maps, and saves the transformed mesh to output.
+Keys other than source, target, mesh, target_mesh and output are
+hyperparameters passed to run.run_msm, such as epsilon, iterations,
+or any parameter of run.MSMConfig (for instance ``profile: minimal``
+for production runs), and unknown keys are rejected when the manifest
+is loaded. source and target may also be a single path.
+Jobs whose output exists and was computed from identical inputs
+are skipped, so that an interrupted batch can simply be run again.
+"""
+
+import argparse
+from concurrent.futures import as_completed
+import hashlib
+import inspect
+import json
+import logging
+import os
+from pathlib import Path
+import time
+
+from msm.run import MSMConfig, run_msm
+from msm.scheduler import Scheduler, estimate_msm_memory, msm_signature
+from msm import utils
+
+JOB_KEYS = ["source", "target", "mesh", "target_mesh", "output"]
+
+
+def load_manifest(manifest_path):
+    """Load jobs from a YAML or JSON manifest, with defaults applied."""
+
+    with open(manifest_path) as f:
+        if str(manifest_path).endswith(".json"):
+            manifest = json.load(f)
+        else:
+            import yaml
+
+            manifest = yaml.safe_load(f)
+
+    defaults = manifest.get("defaults", {})
+    jobs = [{**defaults, **job} for job in manifest["jobs"]]
+    valid_keys = hyperparameter_names()
+    for i, job in enumerate(jobs):
+        missing = [
+            key for key in ["source", "target", "mesh", "output"] if key not in job
+        ]
+        if len(missing) > 0:
+            raise ValueError(f"Job {i} of {manifest_path} is missing {missing}.")
+        unknown = sorted(set(hyperparameters(job)) - valid_keys)
+        if len(unknown) > 0:
+            raise ValueError(
+                f"Job {i} of {manifest_path} has unknown hyperparameters {unknown}."
+            )
+        # A single contrast map can be given as a path
+        for key in ["source", "target"]:
+            if isinstance(job[key], str):
+                job[key] = [job[key]]
+
+    return manifest.get("n_jobs", 1), jobs
+
+
+def job_hash(job):
+    """Hash content of all input files and hyperparameters of a job."""
+
+    h = hashlib.sha1()
+    target_mesh = job.get("target_mesh", job["mesh"])
+    for path in [*job["source"], *job["target"], job["mesh"], target_mesh]:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    h.update(json.dumps(hyperparameters(job), sort_keys=True).encode())
+
+    return h.hexdigest()
+
+
+def hyperparameters(job):
+    return {key: value for key, value in job.items() if key not in JOB_KEYS}
+
+
+def hyperparameter_names():
+    """Names of hyperparameters accepted by run.run_msm."""
+
+    parameters = inspect.signature(run_msm).parameters
+    names = {
+        name
+        for name, parameter in parameters.items()
+        if parameter.kind != parameter.VAR_KEYWORD
+    }
+
+    return (names | set(MSMConfig().get_params())) - {
+        "source_contrasts_list",
+        "source_mesh",
+        "target_contrasts_list",
+        "target_mesh",
+        "config",
+    }
+
+
+def checkpoint_path(job):
+    """Path of the file recording how the output of a job was computed."""
+
+    return Path(f"{job['output']}.json")
+
+
+def is_done(job, input_hash):
+    path = checkpoint_path(job)
+    if not (os.path.exists(job["output"]) and path.exists()):
+        return False
+    with open(path) as f:
+        return json.load(f).get("input_hash") == input_hash
+
+
+def run_job(job, input_hash):
+    """Run a single registration and record its checkpoint."""
+
+    start = time.time()
+    mesh_gii, _ = run_msm(
+        source_contrasts_list=job["source"],
+        source_mesh=job["mesh"],
+        target_contrasts_list=job["target"],
+        target_mesh=job.get("target_mesh"),
+        # Only the registered sphere is saved
+        **{"profile": "minimal", **hyperparameters(job)},
+    )
+
+    # Write output next to its final location, then rename it,
+    # so that interrupted jobs never leave a partial output behind
+    output = Path(job["output"])
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmp_output = output.with_name(f".{os.getpid()}.{output.name}")
+    mesh_gii.to_filename(str(tmp_output))
+    os.replace(tmp_output, output)
+
+    record = {
+        "output": str(output),
+        "status": "done",
+        "input_hash": input_hash,
+        "wall_time": time.time() - start,
+    }
+    with open(checkpoint_path(job), "w") as f:
+        json.dump(record, f, indent=2)
+
+    return record
+
+
+def run_batch(jobs, n_jobs=1, memory_budget=None):
+    """
+    Run registration jobs concurrently.
+
+    Jobs are admitted by a Scheduler, with respect to
+    their estimated memory usage and available memory.
+
+    Parameters
+    ----------
+    jobs: list of dict
+        Jobs as returned by load_manifest.
+    n_jobs: int
+        Maximum number of registrations running at once.
+    memory_budget: int or None
+        Memory which can be used at once, in bytes.
+        See scheduler.Scheduler for default value.
+
+    Returns
+    -------
+    records: list of dict
+        Status, wall time and peak memory (in bytes) of each job.
+        Jobs whose inputs cannot be read are recorded as failed.
+    """
+    logger = logging.getLogger("msm")
+    records = [None] * len(jobs)
+
+    def failed(i, error):
+        records[i] = {
+            "output": jobs[i]["output"],
+            "status": "failed",
+            "error": str(error),
+        }
+        logger.warning(f"Failed {jobs[i]['output']}: {error}")
+
+    with Scheduler(max_cpus=n_jobs, memory_budget=memory_budget) as scheduler:
+        futures = {}
+        for i, job in enumerate(jobs):
+            try:
+                input_hash = job_hash(job)
+                if is_done(job, input_hash):
+                    records[i] = {"output": job["output"], "status": "skipped"}
+                    logger.info(f"Skipping {job['output']}, which is up to date")
+                    continue
+
+                n_vertices = utils.gifti_from_file(job["mesh"]).darrays[0].data.shape[0]
+                n_features = len(job["source"])
+                config = MSMConfig()
+                config.set_params(
+                    **{
+                        key: value
+                        for key, value in hyperparameters(job).items()
+                        if key in config.get_params()
+                    }
+                )
+            except Exception as error:
+                failed(i, error)
+                continue
+
+            grids = {"datagrid": config.datagrid, "cpgrid": config.cpgrid}
+            future = scheduler.submit(
+                run_job,
+                job,
+                input_hash,
+                memory=estimate_msm_memory(n_vertices, n_features, **grids),
+                signature=msm_signature(n_vertices, n_features, **grids),
+            )
+            futures[future] = i
+
+        for future in as_completed(futures):
+            i = futures[future]
+            error = future.exception()
+            if error is None:
+                # Peak memory of the job process and msm processes it spawned
+                records[i] = {**future.result(), "max_rss": future.max_rss}
+                logger.info(f"Done {jobs[i]['output']}")
+            else:
+                failed(i, error)
+
+    return records
+
+
+def summarize(records, wall_time):
+    """Aggregate job records into a summary."""
+
+    done = [record for record in records if record["status"] == "done"]
+    return {
+        "n_jobs": len(records),
+        "n_done": len(done),
+        "n_skipped": sum(record["status"] == "skipped" for record in records),
+        "n_failed": sum(record["status"] == "failed" for record in records),
+        "wall_time": wall_time,
+        "job_time": sum(record["wall_time"] for record in done),
+        "max_rss": max([record["max_rss"] for record in done], default=0),
+        "jobs": records,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a batch of MSM registrations described in a manifest."
+    )
+    parser.add_argument("manifest", help="YAML or JSON manifest of jobs")
+    parser.add_argument(
+        "--n-jobs", type=int, default=None, help="Number of concurrent registrations"
+    )
+    parser.add_argument(
+        "--summary", default=None, help="Path to JSON file summarizing the batch"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    n_jobs, jobs = load_manifest(args.manifest)
+    if args.n_jobs is not None:
+        n_jobs = args.n_jobs
+
+    start = time.time()
+    records = run_batch(jobs, n_jobs=n_jobs)
+    summary = summarize(records, time.time() - start)
+
+    print(
+        f"{summary['n_done']} done, {summary['n_skipped']} skipped, "
+        f"{summary['n_failed']} failed in {summary['wall_time']:.1f}s "
+        f"({summary['job_time']:.1f}s of registration, "
+        f"peak memory {summary['max_rss'] / 2**20:.0f} MB)"
+    )
+    if args.summary is not None:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    return 1 if summary["n_failed"] > 0 else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,404 @@
+"""Compare msmresample and native resampling on synthetic deformations.
+
+Usage::
+
+    python -m msm.benchmark [--level 5] [--n-maps 4] [--angles 0.05 0.2]
+                            [--stub-fsl] [--output report.json]
+
+An icosphere is deformed by rotations, for which transformed maps
+are known analytically: smooth maps are transformed with each
+resampling mode of MSM.transform, and compared to their exact values
+and to one another. Maximum and mean absolute errors and differences,
+as well as time per call and speedup of native modes
+with respect to msmresample, are reported.
+
+If FSL is not installed, or with --stub-fsl, msmresample is replaced
+by a stub which resamples data natively (see stub_msmresample).
+This still exercises the whole msmresample code path of transform
+(writing and reading GIFTI files, running a subprocess), but reported
+differences between modes are then meaningless.
+"""
+
+import argparse
+from contextlib import contextmanager
+import json
+import nibabel as nib
+import numpy as np
+import os
+import sys
+from tempfile import TemporaryDirectory
+import time
+
+from msm.index import SphereIndex
+from msm.model import MSM
+from msm import utils
+
+
+def icosphere(level, radius=100):
+    """
+    Build a regular icosphere.
+
+    Parameters
+    ----------
+    level: int
+        Number of subdivisions of the icosahedron.
+    radius: float
+
+    Returns
+    -------
+    vertices: ndarray(10 * 4**level + 2, 3)
+    faces: ndarray(20 * 4**level, 3)
+    """
+    t = (1 + np.sqrt(5)) / 2
+    vertices = np.array(
+        [
+            [-1, t, 0],
+            [1, t, 0],
+            [-1, -t, 0],
+            [1, -t, 0],
+            [0, -1, t],
+            [0, 1, t],
+            [0, -1, -t],
+            [0, 1, -t],
+            [t, 0, -1],
+            [t, 0, 1],
+            [-t, 0, -1],
+            [-t, 0, 1],
+        ],
+        dtype=np.float64,
+    )
+    faces = np.array(
+        [
+            [0, 11, 5],
+            [0, 5, 1],
+            [0, 1, 7],
+            [0, 7, 10],
+            [0, 10, 11],
+            [1, 5, 9],
+            [5, 11, 4],
+            [11, 10, 2],
+            [10, 7, 6],
+            [7, 1, 8],
+            [3, 9, 4],
+            [3, 4, 2],
+            [3, 2, 6],
+            [3, 6, 8],
+            [3, 8, 9],
+            [4, 9, 5],
+            [2, 4, 11],
+            [6, 2, 10],
+            [8, 6, 7],
+            [9, 8, 1],
+        ]
+    )
+    vertices /= np.linalg.norm(vertices, axis=1, keepdims=True)
+
+    for _ in range(level):
+        # Add one vertex at the middle of each edge
+        edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+        edges, edge_indices = np.unique(edges, axis=0, return_inverse=True)
+        midpoints = vertices[edges].mean(axis=1)
+        midpoints /= np.linalg.norm(midpoints, axis=1, keepdims=True)
+
+        # Split each face into 4 faces
+        a, b, c = faces.T
+        ab, bc, ca = (vertices.shape[0] + edge_indices.reshape(-1, 3)).T
+        faces = np.concatenate(
+            [
+                np.column_stack([a, ab, ca]),
+                np.column_stack([b, bc, ab]),
+                np.column_stack([c, ca, bc]),
+                np.column_stack([ab, bc, ca]),
+            ]
+        )
+        vertices = np.concatenate([vertices, midpoints])
+
+    return radius * vertices, faces
+
+
+def mesh_gifti(vertices, faces):
+    """Build a GIFTI image of a mesh."""
+
+    mesh = nib.gifti.gifti.GiftiImage()
+    mesh.add_gifti_data_array(
+        nib.gifti.gifti.GiftiDataArray(
+            data=vertices.astype(np.float32),
+            intent=nib.nifti1.intent_codes.code["NIFTI_INTENT_POINTSET"],
+            coordsys=nib.gifti.gifti.GiftiCoordSystem(3, 3),
+        )
+    )
+    mesh.add_gifti_data_array(
+        nib.gifti.gifti.GiftiDataArray(
+            data=faces.astype(np.int32),
+            intent=nib.nifti1.intent_codes.code["NIFTI_INTENT_TRIANGLE"],
+        )
+    )
+
+    return mesh
+
+
+def rotation_matrix(axis, angle):
+    """Matrix of the rotation of given angle around axis."""
+
+    axis = np.asarray(axis, dtype=np.float64)
+    axis /= np.linalg.norm(axis)
+    cross = np.array(
+        [
+            [0, -axis[2], axis[1]],
+            [axis[2], 0, -axis[0]],
+            [-axis[1], axis[0], 0],
+        ]
+    )
+
+    return np.eye(3) + np.sin(angle) * cross + (1 - np.cos(angle)) * cross @ cross
+
+
+def smooth_maps(vertices, n_maps, random_state=0):
+    """
+    Smooth maps on a sphere, defined analytically at any point.
+
+    Maps are random polynomials of degree 2 of unit coordinates.
+    """
+    rng = np.random.RandomState(random_state)
+    coefficients = rng.randn(n_maps, 10)
+    x, y, z = (vertices / np.linalg.norm(vertices, axis=1, keepdims=True)).T
+    monomials = np.stack(
+        [np.ones_like(x), x, y, z, x * y, y * z, z * x, x**2, y**2, z**2]
+    )
+
+    return (coefficients @ monomials).astype(np.float32)
+
+
+def rotated_model(vertices, faces, rotation):
+    """Build a model whose deformation is a rotation."""
+
+    mesh = mesh_gifti(vertices, faces)
+    model = MSM()
+    model.source_mesh = mesh
+    model.target_mesh = mesh
+    model.transformed_mesh = mesh_gifti(vertices @ rotation.T, faces)
+    model._reset_operators()
+
+    return model
+
+
+def stub_msmresample(argv):
+    """
+    Stand-in for msmresample, resampling data with native interpolation.
+
+    Only arguments used by run.run_msmresample are supported:
+    ``sphere_in output -labels data -project sphere_out``.
+    """
+    sphere_in, output = argv[:2]
+    options = dict(zip(argv[2::2], argv[3::2]))
+
+    index = SphereIndex.from_gifti(utils.gifti_from_file(sphere_in))
+    sphere_out = utils.gifti_from_file(options["-project"])
+    operator = index.interpolation_operator(sphere_out.darrays[0].data)
+
+    data = nib.load(options["-labels"])
+    resampled = nib.gifti.gifti.GiftiImage()
+    for darray in data.darrays:
+        resampled.add_gifti_data_array(
+            nib.gifti.gifti.GiftiDataArray(
+                data=(operator @ darray.data).astype(np.float32),
+                intent=nib.nifti1.intent_codes.code["NIFTI_INTENT_POINTSET"],
+                coordsys=sphere_out.darrays[0].coordsys,
+            )
+        )
+    resampled.to_filename(f"{output}.func.gii")
+
+    return 0
+
+
+@contextmanager
+def stub_fsl():
+    """
+    Temporarily install stub FSL tools in PATH.
+
+    Only msmresample is provided, see stub_msmresample.
+    """
+    with TemporaryDirectory() as fsl_dir:
+        bin_dir = os.path.join(fsl_dir, "bin")
+        os.makedirs(bin_dir)
+        scripts = {
+            "fsl": "",
+            "msmresample": (
+                "from msm.benchmark import stub_msmresample\n"
+                "sys.exit(stub_msmresample(sys.argv[1:]))\n"
+            ),
+        }
+        for tool, script in scripts.items():
+            tool_path = os.path.join(bin_dir, tool)
+            with open(tool_path, "w") as f:
+                f.write(f"#!{sys.executable}\nimport sys\n{script}")
+            os.chmod(tool_path, 0o755)
+
+        environ = dict(os.environ)
+        os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+        utils.fsl_toolchain.cache_clear()
+        try:
+            yield
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            utils.fsl_toolchain.cache_clear()
+
+
+def has_msmresample():
+    """Whether msmresample of FSL can be run."""
+
+    try:
+        return utils.fsl_toolchain().msmresample is not None
+    except RuntimeError:
+        return False
+
+
+def compare_resampling(
+    level=5,
+    n_maps=4,
+    angles=(0.05, 0.2),
+    modes=("adaptive", "barycentric"),
+    random_state=0,
+):
+    """
+    Compare resampling modes of MSM.transform on rotated icospheres.
+
+    Parameters
+    ----------
+    level: int
+        Level of the icosphere used as source and target meshes.
+    n_maps: int
+        Number of maps transformed.
+    angles: tuple of float
+        Angles of rotations, in radians.
+    modes: tuple of str
+        Modes of MSM.transform to compare. The first one is
+        the reference with respect to which differences and speedups
+        are computed.
+    random_state: int
+        Seed of rotation axes and maps.
+
+    Returns
+    -------
+    report: list of dict
+        For each angle, maximum and mean absolute error (with respect to
+        exact transformed maps) and time per transform call of each mode,
+        and maximum and mean absolute difference and speedup
+        of each mode with respect to the reference mode.
+    """
+    vertices, faces = icosphere(level)
+    source_data = smooth_maps(vertices, n_maps, random_state)
+    rng = np.random.RandomState(random_state)
+
+    report = []
+    for angle in angles:
+        rotation = rotation_matrix(rng.randn(3), angle)
+        model = rotated_model(vertices, faces, rotation)
+        # Target vertices come from source vertices rotated back
+        expected_data = smooth_maps(vertices @ rotation, n_maps, random_state)
+
+        results = {}
+        for mode in modes:
+            # Native operators are built on first call, which is timed apart
+            start = time.time()
+            model.transform(source_data[:1], mode=mode)
+            first_call = time.time() - start
+
+            start = time.time()
+            predicted_data = model.transform(source_data, mode=mode)
+            elapsed = time.time() - start
+
+            errors = np.abs(predicted_data - expected_data)
+            results[mode] = {
+                "predicted_data": predicted_data,
+                "max_abs_error": float(errors.max()),
+                "mean_abs_error": float(errors.mean()),
+                "first_call_time": first_call,
+                "time": elapsed,
+            }
+
+        reference_data = results[modes[0]]["predicted_data"]
+        reference_time = results[modes[0]]["time"]
+        for mode in modes:
+            differences = np.abs(results[mode].pop("predicted_data") - reference_data)
+            results[mode]["max_abs_difference"] = float(np.max(differences))
+            results[mode]["mean_abs_difference"] = float(np.mean(differences))
+            results[mode]["speedup"] = reference_time / results[mode]["time"]
+
+        report.append(
+            {
+                "level": level,
+                "n_vertices": vertices.shape[0],
+                "n_maps": n_maps,
+                "angle": angle,
+                "modes": results,
+            }
+        )
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare msmresample and native resampling of MSM.transform."
+    )
+    parser.add_argument("--level", type=int, default=5, help="Icosphere level")
+    parser.add_argument("--n-maps", type=int, default=4, help="Number of maps")
+    parser.add_argument(
+        "--angles",
+        type=float,
+        nargs="+",
+        default=[0.05, 0.2],
+        help="Rotation angles, in radians",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["adaptive", "barycentric"],
+        help="Modes of MSM.transform, the first one being the reference",
+    )
+    parser.add_argument(
+        "--stub-fsl",
+        action="store_true",
+        help="Replace msmresample by a native stub even if FSL is installed",
+    )
+    parser.add_argument("--output", default=None, help="Path to JSON report")
+    args = parser.parse_args(argv)
+
+    kwargs = {
+        "level": args.level,
+        "n_maps": args.n_maps,
+        "angles": args.angles,
+        "modes": args.modes,
+    }
+    if args.stub_fsl or not has_msmresample():
+        print("msmresample is replaced by a native stub")
+        with stub_fsl():
+            report = compare_resampling(**kwargs)
+    else:
+        report = compare_resampling(**kwargs)
+
+    for run in report:
+        print(
+            f"level {run['level']} ({run['n_vertices']} vertices), "
+            f"{run['n_maps']} maps, rotation of {run['angle']} rad"
+        )
+        for mode, results in run["modes"].items():
+            print(
+                f"  {mode:>12}: error max {results['max_abs_error']:.2e} "
+                f"mean {results['mean_abs_error']:.2e}, "
+                f"difference max {results['max_abs_difference']:.2e} "
+                f"mean {results['mean_abs_difference']:.2e}, "
+                f"{results['time'] * 1000:.1f} ms ({results['speedup']:.1f}x)"
+            )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
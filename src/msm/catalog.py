@@ -0,0 +1,188 @@
+import os
+import pandas as pd
+from pathlib import Path
+import re
+
+COLUMNS = ["subject", "session", "task", "contrast", "hemisphere", "path"]
+
+# Keys on which contrast maps of two subjects are matched
+MATCH_KEYS = ["session", "task", "contrast", "hemisphere"]
+
+_subject_re = re.compile(r"(sub-[A-Za-z0-9]+)")
+_session_re = re.compile(r"(ses-[A-Za-z0-9]+)")
+# Task directories of IBC derivatives, eg. res_fsaverage5_language_ffx
+_task_re = re.compile(r"^res_[^_]+_(.+)_ffx$")
+_hemisphere_re = re.compile(r"^(.*)_(lh|rh)\.gii(\.gz)?$")
+
+
+def parse_contrast_path(path):
+    """
+    Parse subject, session, task, contrast and hemisphere
+    of a GIFTI contrast map from its path.
+
+    Both flat files such as
+    ``bold_sub-04_ses-03_rsvp_language_consonant_string_lh.gii``
+    and IBC derivatives such as
+    ``sub-04/ses-03/res_fsaverage5_language_ffx/stat_surf/sentence-consonant_string_lh.gii``
+    are supported.
+
+    Parameters
+    ----------
+    path: str
+
+    Returns
+    -------
+    record: dict or None
+        Parsed fields, or None if path is not a hemisphere contrast map
+        of a given subject.
+    """
+    path = Path(path)
+    hemisphere_match = _hemisphere_re.match(path.name)
+    subject_match = _subject_re.search(str(path))
+    if hemisphere_match is None or subject_match is None:
+        return None
+
+    session_match = _session_re.search(str(path))
+    task = ""
+    for part in path.parts[:-1]:
+        task_match = _task_re.match(part)
+        if task_match is not None:
+            task = task_match.group(1)
+
+    # Strip subject and session prefixes from flat file names
+    contrast = hemisphere_match.group(1)
+    for match in [subject_match, session_match]:
+        if match is not None and match.group(1) in contrast:
+            contrast = contrast.split(f"{match.group(1)}_", 1)[-1]
+
+    return {
+        "subject": subject_match.group(1),
+        "session": "" if session_match is None else session_match.group(1),
+        "task": task,
+        "contrast": contrast,
+        "hemisphere": hemisphere_match.group(2),
+        "path": str(path),
+    }
+
+
+class Catalog:
+    def __init__(self, records=None):
+        """
+        Initialize catalog of contrast maps.
+
+        Parameters
+        ----------
+        records: pandas.DataFrame or list of dict or None
+            One row per contrast map, with columns
+            subject, session, task, contrast, hemisphere and path.
+        """
+
+        self.records = pd.DataFrame(records, columns=COLUMNS)
+
+    @classmethod
+    def scan(cls, data_path, index_path=None, refresh=False):
+        """
+        Catalog all contrast maps found under data_path.
+
+        The directory tree is walked only once.
+
+        Parameters
+        ----------
+        data_path: str
+            Root directory of contrast maps.
+        index_path: str or None
+            If specified, the catalog is loaded from this file
+            when it exists, and saved to it otherwise,
+            so that further scans are avoided.
+        refresh: bool
+            Whether data_path should be scanned again even though
+            index_path exists, for instance after contrast maps were
+            added, removed or renamed. Checking whether the index is
+            up to date would require walking data_path, hence it is left
+            to callers.
+
+        Returns
+        -------
+        catalog: Catalog
+        """
+        if index_path is not None and os.path.exists(index_path) and not refresh:
+            return cls.load(index_path)
+
+        records = []
+        for root, _, files in os.walk(data_path):
+            for file in files:
+                record = parse_contrast_path(os.path.join(root, file))
+                if record is not None:
+                    records.append(record)
+
+        catalog = cls(records)
+        if index_path is not None:
+            catalog.save(index_path)
+
+        return catalog
+
+    def save(self, index_path):
+        """Save catalog to a CSV file."""
+
+        self.records.to_csv(index_path, index=False)
+
+    @classmethod
+    def load(cls, index_path):
+        """Load catalog saved with save."""
+
+        return cls(pd.read_csv(index_path, dtype=str, keep_default_na=False))
+
+    def select(self, subject=None, hemisphere=None, sessions=None, tasks=None):
+        """
+        Select contrast maps matching all given criteria.
+
+        Returns
+        -------
+        records: pandas.DataFrame
+        """
+        mask = pd.Series(True, index=self.records.index)
+        if subject is not None:
+            mask &= self.records["subject"] == subject
+        if hemisphere is not None:
+            mask &= self.records["hemisphere"] == hemisphere
+        if sessions is not None:
+            mask &= self.records["session"].isin(sessions)
+        if tasks is not None:
+            mask &= self.records["task"].isin(tasks)
+
+        return self.records[mask]
+
+    def pairs(self, source_subject, target_subject, **kwargs):
+        """
+        Match contrast maps of two subjects.
+
+        Maps are matched on session, task, contrast and hemisphere
+        with a hash join.
+
+        Parameters
+        ----------
+        source_subject, target_subject: str
+        **kwargs:
+            Additional selection criteria passed to select,
+            such as hemisphere or sessions.
+
+        Returns
+        -------
+        pairs: pandas.DataFrame
+            One row per matched contrast, with columns session, task,
+            contrast, hemisphere, source_path and target_path.
+            source_path and target_path can be passed directly to
+            functions loading contrast maps.
+        """
+        source = self.select(subject=source_subject, **kwargs)
+        target = self.select(subject=target_subject, **kwargs)
+
+        pairs = pd.merge(
+            source[MATCH_KEYS + ["path"]],
+            target[MATCH_KEYS + ["path"]],
+            on=MATCH_KEYS,
+            how="inner",
+            suffixes=("_source", "_target"),
+        ).rename(columns={"path_source": "source_path", "path_target": "target_path"})
+
+        return pairs.sort_values(MATCH_KEYS, ignore_index=True)
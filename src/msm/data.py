@@ -0,0 +1,146 @@
+import json
+import numpy as np
+import os
+from pathlib import Path
+
+
+class FeatureStore:
+    def __init__(self, path):
+        """
+        Initialize store of contrast matrices.
+
+        Each (subject, hemisphere) entry holds a float32
+        (n_contrasts, n_vertices) array saved as a .npy file,
+        which is memory-mapped when read.
+        Contrast names, sessions and any other metadata
+        are kept in a small JSON index.
+
+        Parameters
+        ----------
+        path: str
+            Directory of the store. It is created if it does not exist.
+        """
+
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.path / "index.json"
+
+        if self.index_path.exists():
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    @staticmethod
+    def _key(subject, hemisphere):
+        return f"{subject}_{hemisphere}"
+
+    def _write_index(self):
+        # Write to a temporary file first, so that readers
+        # never see a partially written index
+        tmp_path = self.index_path.with_suffix(f".json.{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def keys(self):
+        """List (subject, hemisphere) pairs held in store."""
+
+        return [
+            (entry["subject"], entry["hemisphere"]) for entry in self.index.values()
+        ]
+
+    def add(self, subject, hemisphere, data, contrasts, sessions=None, **metadata):
+        """
+        Add contrast matrix of a subject's hemisphere to store.
+
+        Parameters
+        ----------
+        subject: str
+        hemisphere: str
+        data: ndarray(n_contrasts, n_vertices) or list of ndarray(n_vertices)
+            Contrast maps. They are stored as float32.
+        contrasts: list of str
+            Name of each contrast map.
+        sessions: list of str or None
+            Session of each contrast map.
+        **metadata:
+            Additional JSON-serializable metadata of this entry.
+        """
+        n_contrasts = len(data)
+        if len(contrasts) != n_contrasts:
+            raise ValueError(
+                f"Got {len(contrasts)} contrast names for {n_contrasts} contrast maps."
+            )
+        if sessions is not None and len(sessions) != n_contrasts:
+            raise ValueError(
+                f"Got {len(sessions)} sessions for {n_contrasts} contrast maps."
+            )
+
+        key = self._key(subject, hemisphere)
+        filename = f"{key}.npy"
+        n_vertices = len(data[0])
+
+        # Write rows one by one so that data can be a list of maps
+        # without being stacked in memory
+        array = np.lib.format.open_memmap(
+            self.path / filename,
+            mode="w+",
+            dtype=np.float32,
+            shape=(n_contrasts, n_vertices),
+        )
+        for i, contrast_map in enumerate(data):
+            array[i] = contrast_map
+        array.flush()
+        del array
+
+        self.index[key] = {
+            "subject": subject,
+            "hemisphere": hemisphere,
+            "filename": filename,
+            "shape": [n_contrasts, n_vertices],
+            "contrasts": list(contrasts),
+            "sessions": None if sessions is None else list(sessions),
+            "metadata": metadata,
+        }
+        self._write_index()
+
+    def metadata(self, subject, hemisphere):
+        """Get index entry of a subject's hemisphere."""
+
+        return self.index[self._key(subject, hemisphere)]
+
+    def get(self, subject, hemisphere, rows=None, mode="r"):
+        """
+        Get contrast matrix of a subject's hemisphere.
+
+        Parameters
+        ----------
+        subject: str
+        hemisphere: str
+        rows: slice, list of int, list of str or None
+            Contrast maps to select.
+            Slices (and None, which selects all maps) return
+            memory-mapped views without copying data,
+            which can be passed directly to MSM.fit or MSM.transform.
+            Lists of indices or contrast names return in-memory copies
+            of the selected maps.
+        mode: str
+            Mode used to memory-map the array.
+
+        Returns
+        -------
+        data: ndarray(n_selected_contrasts, n_vertices)
+        """
+        entry = self.metadata(subject, hemisphere)
+        data = np.load(self.path / entry["filename"], mmap_mode=mode)
+
+        if rows is None:
+            return data
+        if isinstance(rows, slice):
+            return data[rows]
+
+        positions = {contrast: i for i, contrast in enumerate(entry["contrasts"])}
+        indices = [positions[row] if isinstance(row, str) else row for row in rows]
+
+        return np.asarray(data[indices])
@@ -0,0 +1,84 @@
+import numpy as np
+
+
+def pairwise_similarity(models, data, chunk_size=10000, **kwargs):
+    """
+    Correlate aligned contrast maps of all pairs of subjects.
+
+    Each subject is transformed once into the shared space,
+    then correlations of all pairs of subjects are computed
+    for each contrast with batched matrix products of centered maps,
+    processing vertices by chunks so that memory stays bounded.
+
+    Parameters
+    ----------
+    models: list of MSM or None
+        Fitted alignment of each subject onto the shared space
+        (typically a template). None stands for subjects whose data
+        already lives in the shared space.
+    data: list of ndarray(n_contrasts, n_vertices)
+        Contrast maps of each subject, in the same order of contrasts
+        for all subjects.
+    chunk_size: int
+        Number of vertices processed at once.
+    **kwargs:
+        Additional arguments passed to MSM.transform,
+        such as parcellation.
+
+    Returns
+    -------
+    similarity: ndarray(n_subjects, n_subjects, n_contrasts)
+        Pearson correlation between aligned maps of each pair of subjects
+        for each contrast.
+    """
+    if len(models) != len(data):
+        raise ValueError(f"Got {len(models)} models for {len(data)} subjects.")
+
+    # aligned[i, j] is the j-th contrast map of subject i in the shared space
+    aligned = np.stack(
+        [
+            np.asarray(subject_data)
+            if model is None
+            else model.transform(np.asarray(subject_data), **kwargs)
+            for model, subject_data in zip(models, data)
+        ]
+    ).astype(np.float32, copy=False)
+    n_subjects, n_contrasts, n_vertices = aligned.shape
+
+    means = aligned.mean(axis=2, dtype=np.float64)
+    # Sums of products of centered maps, accumulated over chunks
+    products = np.zeros((n_contrasts, n_subjects, n_subjects))
+    for start in range(0, n_vertices, chunk_size):
+        chunk = aligned[:, :, start : start + chunk_size] - means[:, :, None]
+        # (n_contrasts, n_subjects, chunk_size)
+        chunk = chunk.transpose(1, 0, 2)
+        products += np.matmul(chunk, chunk.transpose(0, 2, 1))
+
+    norms = np.sqrt(np.diagonal(products, axis1=1, axis2=2))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        similarity = products / (norms[:, :, None] * norms[:, None, :])
+
+    return similarity.transpose(1, 2, 0)
+
+
+def correlation(x, y):
+    """
+    Pearson correlation between corresponding rows of two arrays.
+
+    Parameters
+    ----------
+    x, y: ndarray(n_samples, n_features) or ndarray(n_features)
+
+    Returns
+    -------
+    correlations: ndarray(n_samples,) or float
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.sum(x * y, axis=-1) / np.sqrt(
+            np.sum(x**2, axis=-1) * np.sum(y**2, axis=-1)
+        )
@@ -0,0 +1,409 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import os
+from pathlib import Path
+import shutil
+from tempfile import mkdtemp
+
+
+def mesh_hash(mesh):
+    """Hash vertices and faces of a GIFTI mesh."""
+
+    vertices = np.ascontiguousarray(mesh.darrays[0].data)
+    faces = np.ascontiguousarray(mesh.darrays[1].data)
+    h = hashlib.sha1()
+    for array in [vertices, faces]:
+        h.update(str((array.dtype, array.shape)).encode())
+        h.update(array.tobytes())
+
+    return h.hexdigest()
+
+
+def face_neighbors(faces):
+    """Compute, for each triangle, the triangles sharing each of its edges.
+
+    Parameters
+    ----------
+    faces: ndarray(n_faces, 3)
+        Vertex indices of each triangle of the mesh.
+
+    Returns
+    -------
+    neighbors: ndarray(n_faces, 3)
+        neighbors[f, i] is the triangle sharing the edge of triangle f
+        which is opposite to its i-th vertex, or -1 on mesh boundaries.
+    """
+    n_faces = faces.shape[0]
+    n_vertices = faces.max() + 1
+
+    # Edge opposite to the i-th vertex of each triangle
+    start = faces[:, [1, 2, 0]].ravel()
+    end = faces[:, [2, 0, 1]].ravel()
+    keys = np.minimum(start, end).astype(np.int64) * n_vertices + np.maximum(
+        start, end
+    )
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    shared = np.flatnonzero(sorted_keys[1:] == sorted_keys[:-1])
+
+    neighbors = np.full(3 * n_faces, -1)
+    neighbors[order[shared]] = order[shared + 1] // 3
+    neighbors[order[shared + 1]] = order[shared] // 3
+
+    return neighbors.reshape(n_faces, 3)
+
+
+class MeshGeometry:
+    # Arrays derived from vertices and faces, stored in sidecar files
+    arrays = [
+        "vertices",
+        "faces",
+        "face_areas",
+        "face_normals",
+        "face_neighbors",
+        "adjacency_indptr",
+        "adjacency_indices",
+    ]
+
+    def __init__(self, vertices, faces):
+        """
+        Compute derived geometry of a triangular mesh.
+
+        Parameters
+        ----------
+        vertices: ndarray(n_vertices, 3)
+            Vertex coordinates.
+        faces: ndarray(n_faces, 3)
+            Vertex indices of each triangle of the mesh.
+        """
+
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.faces = np.asarray(faces, dtype=np.int64)
+
+        a, b, c = (self.vertices[self.faces[:, i]] for i in range(3))
+        cross = np.cross(b - a, c - a)
+        norms = np.linalg.norm(cross, axis=1)
+        self.face_areas = norms / 2
+        self.face_normals = cross / norms[:, None]
+        self.face_neighbors = face_neighbors(self.faces)
+
+        from scipy import sparse
+
+        n_vertices = self.vertices.shape[0]
+        rows = self.faces[:, [0, 1, 1, 2, 2, 0]].ravel()
+        cols = self.faces[:, [1, 0, 2, 1, 0, 2]].ravel()
+        adjacency = sparse.csr_matrix(
+            (np.ones(rows.shape[0], dtype=np.int8), (rows, cols)),
+            shape=(n_vertices, n_vertices),
+        )
+        adjacency.sum_duplicates()
+        self.adjacency_indptr = adjacency.indptr.astype(np.int64)
+        self.adjacency_indices = adjacency.indices.astype(np.int64)
+
+    @classmethod
+    def from_gifti(cls, mesh):
+        """Compute geometry of a mesh loaded with utils.gifti_from_file."""
+
+        return cls(mesh.darrays[0].data, mesh.darrays[1].data)
+
+    @property
+    def n_vertices(self):
+        return self.vertices.shape[0]
+
+    @property
+    def radius(self):
+        """Mean distance of vertices to the origin."""
+
+        return np.mean(np.linalg.norm(self.vertices, axis=1))
+
+    @property
+    def adjacency(self):
+        """Binary vertex adjacency matrix as a scipy.sparse.csr_matrix."""
+        from scipy import sparse
+
+        return sparse.csr_matrix(
+            (
+                np.ones(self.adjacency_indices.shape[0]),
+                self.adjacency_indices,
+                self.adjacency_indptr,
+            ),
+            shape=(self.n_vertices, self.n_vertices),
+        )
+
+    def save(self, path):
+        """
+        Save geometry as a directory of .npy files.
+
+        The directory is first written next to its final location
+        and then renamed, so that concurrent readers never
+        see partially written files.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = mkdtemp(dir=path.parent, prefix=f".{path.name}.")
+        for name in self.arrays:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(self, name))
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Geometry was saved by a concurrent process in the meantime
+            shutil.rmtree(tmp_path)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Load geometry saved with save, memory-mapping arrays by default."""
+
+        geometry = cls.__new__(cls)
+        for name in cls.arrays:
+            setattr(
+                geometry,
+                name,
+                np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode),
+            )
+
+        return geometry
+
+
+# Size above which least recently used entries of a cache are removed,
+# in bytes, which can be overridden with $MSM_CACHE_SIZE
+MAX_CACHE_SIZE = 2**30
+
+
+def get_cache_dir(cache_dir=None):
+    """
+    Directory in which mesh geometry sidecars are stored.
+
+    Defaults to $MSM_CACHE_DIR if set, and to ~/.cache/msm otherwise.
+    """
+    if cache_dir is None:
+        cache_dir = os.getenv(
+            "MSM_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "msm")
+        )
+
+    return Path(cache_dir)
+
+
+def _entry_size(path):
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+    return path.stat().st_size
+
+
+def prune_cache(directory, max_size=None):
+    """
+    Remove least recently used entries of a cache directory.
+
+    Entries (files or directories) are removed, oldest modification
+    time first, until their total size is below max_size.
+    Readers of the cache should touch entries they use.
+
+    Parameters
+    ----------
+    directory: str or Path
+        Directory whose entries are cached items.
+    max_size: int or None
+        Size of the cache, in bytes. Defaults to $MSM_CACHE_SIZE if set,
+        and to MAX_CACHE_SIZE otherwise.
+    """
+    if max_size is None:
+        max_size = int(os.getenv("MSM_CACHE_SIZE", MAX_CACHE_SIZE))
+
+    entries = []
+    try:
+        for path in Path(directory).iterdir():
+            # Skip temporary entries being written
+            if not path.name.startswith("."):
+                entries.append((path.stat().st_mtime, _entry_size(path), path))
+    except OSError:
+        # Entries were removed concurrently
+        return
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+        if total_size <= max_size:
+            break
+        try:
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+        except OSError:
+            pass
+        total_size -= size
+
+
+# Number of geometries of persisted meshes kept in memory by get_geometry
+MAX_GEOMETRIES = 8
+
+_geometries = OrderedDict()
+
+
+def get_geometry(mesh, cache_dir=None, persist=False):
+    """
+    Get derived geometry of a mesh, computing it only once.
+
+    Geometry is keyed by the content hash of the mesh.
+    It is loaded from a memory-mappable sidecar directory of cache_dir
+    if one was stored by another process. Geometries of persisted meshes
+    are also kept in memory, up to the MAX_GEOMETRIES most recently
+    used ones, while other geometries are left to their caller.
+
+    Parameters
+    ----------
+    mesh: nibabel.gifti.GiftiImage
+        Mesh, typically loaded with utils.gifti_from_file.
+    cache_dir: str or None
+        Directory in which sidecars are stored.
+        See get_cache_dir for default value.
+    persist: bool
+        Whether a sidecar should be stored if there is none,
+        and geometry kept in memory.
+        Only meshes reused across runs, such as source and target
+        spheres, are worth it, rather than transformed meshes of each fit.
+        Least recently used sidecars are removed once they exceed
+        the size of the cache (see prune_cache).
+
+    Returns
+    -------
+    geometry: MeshGeometry
+    """
+    key = mesh_hash(mesh)
+    if key in _geometries:
+        _geometries.move_to_end(key)
+        return _geometries[key]
+
+    path = get_cache_dir(cache_dir) / "geometry" / key
+    if path.exists():
+        geometry = MeshGeometry.load(path)
+        try:
+            # Mark sidecar as recently used
+            os.utime(path)
+        except OSError:
+            pass
+    else:
+        geometry = MeshGeometry.from_gifti(mesh)
+        if persist:
+            try:
+                geometry.save(path)
+                prune_cache(path.parent)
+            except OSError:
+                # Cache directory is not writable,
+                # geometry is only kept in memory
+                pass
+
+    if persist:
+        _geometries[key] = geometry
+        while len(_geometries) > MAX_GEOMETRIES:
+            _geometries.popitem(last=False)
+
+    return geometry
+
+
+def _local_edges(vertices, faces):
+    """Express the two first edges of each triangle in a local 2D frame.
+
+    The frame is oriented with respect to the radial direction,
+    such that triangles which are flipped on the sphere
+    have a negative determinant.
+
+    Returns
+    -------
+    edges: ndarray(n_faces, 2, 2)
+        Columns hold coordinates of edges b - a and c - a.
+    """
+    a, b, c = (vertices[faces[:, i]] for i in range(3))
+    e1, e2 = b - a, c - a
+    radial = a + b + c
+    radial /= np.linalg.norm(radial, axis=1, keepdims=True)
+
+    norm_e1 = np.linalg.norm(e1, axis=1)
+    u = e1 / norm_e1[:, None]
+    v = np.cross(radial, u)
+    v /= np.linalg.norm(v, axis=1, keepdims=True)
+
+    edges = np.zeros((faces.shape[0], 2, 2))
+    edges[:, 0, 0] = norm_e1
+    edges[:, 0, 1] = np.einsum("ij,ij->i", e2, u)
+    edges[:, 1, 1] = np.einsum("ij,ij->i", e2, v)
+
+    return edges
+
+
+def deformation_distortion(vertices, deformed_vertices, faces):
+    """
+    Compute distortion of each triangle of a deformed mesh.
+
+    Parameters
+    ----------
+    vertices: ndarray(n_vertices, 3)
+        Vertex coordinates of the original spherical mesh.
+    deformed_vertices: ndarray(n_vertices, 3)
+        Vertex coordinates of the deformed spherical mesh.
+    faces: ndarray(n_faces, 3)
+        Vertex indices of each triangle, shared by both meshes.
+
+    Returns
+    -------
+    jacobians: ndarray(n_faces,)
+        Signed ratio of deformed to original triangle areas.
+        It is negative for folded triangles.
+    shape_distortion: ndarray(n_faces,)
+        Log2 ratio of the principal stretches of each triangle.
+    """
+    source_edges = _local_edges(np.asarray(vertices, dtype=np.float64), faces)
+    deformed_edges = _local_edges(
+        np.asarray(deformed_vertices, dtype=np.float64), faces
+    )
+
+    # Deformation gradient of each triangle,
+    # source edges being upper triangular matrices
+    inverse = np.zeros_like(source_edges)
+    inverse[:, 0, 0] = 1 / source_edges[:, 0, 0]
+    inverse[:, 1, 1] = 1 / source_edges[:, 1, 1]
+    inverse[:, 0, 1] = -source_edges[:, 0, 1] * inverse[:, 0, 0] * inverse[:, 1, 1]
+    gradients = deformed_edges @ inverse
+
+    jacobians = np.linalg.det(gradients)
+
+    # Closed-form singular values of 2x2 matrices
+    half_norm = np.sum(gradients**2, axis=(1, 2)) / 2
+    largest = np.sqrt(half_norm + np.sqrt(np.maximum(half_norm**2 - jacobians**2, 0)))
+    smallest = np.abs(jacobians) / largest
+    shape_distortion = np.log2(largest / smallest)
+
+    return jacobians, shape_distortion
+
+
+def average_deformations(deformed_vertices, radius):
+    """
+    Average several deformations of a spherical mesh.
+
+    Parameters
+    ----------
+    deformed_vertices: ndarray(n_deformations, n_vertices, 3)
+        Vertex coordinates of each deformed spherical mesh.
+    radius: float
+        Radius of the sphere on which deformed meshes lie.
+
+    Returns
+    -------
+    mean_vertices: ndarray(n_vertices, 3)
+        Mean position of each vertex, projected back onto the sphere.
+    variability: ndarray(n_vertices,)
+        Root mean square geodesic distance between positions
+        of each vertex and their mean, in the units of coordinates.
+    """
+    deformed_vertices = np.asarray(deformed_vertices, dtype=np.float64)
+    mean_vertices = deformed_vertices.mean(axis=0)
+    mean_vertices *= radius / np.linalg.norm(mean_vertices, axis=1, keepdims=True)
+
+    cosines = np.sum(deformed_vertices * mean_vertices, axis=2) / (
+        radius * np.linalg.norm(deformed_vertices, axis=2)
+    )
+    distances = radius * np.arccos(np.clip(cosines, -1, 1))
+    variability = np.sqrt(np.mean(distances**2, axis=0))
+
+    return mean_vertices, variability
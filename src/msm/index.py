@@ -0,0 +1,289 @@
+from collections import OrderedDict
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from msm import geometry
+
+
+def _barycentric_weights(vertices, faces, face_indices, points):
+    """Spherical barycentric coordinates of points in given triangles.
+
+    They are proportional to the volumes of tetrahedra formed by
+    the origin, the point and each edge of the triangle, which amounts
+    to radially projecting points onto triangles.
+    """
+    a, b, c = (vertices[faces[face_indices, i]] for i in range(3))
+    weights = np.stack(
+        [
+            np.einsum("...k,...k->...", points, np.cross(b, c)),
+            np.einsum("...k,...k->...", points, np.cross(c, a)),
+            np.einsum("...k,...k->...", points, np.cross(a, b)),
+        ],
+        axis=-1,
+    )
+    weights /= weights.sum(axis=-1, keepdims=True)
+
+    return weights
+
+
+class SphereIndex:
+    def __init__(
+        self, vertices, faces, neighbors=None, n_candidates=4, max_steps=64
+    ):
+        """
+        Build spatial index of a spherical mesh.
+
+        Query points are first tested against triangles with
+        nearest centroids (found with a KD-tree), and points
+        which are not located this way walk across triangle
+        adjacencies until they reach their triangle.
+
+        Parameters
+        ----------
+        vertices: ndarray(n_vertices, 3)
+            Vertex coordinates of a spherical mesh centered on the origin.
+        faces: ndarray(n_faces, 3)
+            Vertex indices of each triangle of the mesh.
+        neighbors: ndarray(n_faces, 3) or None
+            Adjacent triangles of each triangle,
+            as computed by geometry.face_neighbors.
+            They are computed if not provided.
+        n_candidates: int
+            Number of triangles with nearest centroids tested
+            for each query point.
+        max_steps: int
+            Maximum number of steps of adjacency walking.
+        """
+
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.faces = np.asarray(faces, dtype=np.int64)
+        self.n_candidates = n_candidates
+        self.max_steps = max_steps
+
+        if neighbors is None:
+            neighbors = geometry.face_neighbors(self.faces)
+        self.neighbors = neighbors
+        centroids = self.vertices[self.faces].mean(axis=1)
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+        self._centroid_tree = cKDTree(centroids)
+        self._vertex_tree = None
+
+    @classmethod
+    def from_gifti(cls, mesh, **kwargs):
+        """Build index from a mesh loaded with utils.gifti_from_file."""
+
+        mesh_geometry = geometry.get_geometry(mesh)
+
+        return cls(
+            mesh_geometry.vertices,
+            mesh_geometry.faces,
+            neighbors=mesh_geometry.face_neighbors,
+            **kwargs,
+        )
+
+    @property
+    def n_vertices(self):
+        return self.vertices.shape[0]
+
+    def query(self, points, chunk_size=100000):
+        """
+        Find triangles containing query points.
+
+        Points are radially projected onto triangles, so that they
+        do not need to lie exactly on the mesh.
+
+        Parameters
+        ----------
+        points: ndarray(n_points, 3)
+            Coordinates of query points.
+        chunk_size: int
+            Number of points processed at once, which bounds memory usage.
+
+        Returns
+        -------
+        face_indices: ndarray(n_points,)
+            Index of the triangle containing each point.
+        weights: ndarray(n_points, 3)
+            Barycentric coordinates of each point in its triangle.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        face_indices = np.empty(points.shape[0], dtype=np.int64)
+        weights = np.empty((points.shape[0], 3))
+
+        for start in range(0, points.shape[0], chunk_size):
+            chunk = slice(start, start + chunk_size)
+            face_indices[chunk], weights[chunk] = self._query(points[chunk])
+
+        return face_indices, weights
+
+    def _query(self, points):
+        n_points = points.shape[0]
+        rows = np.arange(n_points)
+        k = min(self.n_candidates, self.faces.shape[0])
+
+        directions = points / np.linalg.norm(points, axis=1, keepdims=True)
+        _, candidates = self._centroid_tree.query(directions, k=k)
+        candidates = candidates.reshape(n_points, k)
+
+        candidate_weights = _barycentric_weights(
+            self.vertices, self.faces, candidates, points[:, None, :]
+        )
+        best = np.argmax(candidate_weights.min(axis=-1), axis=1)
+        face_indices = candidates[rows, best]
+        weights = candidate_weights[rows, best]
+
+        # Walk from the best candidate towards the triangle
+        # containing each remaining point, crossing the edge
+        # opposite to the most negative barycentric coordinate
+        remaining = np.flatnonzero(weights.min(axis=1) < -1e-6)
+        for _ in range(self.max_steps):
+            if remaining.size == 0:
+                break
+            worst = np.argmin(weights[remaining], axis=1)
+            next_faces = self.neighbors[face_indices[remaining], worst]
+            # Stop on mesh boundaries
+            remaining = remaining[next_faces >= 0]
+            next_faces = next_faces[next_faces >= 0]
+
+            face_indices[remaining] = next_faces
+            weights[remaining] = _barycentric_weights(
+                self.vertices, self.faces, next_faces, points[remaining]
+            )
+            remaining = remaining[weights[remaining].min(axis=1) < -1e-6]
+
+        # Points which could not be strictly located (because of numerical
+        # precision or holes in the mesh) are snapped to their last triangle
+        weights = np.clip(weights, 0, None)
+        weights /= weights.sum(axis=1, keepdims=True)
+
+        return face_indices, weights
+
+    def nearest_vertex(self, points):
+        """
+        Find nearest mesh vertex of query points.
+
+        Parameters
+        ----------
+        points: ndarray(n_points, 3)
+            Coordinates of query points.
+
+        Returns
+        -------
+        vertex_indices: ndarray(n_points,)
+            Index of the nearest vertex of each point.
+        """
+        if self._vertex_tree is None:
+            self._vertex_tree = cKDTree(self.vertices)
+        _, vertex_indices = self._vertex_tree.query(np.asarray(points))
+
+        return vertex_indices
+
+    def interpolation_operator(self, points):
+        """
+        Build the sparse operator interpolating mesh data at query points.
+
+        Parameters
+        ----------
+        points: ndarray(n_points, 3)
+            Coordinates of query points.
+
+        Returns
+        -------
+        operator: scipy.sparse.csr_matrix(n_points, n_vertices)
+            Operator such that operator @ data interpolates data,
+            living on mesh vertices, at query points.
+        """
+        face_indices, weights = self.query(points)
+        n_points = face_indices.shape[0]
+
+        operator = sparse.csr_matrix(
+            (
+                weights.ravel(),
+                (
+                    np.repeat(np.arange(n_points), 3),
+                    self.faces[face_indices].ravel(),
+                ),
+            ),
+            shape=(n_points, self.n_vertices),
+        )
+
+        return operator
+
+    def save(self, path):
+        """Save index to a .npz file, which can be reloaded with load."""
+
+        np.savez(
+            path,
+            vertices=self.vertices,
+            faces=self.faces,
+            neighbors=self.neighbors,
+            n_candidates=self.n_candidates,
+            max_steps=self.max_steps,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load index saved with save."""
+
+        with np.load(path) as f:
+            index = cls.__new__(cls)
+            index.vertices = f["vertices"]
+            index.faces = f["faces"]
+            index.neighbors = f["neighbors"]
+            index.n_candidates = int(f["n_candidates"])
+            index.max_steps = int(f["max_steps"])
+
+        centroids = index.vertices[index.faces].mean(axis=1)
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+        index._centroid_tree = cKDTree(centroids)
+        index._vertex_tree = None
+
+        return index
+
+
+# Number of indices kept in memory by get_index
+MAX_INDICES = 8
+
+_indices = OrderedDict()
+
+
+def get_index(mesh, persist=False):
+    """
+    Get spatial index of a mesh, building it only once per process.
+
+    Indices are shared between all meshes with identical vertices
+    and faces, such that models fitted on the same sphere
+    reuse the same index. They are built upon the cached mesh geometry.
+    Only the MAX_INDICES most recently used indices are kept in memory,
+    hence indices of meshes specific to a model (such as its transformed
+    mesh) should rather be built with SphereIndex.from_gifti
+    and kept on the model.
+
+    Parameters
+    ----------
+    mesh: nibabel.gifti.GiftiImage
+        Spherical mesh, typically loaded with utils.gifti_from_file.
+    persist: bool
+        Whether the geometry of the mesh should be stored in the cache
+        directory, see geometry.get_geometry.
+
+    Returns
+    -------
+    index: SphereIndex
+    """
+    key = geometry.mesh_hash(mesh)
+
+    if key in _indices:
+        _indices.move_to_end(key)
+    else:
+        mesh_geometry = geometry.get_geometry(mesh, persist=persist)
+        _indices[key] = SphereIndex(
+            mesh_geometry.vertices,
+            mesh_geometry.faces,
+            neighbors=mesh_geometry.face_neighbors,
+        )
+        while len(_indices) > MAX_INDICES:
+            _indices.popitem(last=False)
+
+    return _indices[key]
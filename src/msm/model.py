@@ -1,19 +1,209 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import hashlib
 import logging
 import nibabel as nib
 import numpy as np
-from sklearn.base import BaseEstimator, TransformerMixin
-from scipy.stats import pearsonr
 import os
 from pathlib import Path
-import shlex
-import subprocess
 from tempfile import TemporaryDirectory
+import time
 
-from msm.run import run_msm
+from msm.evaluate import correlation
+from msm.geometry import average_deformations, deformation_distortion, get_geometry
+from msm.run import run_msm, run_msmresample
+from msm.scheduler import Scheduler, estimate_msm_memory, msm_signature
 from msm import utils
 
+# scipy, and msm.index which builds upon it, are imported where needed,
+# so that importing this module remains cheap
 
-class MSM(BaseEstimator, TransformerMixin):
+# Number of maps transformed at once by native resampling
+TRANSFORM_CHUNK_SIZE = 256
+
+RESAMPLING_MODES = ["adaptive", "barycentric", "nearest", "majority"]
+
+
+def is_out_of_core(data):
+    """
+    Whether data is an on-disk array, which should be read by blocks of rows.
+
+    These are 2-dimensional numpy memory-mapped arrays, as well as
+    array-likes with a dtype supporting row slicing, such as
+    HDF5 datasets or zarr arrays. Other inputs, among which pandas
+    DataFrames and scipy sparse matrices, are converted with np.asarray.
+    """
+    if len(getattr(data, "shape", ())) != 2:
+        return False
+    if isinstance(data, np.memmap):
+        return True
+    if isinstance(data, np.ndarray):
+        return False
+
+    # Checked by module, to avoid importing pandas or scipy
+    module = type(data).__module__.split(".")[0]
+
+    return (
+        module not in ["pandas", "scipy"]
+        and hasattr(data, "dtype")
+        and hasattr(data, "__getitem__")
+    )
+
+
+def _create_output(source_data, path, shape, dtype, block_size):
+    # On-disk output of the same kind as source_data, at given path
+    parent = getattr(source_data, "parent", None)
+    if hasattr(parent, "create_dataset"):
+        # path names an HDF5 dataset of the group of source_data
+        return parent.create_dataset(
+            str(path),
+            shape=shape,
+            dtype=dtype,
+            chunks=(min(block_size, shape[0]), shape[1]),
+        )
+
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+def _fit_sample(
+    source_filenames, target_filenames, sample, source_mesh, target_mesh, run_kwargs
+):
+    # Register contrast maps of a sample, in a scheduler job for bootstraps
+    transformed_mesh, _ = run_msm(
+        source_contrasts_list=[source_filenames[i] for i in sample],
+        source_mesh=source_mesh,
+        target_contrasts_list=[target_filenames[i] for i in sample],
+        target_mesh=target_mesh,
+        **run_kwargs,
+    )
+
+    return transformed_mesh
+
+
+def _fit_hemisphere(
+    epsilon, source_data, target_data, source_mesh, target_mesh, kwargs
+):
+    # Fit one hemisphere of a BilateralMSM, in a scheduler job
+    return MSM(epsilon=epsilon).fit(
+        source_data,
+        target_data,
+        source_mesh=source_mesh,
+        target_mesh=target_mesh,
+        **kwargs,
+    )
+
+
+def _transform_hemisphere(model, source_data, kwargs):
+    # Transform one hemisphere of a BilateralMSM, in a scheduler job
+    return model.transform(source_data, **kwargs)
+
+
+def stream_rows(function, source_data, out, block_size=TRANSFORM_CHUNK_SIZE):
+    """
+    Apply function to blocks of rows of an on-disk array.
+
+    Reading, computing and writing overlap: while function
+    is applied to a block, a prefetch thread reads the next one,
+    and a writer thread writes the previous result to out.
+    Only a few blocks are thus held in memory at once.
+
+    Parameters
+    ----------
+    function: callable
+        Maps an ndarray(n_rows, n_features) to an ndarray(n_rows, n_outputs).
+    source_data: array-like(n_samples, n_features)
+        Array supporting row slicing, such as np.memmap or HDF5 dataset.
+    out: array-like(n_samples, n_outputs)
+        Array supporting row slice assignment, in which results are written.
+    block_size: int
+        Number of rows of each block.
+
+    Returns
+    -------
+    stats: dict
+        Number of rows, bytes read and written, elapsed time in seconds,
+        and resulting throughput in rows and megabytes per second.
+    """
+    n_samples = source_data.shape[0]
+    starts = list(range(0, n_samples, block_size))
+    stats = {"n_rows": n_samples, "bytes_read": 0, "bytes_written": 0}
+
+    def read(start):
+        # Copying forces the actual read from disk
+        return np.array(source_data[start : start + block_size])
+
+    def write(start, result):
+        out[start : start + result.shape[0]] = result
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(
+        max_workers=1
+    ) as writer:
+        next_block = reader.submit(read, starts[0]) if starts else None
+        written = None
+        for i, start in enumerate(starts):
+            block = next_block.result()
+            if i + 1 < len(starts):
+                next_block = reader.submit(read, starts[i + 1])
+            result = function(block)
+
+            # Results are written in order, one at a time
+            if written is not None:
+                written.result()
+            written = writer.submit(write, start, result)
+
+            stats["bytes_read"] += block.nbytes
+            stats["bytes_written"] += result.nbytes
+        if written is not None:
+            written.result()
+
+    if hasattr(out, "flush"):
+        out.flush()
+
+    stats["time"] = time.time() - start_time
+    elapsed = max(stats["time"], 1e-9)
+    stats["rows_per_second"] = n_samples / elapsed
+    stats["megabytes_per_second"] = (
+        (stats["bytes_read"] + stats["bytes_written"]) / 1e6 / elapsed
+    )
+
+    return stats
+
+
+def parcel_averaging(labels):
+    """
+    Build the sparse operator averaging data within parcels.
+
+    Parameters
+    ----------
+    labels: ndarray(n_vertices,)
+        Parcel label of each vertex.
+
+    Returns
+    -------
+    operator: scipy.sparse.csr_matrix(n_parcels, n_vertices)
+        Operator such that operator @ data averages data,
+        living on vertices, within each parcel.
+    parcels: ndarray(n_parcels,)
+        Label of each parcel, in the order of operator rows,
+        as given by np.unique(labels).
+    """
+    from scipy import sparse
+
+    parcels, parcel_indices = np.unique(np.asarray(labels), return_inverse=True)
+    counts = np.bincount(parcel_indices)
+    operator = sparse.csr_matrix(
+        (
+            1 / counts[parcel_indices],
+            (parcel_indices, np.arange(parcel_indices.shape[0])),
+        ),
+        shape=(parcels.shape[0], parcel_indices.shape[0]),
+    )
+
+    return operator, parcels
+
+
+class MSM(utils.TransformerMixin, utils.Estimator):
     def __init__(self, epsilon=0.1, **kwargs):
         """
         Initialize MSM object.
@@ -36,6 +226,10 @@ class MSM(BaseEstimator, TransformerMixin):
         target_mesh=None,
         verbose=False,
         debug=False,
+        n_bootstrap=None,
+        n_jobs=1,
+        memory_budget=None,
+        random_state=None,
         **kwargs,
     ):
         """
@@ -54,8 +248,32 @@ class MSM(BaseEstimator, TransformerMixin):
             Path to mesh used for source and target.
             Note that if target_mesh is not specified,
             the source_mesh will be used for all input data.
-        output_dir: str
-            Path to outputed files
+        verbose: bool
+            Whether msm should output verbose logs
+        debug: bool
+            Whether msm should output intermediate files
+            (only useful along with a work_dir kept after fitting)
+        n_bootstrap: int or None
+            If specified, n_bootstrap registrations are fitted on
+            contrast maps drawn with replacement from source_data
+            and target_data, and their deformations are averaged.
+            The root mean square geodesic distance between positions
+            of each vertex given by each registration and the average
+            is stored in deformation_variability.
+        n_jobs: int
+            Number of bootstrap registrations running at once.
+            They are run by a scheduler.Scheduler, which only starts
+            registrations whose estimated memory fits in memory_budget.
+        memory_budget: int or None
+            Memory which bootstrap registrations can use at once, in bytes.
+            See scheduler.Scheduler for default value.
+        random_state: int, numpy.random.RandomState or None
+            Seed of bootstrap samples.
+        **kwargs:
+            Additional arguments passed to run.run_msm,
+            such as timeout, retries or work_dir.
+            With n_bootstrap, each registration uses
+            a subdirectory of work_dir.
 
         Returns
         -------
@@ -68,6 +286,13 @@ class MSM(BaseEstimator, TransformerMixin):
         else:
             logger.setLevel(logging.WARNING)
 
+        # Only the registered sphere is used by the model
+        profile = "minimal"
+        if debug:
+            profile = "debug"
+        elif verbose:
+            profile = "standard"
+
         with TemporaryDirectory() as tmp_dir:
             source_filenames = []
             target_filenames = []
@@ -115,21 +340,177 @@ class MSM(BaseEstimator, TransformerMixin):
                 contrast_image.add_gifti_data_array(contrast_data_array)
                 contrast_image.to_filename(filename)
 
-            # Run msm
-            transformed_mesh, _ = run_msm(
-                source_contrasts_list=source_filenames,
-                source_mesh=source_mesh,
-                target_contrasts_list=target_filenames,
-                target_mesh=target_mesh,
-                epsilon=self.epsilon,
-            )
+            run_kwargs = {"epsilon": self.epsilon, "profile": profile, **kwargs}
+
+            if n_bootstrap is None:
+                # Run msm
+                transformed_mesh = _fit_sample(
+                    source_filenames,
+                    target_filenames,
+                    range(len(source_filenames)),
+                    source_mesh,
+                    target_mesh,
+                    run_kwargs,
+                )
+                self.deformation_variability = None
+            else:
+                # Contrast maps are written once and shared by all samples,
+                # which are registered concurrently by the scheduler
+                rng = random_state
+                if not isinstance(rng, np.random.RandomState):
+                    rng = np.random.RandomState(random_state)
+                n_samples = len(source_filenames)
+                samples = [
+                    rng.choice(n_samples, n_samples, replace=True)
+                    for _ in range(n_bootstrap)
+                ]
+                n_vertices = self.source_mesh.darrays[0].data.shape[0]
+                with Scheduler(
+                    max_cpus=n_jobs, memory_budget=memory_budget
+                ) as scheduler:
+                    futures = []
+                    for b, sample in enumerate(samples):
+                        sample_kwargs = dict(run_kwargs)
+                        if kwargs.get("work_dir") is not None:
+                            sample_kwargs["work_dir"] = os.path.join(
+                                kwargs["work_dir"], f"bootstrap_{b}"
+                            )
+                        futures.append(
+                            scheduler.submit(
+                                _fit_sample,
+                                source_filenames,
+                                target_filenames,
+                                sample,
+                                source_mesh,
+                                target_mesh,
+                                sample_kwargs,
+                                memory=estimate_msm_memory(n_vertices, n_samples),
+                                signature=msm_signature(n_vertices, n_samples),
+                            )
+                        )
+                    transformed_meshes = [future.result() for future in futures]
+
+                mean_vertices, self.deformation_variability = average_deformations(
+                    [mesh.darrays[0].data for mesh in transformed_meshes],
+                    get_geometry(self.target_mesh, persist=True).radius,
+                )
+                transformed_mesh = transformed_meshes[0]
+                transformed_mesh.darrays[0].data = mean_vertices.astype(np.float32)
 
             # Save computed transformation in model
             self.transformed_mesh = transformed_mesh
+            self._reset_operators()
 
         return self
 
-    def transform(self, source_data):
+    def _reset_operators(self):
+        # Sparse operators derived from the fitted deformation,
+        # which are computed lazily and cached in the model
+        self._inverse_operator = None
+        self._forward_operator = None
+        self._parcel_operators = {}
+        self._nearest_indices = None
+        self._majority_operator = None
+        self._transformed_index = None
+
+    def _get_inverse_operator(self):
+        # Interpolate target data at positions of transformed source vertices
+        if getattr(self, "_inverse_operator", None) is None:
+            from msm.index import get_index
+
+            self._inverse_operator = get_index(
+                self.target_mesh, persist=True
+            ).interpolation_operator(self.transformed_mesh.darrays[0].data)
+
+        return self._inverse_operator
+
+    def _get_transformed_index(self):
+        # The transformed source mesh is specific to this model,
+        # hence its index is kept on the model rather than in the
+        # process-wide cache of msm.index.get_index, so that it is
+        # released along with the model
+        if getattr(self, "_transformed_index", None) is None:
+            from msm.index import SphereIndex
+
+            self._transformed_index = SphereIndex.from_gifti(self.transformed_mesh)
+
+        return self._transformed_index
+
+    def _get_forward_operator(self):
+        # Interpolate source data at positions of target vertices
+        # on the transformed source mesh
+        if getattr(self, "_forward_operator", None) is None:
+            index = self._get_transformed_index()
+            self._forward_operator = index.interpolation_operator(
+                self.target_mesh.darrays[0].data
+            )
+
+        return self._forward_operator
+
+    def _get_parcel_operator(self, parcellation):
+        parcellation = np.ascontiguousarray(parcellation)
+        key = hashlib.sha1(
+            parcellation.tobytes() + str(parcellation.dtype).encode()
+        ).hexdigest()
+
+        if getattr(self, "_parcel_operators", None) is None:
+            self._parcel_operators = {}
+        if key not in self._parcel_operators:
+            averaging, _ = parcel_averaging(parcellation)
+            self._parcel_operators[key] = (
+                averaging @ self._get_forward_operator()
+            ).tocsr()
+
+        return self._parcel_operators[key]
+
+    def _get_nearest_indices(self):
+        # Nearest transformed source vertex of each target vertex
+        if getattr(self, "_nearest_indices", None) is None:
+            self._nearest_indices = self._get_transformed_index().nearest_vertex(
+                self.target_mesh.darrays[0].data
+            )
+
+        return self._nearest_indices
+
+    def _get_majority_operator(self):
+        # Vertices of the transformed source triangle containing
+        # each target vertex, along with their barycentric coordinates,
+        # which are ratios of areas of the triangle
+        if getattr(self, "_majority_operator", None) is None:
+            index = self._get_transformed_index()
+            face_indices, weights = index.query(self.target_mesh.darrays[0].data)
+            self._majority_operator = (index.faces[face_indices], weights)
+
+        return self._majority_operator
+
+    def _transform_labels(self, source_data, mode):
+        if mode == "nearest":
+            return source_data[:, self._get_nearest_indices()]
+
+        vertices, weights = self._get_majority_operator()
+        # candidates[i, j, k] is the label of the k-th vertex
+        # of the triangle containing target vertex j in map i
+        candidates = source_data[:, vertices]
+        # Total area of the triangle holding the same label as each vertex
+        votes = np.zeros(candidates.shape, dtype=weights.dtype)
+        for k in range(3):
+            for j in range(3):
+                votes[..., k] += weights[:, j] * (
+                    candidates[..., k] == candidates[..., j]
+                )
+        winners = np.argmax(votes, axis=-1)
+
+        return np.take_along_axis(candidates, winners[..., None], axis=-1)[..., 0]
+
+    def transform(
+        self,
+        source_data,
+        parcellation=None,
+        mode="adaptive",
+        dtype=None,
+        out=None,
+        block_size=None,
+    ):
         """
         Map source contrast maps onto target mesh.
 
@@ -137,23 +518,113 @@ class MSM(BaseEstimator, TransformerMixin):
         ----------
         source_data: ndarray(n_samples, n_features)
             Contrast maps for source subject.
+            It can also be an on-disk array which does not fit in memory,
+            such as np.memmap, HDF5 dataset or zarr array
+            (any array-like supporting row slicing).
+            It is then transformed by blocks of rows, with a prefetch thread
+            reading the next block and another thread writing the previous
+            one while the current one is resampled (see stream_rows),
+            and throughput is logged.
+        parcellation: ndarray(n_target_vertices,) or None
+            Parcel label of each vertex of the target mesh.
+            If specified, transformed maps are averaged within parcels:
+            resampling and averaging are fused in a single sparse
+            (n_parcels, n_features) operator, cached for each parcellation,
+            so that full resolution transformed maps are never computed.
+            Resampling then uses barycentric interpolation
+            on the transformed mesh instead of msmresample.
+        mode: "adaptive", "barycentric", "nearest" or "majority"
+            Resampling method. "adaptive" uses adaptive barycentric
+            interpolation of msmresample, and suits continuous maps.
+            "barycentric" interpolates continuous maps natively,
+            with a sparse operator cached in the model.
+            "nearest" and "majority" suit discrete maps such as
+            parcellations or masks, which are mapped at once
+            without any subprocess: "nearest" takes the value of
+            the nearest transformed source vertex, and "majority"
+            the value covering the largest area of the transformed
+            source triangle containing each target vertex.
+            Their index arrays are computed once and cached in the model.
+        dtype: numpy dtype or None
+            Type of transformed maps. Defaults to the type of source_data.
+            msmresample computes float32 maps, which are best kept
+            as float32 to avoid converting them.
+        out: ndarray or None
+            Array in which transformed maps are written, of the shape
+            described below (for instance a view of a larger array
+            or a memory-mapped file). If None, a new array is allocated.
+            Each transformed map is written directly in it,
+            without any intermediate copy of all maps.
+            For on-disk source_data, it can be any array-like supporting
+            row slice assignment, or a path where an on-disk output
+            of the same kind is created: the name of a dataset of the group
+            of an HDF5 dataset, and a memory-mapped .npy file otherwise.
+        block_size: int or None
+            Number of rows of on-disk source_data read at once.
+            Defaults to TRANSFORM_CHUNK_SIZE.
 
         Returns
         -------
         predicted_contrast_maps: ndarray(n_samples, n_features)
             Contrast map transformed from source space to target space.
             n is the number of voxels of the target mesh
-            use during the fitting phase
+            use during the fitting phase.
+            If parcellation is specified, it is rather
+            ndarray(n_samples, n_parcels), with parcels ordered
+            as np.unique(parcellation).
+            It is out if specified.
         """
-        FSLDIR, _ = utils.check_fsl()
+        if mode not in RESAMPLING_MODES:
+            raise ValueError(
+                f"Unknown mode {mode}, should be one of {RESAMPLING_MODES}"
+            )
+        if mode in ["nearest", "majority"] and parcellation is not None:
+            raise ValueError(f"parcellation cannot be used in {mode} mode")
+
+        if is_out_of_core(source_data):
+            return self._transform_out_of_core(
+                source_data, parcellation, mode, dtype, out, block_size
+            )
 
-        predicted_contrast_maps = []
+        if hasattr(source_data, "toarray"):
+            # scipy sparse matrices
+            source_data = source_data.toarray()
+        source_data = np.asarray(source_data)
 
-        # Assure source_data to be 2-dimensional
-        one_dimensional = False
-        if source_data.ndim == 1:
-            one_dimensional = True
-            source_data = np.array([source_data])
+        # Assure source_data to be 2-dimensional, without copying it
+        one_dimensional = source_data.ndim == 1
+        if one_dimensional:
+            source_data = source_data[None, :]
+
+        operator = None
+        n_outputs = self.target_mesh.darrays[0].data.shape[0]
+        if parcellation is not None:
+            operator = self._get_parcel_operator(parcellation)
+            n_outputs = operator.shape[0]
+        elif mode == "barycentric":
+            operator = self._get_forward_operator()
+
+        shape = (n_outputs,) if one_dimensional else (source_data.shape[0], n_outputs)
+        if out is None:
+            out = np.empty(shape, dtype=source_data.dtype if dtype is None else dtype)
+        elif out.shape != shape:
+            raise ValueError(f"Expected out of shape {shape}, got {out.shape}.")
+        # View of out with one row per map
+        predicted_data = out[None, :] if one_dimensional else out
+
+        if mode != "adaptive" or operator is not None:
+            # Maps are transformed by chunks of rows,
+            # which bounds memory used by intermediate results
+            for start in range(0, source_data.shape[0], TRANSFORM_CHUNK_SIZE):
+                chunk = slice(start, start + TRANSFORM_CHUNK_SIZE)
+                if operator is not None:
+                    predicted_data[chunk] = (operator @ source_data[chunk].T).T
+                else:
+                    predicted_data[chunk] = self._transform_labels(
+                        source_data[chunk], mode
+                    )
+
+            return out
 
         with TemporaryDirectory() as tmp_dir:
             # Write transformed_mesh to gifti file
@@ -169,7 +640,7 @@ class MSM(BaseEstimator, TransformerMixin):
                 source_contrast_filename = str(Path(tmp_dir) / f"source_{i}.func.gii")
 
                 contrast_data_array = nib.gifti.gifti.GiftiDataArray(
-                    data=contrast,
+                    data=contrast.astype(np.float32, copy=False),
                     datatype=nib.nifti1.data_type_codes.code["NIFTI_TYPE_FLOAT32"],
                     intent=nib.nifti1.intent_codes.code["NIFTI_INTENT_POINTSET"],
                     coordsys=self.source_mesh.darrays[0].coordsys,
@@ -183,61 +654,78 @@ class MSM(BaseEstimator, TransformerMixin):
                 contrast_image.add_gifti_data_array(contrast_data_array)
                 contrast_image.to_filename(source_contrast_filename)
 
-                predicted_contrast_path = str(Path(tmp_dir) / "predicted_contrast")
-
                 # Map source_data onto target mesh
-                cmd = shlex.split(
-                    " ".join(
-                        [
-                            os.path.join(FSLDIR, "bin/msmresample"),
-                            f"{transformed_mesh_path}",
-                            predicted_contrast_path,
-                            f"-labels {source_contrast_filename}",
-                            f"-project {target_mesh_path}",
-                        ]
-                    )
+                predicted_contrast = run_msmresample(
+                    transformed_mesh_path,
+                    source_contrast_filename,
+                    target_mesh_path,
                 )
 
-                process = subprocess.Popen(
-                    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                )
+                # Write predicted contrast map in its row of the output
+                predicted_data[i] = predicted_contrast.darrays[0].data
 
-                with process.stdout:
-                    utils.log_subprocess_output(process.stdout)
-                with process.stderr:
-                    utils.log_subprocess_output(
-                        process.stderr,
-                        err=True,
-                        silence=[
-                            # Silence this false warning from msmresample
-                            "** DA[1] has coordsys with intent NIFTI_INTENT_TRIANGLE (should be NIFTI_INTENT_POINTSET)"
-                        ],
-                    )
+        return out
 
-                exit_code = process.wait()
+    def _transform_out_of_core(
+        self, source_data, parcellation, mode, dtype, out, block_size
+    ):
+        n_outputs = self.target_mesh.darrays[0].data.shape[0]
+        if parcellation is not None:
+            n_outputs = self._get_parcel_operator(parcellation).shape[0]
+        shape = (source_data.shape[0], n_outputs)
+        if dtype is None:
+            dtype = source_data.dtype
+        if block_size is None:
+            block_size = TRANSFORM_CHUNK_SIZE
 
-                if exit_code != 0:
-                    raise RuntimeError(
-                        f"Failed to run msmresample with command:\n{cmd}"
-                    )
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif isinstance(out, (str, os.PathLike)):
+            out = _create_output(source_data, out, shape, dtype, block_size)
+        elif tuple(out.shape) != shape:
+            raise ValueError(f"Expected out of shape {shape}, got {out.shape}.")
 
-                # Load predicted contrast map ndarray and append it
-                # to result list
-                predicted_contrast_map = (
-                    nib.load(f"{predicted_contrast_path}.func.gii").darrays[0].data
-                )
-                predicted_contrast_map = predicted_contrast_map.astype(
-                    source_data.dtype
-                )
-                predicted_contrast_maps.append(predicted_contrast_map)
+        stats = stream_rows(
+            lambda block: self.transform(
+                block, parcellation=parcellation, mode=mode, dtype=dtype
+            ),
+            source_data,
+            out,
+            block_size=block_size,
+        )
+        logging.getLogger("msm").info(
+            f"Transformed {stats['n_rows']} maps in {stats['time']:.1f}s: "
+            f"{stats['rows_per_second']:.1f} maps/s, "
+            f"{stats['megabytes_per_second']:.1f} MB/s read and written"
+        )
 
-        predicted_data = np.vstack(predicted_contrast_maps)
+        return out
 
-        # If source data is 1-dim, return 1-dim array
-        if one_dimensional:
-            return predicted_data.flatten()
-        else:
-            return predicted_data
+    def inverse_transform(self, target_data):
+        """
+        Map target contrast maps onto source mesh.
+
+        No additional registration is run: the fitted deformation
+        gives the position of each source vertex on the target sphere,
+        where target data is interpolated.
+        The corresponding sparse operator is computed once
+        and cached in the model.
+
+        Parameters
+        ----------
+        target_data: ndarray(n_samples, n_features)
+            Contrast maps for target subject.
+
+        Returns
+        -------
+        predicted_contrast_maps: ndarray(n_samples, n_features)
+            Contrast map transformed from target space to source space.
+            n is the number of voxels of the source mesh
+            use during the fitting phase
+        """
+        predicted_data = (self._get_inverse_operator() @ target_data.T).T
+
+        return predicted_data.astype(target_data.dtype)
 
     def score(self, source_data, target_data):
         """
@@ -260,15 +748,85 @@ class MSM(BaseEstimator, TransformerMixin):
         """
 
         transformed_data = self.transform(source_data)
-        score = np.mean(
-            [
-                pearsonr(transformed_data[i, :], target_data[i, :])[0]
-                for i in range(transformed_data.shape[0])
-            ]
-        )
+        score = float(np.mean(correlation(transformed_data, target_data)))
 
         return score
 
+    def distortion_report(self):
+        """
+        Measure distortion induced by the fitted deformation
+        on the source mesh.
+
+        All quantities are computed from the source mesh and
+        the transformed mesh only, and do not require any data.
+
+        Returns
+        -------
+        report: dict
+            areal_distortion: ndarray(n_faces,)
+                Log2 ratio of transformed to source triangle areas.
+            shape_distortion: ndarray(n_faces,)
+                Log2 ratio of the principal stretches of each triangle.
+            folded: ndarray(n_faces,)
+                Whether each triangle is flipped by the deformation.
+            log_jacobian: ndarray(n_vertices,)
+                Natural log ratio of transformed to source areas
+                of triangles surrounding each vertex.
+            summary: dict
+                Summary statistics of the above quantities.
+        """
+        from scipy import sparse
+
+        source_geometry = get_geometry(self.source_mesh, persist=True)
+        faces = source_geometry.faces
+        jacobians, shape_distortion = deformation_distortion(
+            source_geometry.vertices,
+            self.transformed_mesh.darrays[0].data,
+            faces,
+        )
+
+        folded = jacobians <= 0
+        areal_distortion = np.log2(np.abs(jacobians))
+
+        # Sum areas of triangles surrounding each vertex
+        incidence = sparse.csr_matrix(
+            (
+                np.ones(faces.size),
+                (faces.ravel(), np.repeat(np.arange(faces.shape[0]), 3)),
+            ),
+            shape=(source_geometry.n_vertices, faces.shape[0]),
+        )
+        source_areas = incidence @ source_geometry.face_areas
+        transformed_areas = incidence @ (
+            source_geometry.face_areas * np.abs(jacobians)
+        )
+        log_jacobian = np.log(transformed_areas / source_areas)
+
+        summary = {
+            "n_folded": int(folded.sum()),
+            "folded_fraction": float(folded.mean()),
+        }
+        for name, values in [
+            ("areal_distortion", areal_distortion),
+            ("shape_distortion", shape_distortion),
+            ("log_jacobian", log_jacobian),
+        ]:
+            summary[name] = {
+                "mean": float(np.mean(values)),
+                "std": float(np.std(values)),
+                "min": float(np.min(values)),
+                "max": float(np.max(values)),
+                "p95_abs": float(np.percentile(np.abs(values), 95)),
+            }
+
+        return {
+            "areal_distortion": areal_distortion,
+            "shape_distortion": shape_distortion,
+            "folded": folded,
+            "log_jacobian": log_jacobian,
+            "summary": summary,
+        }
+
     def load_model(self, model_path, source_mesh, target_mesh=None):
         """
         Load fitted model from file
@@ -290,6 +848,7 @@ class MSM(BaseEstimator, TransformerMixin):
             Loaded fitted alignment
         """
         self.transformed_mesh = nib.load(model_path)
+        self._reset_operators()
         self.source_mesh = utils.gifti_from_file(source_mesh)
         if target_mesh is None:
             self.target_mesh = utils.gifti_from_file(source_mesh)
@@ -297,3 +856,325 @@ class MSM(BaseEstimator, TransformerMixin):
             self.target_mesh = utils.gifti_from_file(target_mesh)
 
         return self
+
+
+class ComposedMSM(MSM):
+    def __init__(self, first=None, second=None, invert_second=False):
+        """
+        Initialize composition of two fitted MSM objects.
+
+        Parameters
+        ----------
+        first: MSM
+            Fitted alignment from source to an intermediate space
+            (typically a template).
+        second: MSM
+            Fitted alignment from the intermediate space to target.
+            If invert_second is True, second should rather be
+            a fitted alignment from target to the intermediate space,
+            which will be used in the reverse direction.
+        invert_second: bool
+            Whether second should be inverted before composition.
+            This allows to align N subjects with only N fits
+            onto a common template.
+        """
+
+        self.first = first
+        self.second = second
+        self.invert_second = invert_second
+
+    def fit(self, source_data=None, target_data=None, **kwargs):
+        """
+        Compose fitted alignments into a single source to target alignment.
+
+        No registration is run: source vertices are mapped
+        through both deformations, and source_data and target_data
+        are only accepted for API compatibility.
+
+        Returns
+        -------
+        self: object
+            Composed alignment
+        """
+        if self.invert_second:
+            # Positions of target vertices in the intermediate space
+            # are known, so target sphere coordinates are interpolated
+            # at positions of source vertices in the intermediate space
+            sphere_in = self.second.transformed_mesh
+            coordinates = self.second.source_mesh.darrays[0].data
+            target_mesh = self.second.source_mesh
+        else:
+            sphere_in = self.second.source_mesh
+            coordinates = self.second.transformed_mesh.darrays[0].data
+            target_mesh = self.second.target_mesh
+
+        with TemporaryDirectory() as tmp_dir:
+            sphere_in_path = str(Path(tmp_dir) / "sphere_in.surf.gii")
+            sphere_in.to_filename(sphere_in_path)
+
+            intermediate_mesh_path = str(Path(tmp_dir) / "intermediate.surf.gii")
+            self.first.transformed_mesh.to_filename(intermediate_mesh_path)
+
+            # Write each coordinate as a separate map living on sphere_in
+            coordinates_image = nib.gifti.gifti.GiftiImage()
+            for coordinate in coordinates.T:
+                coordinates_image.add_gifti_data_array(
+                    nib.gifti.gifti.GiftiDataArray(
+                        data=coordinate,
+                        datatype=nib.nifti1.data_type_codes.code[
+                            "NIFTI_TYPE_FLOAT32"
+                        ],
+                        intent=nib.nifti1.intent_codes.code[
+                            "NIFTI_INTENT_POINTSET"
+                        ],
+                        coordsys=sphere_in.darrays[0].coordsys,
+                    )
+                )
+            coordinates_path = str(Path(tmp_dir) / "coordinates.func.gii")
+            coordinates_image.to_filename(coordinates_path)
+
+            resampled = run_msmresample(
+                sphere_in_path, coordinates_path, intermediate_mesh_path
+            )
+
+        composed_coordinates = np.column_stack([d.data for d in resampled.darrays])
+
+        # Interpolated coordinates lie slightly inside the sphere,
+        # hence they are projected back onto it
+        radius = get_geometry(target_mesh, persist=True).radius
+        composed_coordinates *= radius / np.linalg.norm(
+            composed_coordinates, axis=1, keepdims=True
+        )
+
+        transformed_mesh = copy.deepcopy(self.first.transformed_mesh)
+        transformed_mesh.darrays[0].data = composed_coordinates.astype(np.float32)
+
+        self.source_mesh = self.first.source_mesh
+        self.target_mesh = target_mesh
+        self.transformed_mesh = transformed_mesh
+        self._reset_operators()
+
+        return self
+
+
+class BilateralMSM(utils.TransformerMixin, utils.Estimator):
+    def __init__(self, epsilon=0.1, n_jobs=2, memory_budget=None):
+        """
+        Initialize MSM object aligning both hemispheres at once.
+
+        Data of both hemispheres is concatenated along features,
+        with left hemisphere vertices first.
+
+        Parameters
+        ----------
+        epsilon: scalar,
+            Regularization parameter used in MSM
+            for both hemispheres.
+        n_jobs: int
+            Number of hemispheres processed at once.
+            Registrations, as well as transforms using msmresample,
+            are run by a scheduler.Scheduler, such that both hemispheres
+            are processed concurrently if memory allows it.
+        memory_budget: int or None
+            Memory which can be used at once, in bytes.
+            See scheduler.Scheduler for default value.
+        """
+
+        self.epsilon = epsilon
+        self.n_jobs = n_jobs
+        self.memory_budget = memory_budget
+
+    def _map(self, fn, *args, **job_kwargs):
+        # Run fn on each hemisphere in scheduler jobs
+        with Scheduler(
+            max_cpus=self.n_jobs, memory_budget=self.memory_budget
+        ) as scheduler:
+            futures = [
+                scheduler.submit(fn, *hemisphere_args, **job_kwargs)
+                for hemisphere_args in zip(*args)
+            ]
+            return [future.result() for future in futures]
+
+    @staticmethod
+    def _split(data, n_vertices):
+        # Views of data of each hemisphere, without copy
+        return [data[..., : n_vertices[0]], data[..., n_vertices[0] :]]
+
+    def _concatenate(self, hemisphere_data, n_vertices, dtype):
+        # Write data of each hemisphere into a single output array
+        data = np.empty((*hemisphere_data[0].shape[:-1], sum(n_vertices)), dtype=dtype)
+        for view, values in zip(self._split(data, n_vertices), hemisphere_data):
+            view[...] = values
+
+        return data
+
+    def fit(
+        self,
+        source_data,
+        target_data,
+        source_mesh=None,
+        target_mesh=None,
+        **kwargs,
+    ):
+        """
+        Fit MSM alignment of both hemispheres.
+
+        Parameters
+        ----------
+        source_data: ndarray(n_samples, n_lh_features + n_rh_features)
+            Contrast maps for source subject.
+        target_data: ndarray(n_samples, n_lh_features + n_rh_features)
+            Contrast maps for target subject.
+        source_mesh, target_mesh: tuple of str
+            Path to left and right hemisphere meshes
+            used for source and target.
+            Note that if target_mesh is not specified,
+            the source_mesh will be used for all input data.
+        **kwargs:
+            Additional arguments passed to MSM.fit.
+            If work_dir is specified, each hemisphere uses
+            a subdirectory of it.
+
+        Returns
+        -------
+        self: object
+            Fitted alignment
+        """
+        if target_mesh is None:
+            target_mesh = source_mesh
+
+        self.source_n_vertices = [
+            utils.gifti_from_file(mesh).darrays[0].data.shape[0] for mesh in source_mesh
+        ]
+        self.target_n_vertices = [
+            utils.gifti_from_file(mesh).darrays[0].data.shape[0] for mesh in target_mesh
+        ]
+
+        hemisphere_kwargs = []
+        for hemisphere in ["lh", "rh"]:
+            hemisphere_kwargs.append(dict(kwargs))
+            if kwargs.get("work_dir") is not None:
+                hemisphere_kwargs[-1]["work_dir"] = os.path.join(
+                    kwargs["work_dir"], hemisphere
+                )
+
+        n_samples, n_vertices = len(source_data), max(self.source_n_vertices)
+        self.models = self._map(
+            _fit_hemisphere,
+            [self.epsilon] * 2,
+            self._split(source_data, self.source_n_vertices),
+            self._split(target_data, self.target_n_vertices),
+            source_mesh,
+            target_mesh,
+            hemisphere_kwargs,
+            memory=estimate_msm_memory(n_vertices, n_samples),
+            signature=msm_signature(n_vertices, n_samples),
+        )
+
+        return self
+
+    def transform(self, source_data, parcellation=None, dtype=None, out=None, **kwargs):
+        """
+        Map source contrast maps of both hemispheres onto target meshes.
+
+        Parameters
+        ----------
+        source_data: ndarray(n_samples, n_lh_features + n_rh_features)
+            Contrast maps for source subject.
+        parcellation: ndarray(n_lh + n_rh,) or None
+            Parcel label of each vertex of both target meshes.
+            If specified, transformed maps of each hemisphere are averaged
+            within parcels of this hemisphere (see MSM.transform).
+        dtype: numpy dtype or None
+            Type of transformed maps. Defaults to the type of source_data.
+        out: ndarray(n_samples, n_lh + n_rh) or None
+            Array in which transformed maps are written.
+            Each hemisphere is written directly in a view of it.
+        **kwargs:
+            Additional arguments passed to MSM.transform, such as mode.
+
+        Returns
+        -------
+        predicted_contrast_maps: ndarray(n_samples, n_lh + n_rh)
+            Contrast maps transformed from source space to target space.
+            If parcellation is specified, it is rather
+            ndarray(n_samples, n_lh_parcels + n_rh_parcels), with parcels
+            of each hemisphere ordered as np.unique of its labels.
+        """
+        source_data = np.asarray(source_data)
+
+        n_outputs = self.target_n_vertices
+        hemisphere_kwargs = [dict(kwargs), dict(kwargs)]
+        if parcellation is not None:
+            hemisphere_parcellations = self._split(
+                np.asarray(parcellation), self.target_n_vertices
+            )
+            n_outputs = [np.unique(p).shape[0] for p in hemisphere_parcellations]
+            for kw, hemisphere_parcellation in zip(
+                hemisphere_kwargs, hemisphere_parcellations
+            ):
+                kw["parcellation"] = hemisphere_parcellation
+
+        if out is None:
+            out = np.empty(
+                (*source_data.shape[:-1], sum(n_outputs)),
+                dtype=source_data.dtype if dtype is None else dtype,
+            )
+
+        hemisphere_data = self._split(source_data, self.source_n_vertices)
+        views = self._split(out, n_outputs)
+        if kwargs.get("mode", "adaptive") == "adaptive" and parcellation is None:
+            # msmresample runs in subprocesses, so hemispheres
+            # are resampled concurrently in scheduler jobs
+            for view, values in zip(
+                views,
+                self._map(
+                    _transform_hemisphere,
+                    self.models,
+                    hemisphere_data,
+                    hemisphere_kwargs,
+                ),
+            ):
+                view[...] = values
+        else:
+            # Native resampling is fast, and writes in views directly
+            for model, data, view, kw in zip(
+                self.models, hemisphere_data, views, hemisphere_kwargs
+            ):
+                model.transform(data, out=view, **kw)
+
+        return out
+
+    def inverse_transform(self, target_data):
+        """
+        Map target contrast maps of both hemispheres onto source meshes.
+
+        Parameters
+        ----------
+        target_data: ndarray(n_samples, n_lh + n_rh)
+            Contrast maps for target subject.
+
+        Returns
+        -------
+        predicted_contrast_maps: ndarray(n_samples, n_lh + n_rh)
+            Contrast maps transformed from target space to source space.
+        """
+        predicted_data = [
+            model.inverse_transform(data)
+            for model, data in zip(
+                self.models, self._split(target_data, self.target_n_vertices)
+            )
+        ]
+
+        return self._concatenate(
+            predicted_data, self.source_n_vertices, target_data.dtype
+        )
+
+    def score(self, source_data, target_data):
+        """
+        Mean Pearson correlation between transformed source contrast maps
+        and actual target contrast maps, over both hemispheres.
+        """
+        transformed_data = self.transform(source_data)
+
+        return float(np.mean(correlation(transformed_data, target_data)))
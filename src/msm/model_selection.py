@@ -0,0 +1,159 @@
+import numpy as np
+import os
+from sklearn.base import clone
+from sklearn.model_selection import check_cv
+from tempfile import TemporaryDirectory
+import time
+
+from msm.evaluate import correlation
+from msm.scheduler import Scheduler, estimate_msm_memory, msm_signature
+from msm import utils
+
+
+def _fit_and_score(
+    estimator,
+    source_path,
+    target_path,
+    train,
+    test,
+    source_mesh,
+    target_mesh,
+    fit_params,
+    return_estimator,
+):
+    # Contrast maps are memory-mapped, so that workers
+    # only read rows of their fold
+    source_data = np.load(source_path, mmap_mode="r")
+    target_data = np.load(target_path, mmap_mode="r")
+
+    start = time.time()
+    estimator = clone(estimator).fit(
+        np.asarray(source_data[train]),
+        np.asarray(target_data[train]),
+        source_mesh=source_mesh,
+        target_mesh=target_mesh,
+        **fit_params,
+    )
+    fit_time = time.time() - start
+
+    start = time.time()
+    transformed_data = estimator.transform(np.asarray(source_data[test]))
+    scores = correlation(transformed_data, target_data[test])
+    score_time = time.time() - start
+
+    result = {
+        "test_score": float(np.mean(scores)),
+        "fit_time": fit_time,
+        "score_time": score_time,
+    }
+    if return_estimator:
+        result["estimator"] = estimator
+
+    return result
+
+
+def cross_validate(
+    estimator,
+    source_data,
+    target_data,
+    source_mesh,
+    target_mesh=None,
+    cv=5,
+    n_jobs=1,
+    memory_budget=None,
+    return_estimator=False,
+    **fit_params,
+):
+    """
+    Evaluate an alignment by cross-validation over contrasts.
+
+    Each fold fits a clone of estimator on train contrast maps,
+    and scores it with the mean Pearson correlation between
+    transformed and actual target test maps.
+    Folds are fitted concurrently by a scheduler.Scheduler.
+    Preparation shared by all folds is done once: contrast maps
+    are written to a single memory-mapped file read by all workers,
+    and compressed meshes are decompressed once.
+
+    Parameters
+    ----------
+    estimator: MSM
+        Alignment to evaluate. It is not fitted itself.
+    source_data, target_data: ndarray(n_samples, n_features)
+        Contrast maps for source and target subjects.
+    source_mesh, target_mesh: str
+        Path to mesh used for source and target.
+        Note that if target_mesh is not specified,
+        the source_mesh will be used for all input data.
+    cv: int, cross-validation generator or iterable
+        Splitting of contrast maps into train and test sets,
+        as accepted by sklearn.model_selection.check_cv.
+        An int gives the number of folds of a KFold.
+    n_jobs: int
+        Number of folds fitted at once.
+    memory_budget: int or None
+        Memory which can be used at once, in bytes.
+        See scheduler.Scheduler for default value.
+    return_estimator: bool
+        Whether fitted estimators of each fold should be returned.
+    **fit_params:
+        Additional arguments passed to fit,
+        such as iterations or timeout.
+
+    Returns
+    -------
+    results: dict
+        test_score: ndarray(n_folds,)
+            Mean correlation over test maps of each fold.
+        fit_time, score_time: ndarray(n_folds,)
+            Time spent fitting and scoring each fold, in seconds.
+        estimator: list of MSM
+            Fitted estimator of each fold, if return_estimator is True.
+    """
+    if target_mesh is None:
+        target_mesh = source_mesh
+    splits = list(check_cv(cv).split(source_data))
+
+    with TemporaryDirectory() as tmp_dir:
+        meshes = []
+        for mesh in [source_mesh, target_mesh]:
+            if mesh.endswith(".gz"):
+                mesh_path = os.path.join(tmp_dir, os.path.basename(mesh[:-3]))
+                if not os.path.exists(mesh_path):
+                    utils.ungzip(mesh, mesh_path)
+                mesh = mesh_path
+            meshes.append(mesh)
+
+        source_path = os.path.join(tmp_dir, "source.npy")
+        np.save(source_path, np.asarray(source_data, dtype=np.float32))
+        target_path = os.path.join(tmp_dir, "target.npy")
+        np.save(target_path, np.asarray(target_data, dtype=np.float32))
+
+        n_vertices = utils.gifti_from_file(meshes[0]).darrays[0].data.shape[0]
+        with Scheduler(max_cpus=n_jobs, memory_budget=memory_budget) as scheduler:
+            futures = [
+                scheduler.submit(
+                    _fit_and_score,
+                    estimator,
+                    source_path,
+                    target_path,
+                    train,
+                    test,
+                    *meshes,
+                    fit_params,
+                    return_estimator,
+                    memory=estimate_msm_memory(n_vertices, len(train)),
+                    signature=msm_signature(n_vertices, len(train)),
+                )
+                for train, test in splits
+            ]
+            fold_results = [future.result() for future in futures]
+
+    results = {
+        key: np.array([result[key] for result in fold_results])
+        for key in ["test_score", "fit_time", "score_time"]
+    }
+    if return_estimator:
+        results["estimator"] = [result["estimator"] for result in fold_results]
+
+    return results
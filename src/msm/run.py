@@ -1,22 +1,166 @@
+import copy
+import json
 import logging
 import nibabel as nib
 import numpy as np
 import os
-import pandas as pd
 from pathlib import Path
 import shlex
 import subprocess
 from tempfile import TemporaryDirectory
+import time
+
+from msm import smoothing, utils
+
+# Flags of msm for each output profile
+OUTPUT_PROFILES = {
+    # Only the registered sphere is used
+    "minimal": [],
+    "standard": ["--verbose"],
+    # Intermediate files are written in the working directory
+    "debug": ["--verbose", "--debug"],
+}
+
+
+class MSMConfig(utils.Estimator):
+    def __init__(
+        self,
+        epsilon=None,
+        iterations=None,
+        sigma_in=(6, 6, 4, 2),
+        sigma_ref=(6, 6, 4, 2),
+        opt=("AFFINE", "DISCRETE", "DISCRETE", "DISCRETE"),
+        cpgrid=(0, 2, 3, 4),
+        sggrid=(0, 4, 5, 6),
+        datagrid=(5, 5, 5, 6),
+        levels=1,
+        profile="debug",
+        presmooth=False,
+    ):
+        """
+        Initialize msm configuration.
+
+        Default values are taken from
+        https://github.com/ecr05/MSM_HOCR/blob/master/config/basic_configs/config_standard_MSMpair
+        (see also https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/MSM/UserGuide)
+
+        Parameters
+        ----------
+        epsilon: float or None
+            Regularization parameter, used at all resolution levels.
+            If None, defaults to 0,0.1,0.2,0.3
+        iterations: int or str or None
+            Number of iterations
+            examples: 5 or "5,2,3,4"
+            If None, defaults to 50,5,10,10
+        sigma_in, sigma_ref: tuple of float
+            Smoothing of input and reference data at each resolution level.
+        opt: tuple of str
+            Optimisation method at each resolution level.
+        cpgrid, sggrid, datagrid: tuple of int
+            Icosphere levels of control point, sampling
+            and data grids at each resolution level.
+        levels: int or None
+            Number of resolution levels run by msm (--levels).
+            If None, all levels of the config are run.
+        profile: "minimal", "standard" or "debug"
+            Amount of logs and files outputed by msm.
+            "minimal" only requests the registered sphere,
+            "standard" adds verbose logs, and
+            "debug" adds intermediate files.
+        presmooth: bool
+            Whether contrast maps should be smoothed before being passed
+            to msm. Maps are smoothed once with the smallest sigma of
+            each subject among levels which are run (see
+            smoothing.smooth_cached, which caches them across runs),
+            and msm only applies the remaining smoothing, that is
+            sqrt(sigma**2 - min(sigma)**2) at each level.
+            msm then skips smoothing at the finest level run, which only
+            saves work in multi-level runs: with a single level,
+            smoothing is merely moved out of msm, and cached.
+        """
+
+        self.epsilon = epsilon
+        self.iterations = iterations
+        self.sigma_in = sigma_in
+        self.sigma_ref = sigma_ref
+        self.opt = opt
+        self.cpgrid = cpgrid
+        self.sggrid = sggrid
+        self.datagrid = datagrid
+        self.levels = levels
+        self.profile = profile
+        self.presmooth = presmooth
+
+    def presmoothing(self):
+        """Sigma used to smooth input and reference maps before msm."""
+
+        if not self.presmooth:
+            return 0, 0
+
+        # Only levels run by msm are taken into account
+        levels = len(self.sigma_in) if self.levels is None else self.levels
+
+        return min(self.sigma_in[:levels]), min(self.sigma_ref[:levels])
+
+    def to_string(self):
+        """Content of the config file passed to msm with --conf."""
+
+        def join(values):
+            return ",".join(str(v) for v in values)
+
+        def residual(sigmas, presmoothing):
+            # Smoothing twice with Gaussian kernels of width a and b
+            # is equivalent to smoothing once with width sqrt(a**2 + b**2)
+            return [
+                round(float(np.sqrt(max(s**2 - presmoothing**2, 0))), 4)
+                if presmoothing > 0
+                else s
+                for s in sigmas
+            ]
 
-from msm import utils
+        sigma_in_presmoothing, sigma_ref_presmoothing = self.presmoothing()
+        sigma_in = residual(self.sigma_in, sigma_in_presmoothing)
+        sigma_ref = residual(self.sigma_ref, sigma_ref_presmoothing)
 
+        lambda_line = "--lambda=0,0.1,0.2,0.3"
+        if self.epsilon is not None:
+            lambda_line = f"--lambda={join([self.epsilon] * 4)}"
 
-def is_same_coordsys(c1, c2):
-    return (
-        c1.dataspace == c2.dataspace
-        and c1.xformspace == c2.xformspace
-        and np.all(c1.xform == c2.xform)
-    )
+        iteration_line = "--it=50,5,10,10"
+        if self.iterations is not None:
+            if isinstance(self.iterations, int):
+                iteration_line = f"--it={join([self.iterations] * 4)}"
+            elif isinstance(self.iterations, str):
+                iteration_line = f"--it={self.iterations}"
+
+        return "\n".join(
+            [
+                f"--sigma_in={join(sigma_in)}",
+                f"--sigma_ref={join(sigma_ref)}",
+                lambda_line,
+                iteration_line,
+                f"--opt={join(self.opt)}",
+                f"--CPgrid={join(self.cpgrid)}",
+                f"--SGgrid={join(self.sggrid)}",
+                f"--datagrid={join(self.datagrid)}",
+            ]
+        )
+
+    def flags(self):
+        """Command line flags of msm controlling its outputs."""
+
+        if self.profile not in OUTPUT_PROFILES:
+            raise ValueError(
+                f"Unknown profile {self.profile}, "
+                f"should be one of {list(OUTPUT_PROFILES)}"
+            )
+
+        flags = list(OUTPUT_PROFILES[self.profile])
+        if self.levels is not None:
+            flags.append(f"--levels={self.levels}")
+
+        return flags
 
 
 def prepare_darrays(darrays, coordsys):
@@ -24,13 +168,61 @@ def prepare_darrays(darrays, coordsys):
         d.data = d.data.astype(np.float32)
         d.datatype = nib.nifti1.data_type_codes.code["NIFTI_TYPE_FLOAT32"]
         d.intent = nib.nifti1.intent_codes.code["NIFTI_INTENT_POINTSET"]
-        if d.coordsys is not None and not is_same_coordsys(d.coordsys, coordsys):
+        if d.coordsys is not None and not utils.is_same_coordsys(
+            d.coordsys, coordsys
+        ):
             raise ValueError("Provided data is in different coordsys than the mesh.")
         d.coordsys = coordsys
 
     return darrays
 
 
+def run_with_retries(
+    cmd, description, timeout=None, retries=0, backoff=10, log_stdout=True
+):
+    """Run command, retrying with exponential backoff if it fails.
+
+    Parameters
+    ----------
+    cmd: list of str
+        Command to run.
+    description: str
+        Description of the command used in error messages.
+    timeout: float or None
+        Time after which each attempt is killed, in seconds.
+    retries: int
+        Number of attempts after the first one fails.
+    backoff: float
+        Delay before the first retry, in seconds.
+        It is doubled after each failed attempt.
+    log_stdout: bool
+        Whether standard output of the command should be logged.
+    """
+    logger = logging.getLogger("msm")
+
+    for attempt in range(retries + 1):
+        try:
+            exit_code = utils.run_command(
+                cmd, timeout=timeout, log_stdout=log_stdout
+            )
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Timed out after {timeout}s, command:\n{cmd}")
+            exit_code = None
+
+        if exit_code == 0:
+            return
+
+        if attempt < retries:
+            delay = backoff * 2**attempt
+            logger.warning(
+                f"Failed to {description} (attempt {attempt + 1}/{retries + 1}), "
+                f"retrying in {delay}s"
+            )
+            time.sleep(delay)
+
+    raise RuntimeError(f"Failed to {description} with command:\n{cmd}")
+
+
 def run_msm(
     source_contrasts_list,
     source_mesh,
@@ -38,6 +230,11 @@ def run_msm(
     target_mesh=None,
     epsilon=None,
     iterations=None,
+    timeout=None,
+    retries=0,
+    backoff=10,
+    work_dir=None,
+    config=None,
     **kwargs,
 ):
     """Run MSM on a list of contrast between in data and ref data
@@ -58,87 +255,93 @@ def run_msm(
     iterations: int or str or None
         Number of iterations
         examples: 5 or "5,2,3,4"
+    timeout: float or None
+        Time after which msm is killed, in seconds.
+    retries: int
+        Number of times msm is run again if it fails or times out.
+    backoff: float
+        Delay before the first retry, in seconds.
+        It is doubled after each failed attempt.
+    work_dir: str or None
+        Directory in which inputs and outputs of msm are written.
+        If None, a temporary directory is used and deleted afterwards.
+        Otherwise, the directory is kept, and a later run with the same
+        work_dir reuses inputs already written in it, as well as
+        msm outputs, if input files and hyperparameters did not change.
+        Hashes of input contrast maps and meshes are recorded
+        in work_dir/manifest.json to check this, and files are written
+        atomically, so that files of an interrupted run are never reused.
+    config: MSMConfig or None
+        Hyperparameters and outputs of msm.
+        If None, default MSMConfig is used.
+        epsilon, iterations, and any parameter of MSMConfig
+        passed as keyword argument (such as profile or levels)
+        override values of config.
 
     Returns
     -------
     mesh_gii : nibabel.gifti.GiftiImage
         Image holding the transformed mesh.
-    transformed_gii : nibabel.gifti.GiftiImage
+    transformed_gii : nibabel.gifti.GiftiImage or None
         Image holding the transformed data in the target_mesh.
+        It is None in minimal profile.
     """
+    config = MSMConfig() if config is None else copy.copy(config)
+    config_params = config.get_params()
+    config.set_params(
+        **{key: value for key, value in kwargs.items() if key in config_params}
+    )
+    if epsilon is not None:
+        config.set_params(epsilon=epsilon)
+    if iterations is not None:
+        config.set_params(iterations=iterations)
+
     FSLDIR, FSL_CONFIG_PATH = utils.check_fsl()
+    toolchain = utils.fsl_toolchain()
     logger = logging.getLogger("msm")
-    logger.info(f"FSLDIR: {FSLDIR}")
+    logger.info(f"FSLDIR: {FSLDIR} (version {toolchain.version})")
     logger.info(f"FSL_CONFIG_PATH: {FSL_CONFIG_PATH}")
 
     if target_mesh is None:
         target_mesh = source_mesh
 
+    sigma_in_presmoothing, sigma_ref_presmoothing = config.presmoothing()
     contrasts_to_load = {
         # Source subject data
-        "source_subject": (source_contrasts_list, source_mesh),
+        "source_subject": (
+            source_contrasts_list,
+            source_mesh,
+            sigma_in_presmoothing,
+        ),
         # Target subject data
-        "target_subject": (target_contrasts_list, target_mesh),
+        "target_subject": (
+            target_contrasts_list,
+            target_mesh,
+            sigma_ref_presmoothing,
+        ),
     }
 
     contrasts_gifti_file = {}
 
-    with TemporaryDirectory() as tmp_dir:
-        # Write temporary MSM config file, used to specify hyperparams
-        # Default config is taken from
-        # https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/MSM/UserGuide
-        config_path = os.path.join(tmp_dir, "msm_config")
+    with utils.working_directory(work_dir) as tmp_dir:
+        # Files of a previous run in the same working directory are only
+        # reused if the hash of what they were computed from,
+        # recorded in its manifest, did not change
+        manifest_path = os.path.join(tmp_dir, "manifest.json")
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
 
-        # lambda_line = "--lambda=0,0.2,0.2,0.2"
-        lambda_line = "--lambda=0,0.1,0.2,0.3"
-        if epsilon is not None:
-            lambda_line = f"--lambda={epsilon},{epsilon},{epsilon},{epsilon}"
+        def write_manifest():
+            with utils.atomic_path(manifest_path) as path, open(path, "w") as f:
+                json.dump(manifest, f)
 
-        # iteration_line = "--it=50,20,25,25"
-        iteration_line = "--it=50,5,10,10"
-        if iterations is not None:
-            if isinstance(iterations, int):
-                it = str(iterations)
-                iteration_line = f"--it={it},{it},{it},{it}"
-            elif isinstance(iterations, str):
-                iteration_line = f"--it={iterations}"
-
-        lines = "\n".join(
-            # https://github.com/ecr05/MSM_HOCR/blob/master/config/basic_configs/config_standard_MSM_strain
-            # [
-            #     "--simval=3,2,2,2",
-            #     "--sigma_in=0,0,0,0",
-            #     "--sigma_ref=0,0,0,0",
-            #     # "--lambda=0,0.2,0.2,0.2",
-            #     lambda_line,
-            #     # "--it=50,5,10,10",
-            #     iteration_line,
-            #     "--opt=AFFINE,DISCRETE,DISCRETE,DISCRETE",
-            #     "--CPgrid=6,2,3,4",
-            #     "--SGgrid=6,4,5,6",
-            #     "--datagrid=6,4,5,6",
-            #     # "--regoption=1", # use the 2014 or 2018 version
-            #     "--regexp=2",
-            #     "--VN",
-            #     "--rescaleL",
-            # ]
-            # https://github.com/ecr05/MSM_HOCR/blob/master/config/basic_configs/config_standard_MSMpair
-            [
-                "--sigma_in=6,6,4,2",
-                "--sigma_ref=6,6,4,2",
-                # "--lambda=0,0.1,0.2,0.3",
-                lambda_line,
-                # "--it=50,5,10,10"
-                iteration_line,
-                "--opt=AFFINE,DISCRETE,DISCRETE,DISCRETE",
-                "--CPgrid=0,2,3,4",
-                "--SGgrid=0,4,5,6",
-                "--datagrid=5,5,5,6",
-                # "--regoption=1",
-            ]
-        )
-
-        with open(config_path, "w") as f:
+        # Write temporary MSM config file, used to specify hyperparams
+        config_path = os.path.join(tmp_dir, "msm_config")
+        lines = config.to_string()
+        flags = " ".join(config.flags())
+        with utils.atomic_path(config_path) as path, open(path, "w") as f:
             f.write(lines)
 
         # For source and target subjects (denoted as in and ref subjects
@@ -146,7 +349,25 @@ def run_msm(
         # contrast maps (denoted as "data" in msm).
         # These maps will previously be set to use the same
         # coordinate system as the subject mesh
-        for subject, (contrast_paths, mesh_path) in contrasts_to_load.items():
+        input_hashes = {}
+        for subject, (
+            contrast_paths,
+            mesh_path,
+            presmoothing,
+        ) in contrasts_to_load.items():
+            suffix = f".smooth{presmoothing}" if presmoothing > 0 else ""
+            filename = str(Path(tmp_dir) / f"{subject}{suffix}.func.gii")
+            contrasts_gifti_file[subject] = filename
+            input_hashes[subject] = utils.files_hash(
+                [mesh_path, *contrast_paths], presmoothing
+            )
+            if (
+                os.path.exists(filename)
+                and manifest.get(os.path.basename(filename)) == input_hashes[subject]
+            ):
+                # Reuse data written by a previous run
+                continue
+
             # Load the coordsys from the mesh associated to the data
             # in order to make sure it is well specified
             mesh = utils.gifti_from_file(mesh_path)
@@ -163,27 +384,45 @@ def run_msm(
                     prepare_darrays(extra_data.darrays, mesh_coordsys)
                 )
 
+            if presmoothing > 0:
+                smoothed_maps = smoothing.smooth_cached(
+                    np.stack([d.data for d in contrast_maps.darrays]),
+                    mesh,
+                    presmoothing,
+                )
+                for d, smoothed_map in zip(contrast_maps.darrays, smoothed_maps):
+                    d.data = smoothed_map
+
             # Save contrast map
-            filename = str(Path(tmp_dir) / f"{subject}.func.gii")
-            contrast_maps.to_filename(filename)
-            contrasts_gifti_file[subject] = filename
+            with utils.atomic_path(filename) as path:
+                contrast_maps.to_filename(path)
+            manifest[os.path.basename(filename)] = input_hashes[subject]
+            write_manifest()
 
         # If input meshes are compressed, decompress them
         # in temporary files and update mesh path
-        if source_mesh.endswith(".gz"):
-            tmp_source_mesh = os.path.join(tmp_dir, os.path.basename(source_mesh[:-3]))
-            utils.ungzip(source_mesh, tmp_source_mesh)
-            source_mesh = tmp_source_mesh
-        if target_mesh.endswith(".gz"):
-            tmp_target_mesh = os.path.join(tmp_dir, os.path.basename(target_mesh[:-3]))
-            utils.ungzip(target_mesh, tmp_target_mesh)
-            target_mesh = tmp_target_mesh
+        meshes = {"source_mesh": source_mesh, "target_mesh": target_mesh}
+        for key, mesh_path in meshes.items():
+            if not mesh_path.endswith(".gz"):
+                continue
+            tmp_mesh_path = os.path.join(tmp_dir, os.path.basename(mesh_path[:-3]))
+            mesh_hash = utils.files_hash([mesh_path])
+            if not (
+                os.path.exists(tmp_mesh_path)
+                and manifest.get(os.path.basename(tmp_mesh_path)) == mesh_hash
+            ):
+                with utils.atomic_path(tmp_mesh_path) as path:
+                    utils.ungzip(mesh_path, path)
+                manifest[os.path.basename(tmp_mesh_path)] = mesh_hash
+                write_manifest()
+            meshes[key] = tmp_mesh_path
+        source_mesh, target_mesh = meshes["source_mesh"], meshes["target_mesh"]
 
         # Run MSM
         cmd = shlex.split(
             " ".join(
                 [
-                    os.path.join(FSLDIR, "bin/msm"),
+                    utils.fsl_tool("msm"),
                     f"--inmesh={source_mesh}",
                     f"--refmesh={target_mesh}",
                     f"--indata={contrasts_gifti_file['source_subject']}",
@@ -191,32 +430,45 @@ def run_msm(
                     f"--conf={config_path}",
                     f"-o {tmp_dir}/",
                     "-f ASCII",
-                    "--verbose",
-                    "--debug --levels=1",
+                    flags,
                 ]
             )
         )
 
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        with process.stdout:
-            utils.log_subprocess_output(process.stdout)
-        with process.stderr:
-            utils.log_subprocess_output(process.stderr, err=True)
-
-        exit_code = process.wait()
-
-        if exit_code != 0:
-            raise RuntimeError(f"Failed to run msm with command:\n{cmd}")
-
         mesh_ascii_path = Path(tmp_dir) / "sphere.reg.asc"
         mesh_gii_path = Path(tmp_dir) / "transformed_in_mesh.surf.gii"
 
+        # Outputs of msm can only be reused if it completed
+        # with the same inputs and config
+        msm_hash = utils.files_hash(
+            [],
+            input_hashes["source_subject"],
+            input_hashes["target_subject"],
+            lines,
+            flags,
+        )
+        if manifest.get("msm") == msm_hash and mesh_ascii_path.exists():
+            logger.info(f"Reusing msm outputs from {tmp_dir}")
+        else:
+            # Outputs of an interrupted run should not be reused
+            manifest.pop("msm", None)
+            write_manifest()
+            run_with_retries(
+                cmd,
+                "run msm",
+                timeout=timeout,
+                retries=retries,
+                backoff=backoff,
+                log_stdout=config.profile != "minimal",
+            )
+            manifest["msm"] = msm_hash
+            write_manifest()
+
         # Convert ascii output to gitfi data
         cmd = shlex.split(
             " ".join(
                 [
-                    os.path.join(FSLDIR, "bin/surf2surf"),
+                    utils.fsl_tool("surf2surf"),
                     f"-i {mesh_ascii_path}",
                     f"-o {mesh_gii_path}",
                     "--outputtype=GIFTI_BIN_GZ",
@@ -224,22 +476,19 @@ def run_msm(
             )
         )
 
-        process = subprocess.Popen(
+        run_with_retries(
             cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            "convert ASCII output to GIFTI",
+            timeout=timeout,
+            retries=retries,
+            backoff=backoff,
         )
 
-        with process.stdout:
-            utils.log_subprocess_output(process.stdout)
-        with process.stderr:
-            utils.log_subprocess_output(process.stderr, err=True)
+        mesh_gii = nib.load(mesh_gii_path)
 
-        exit_code = process.wait()
-        if exit_code != 0:
-            raise RuntimeError(
-                f"Failed to convert ASCII output to GIFTI with command:\n{cmd}"
-            )
+        # Only the registered sphere is needed in minimal profile
+        if config.profile == "minimal":
+            return mesh_gii, None
 
         # Create a transformed GIFTI image with all attributes
         # indentical to target GIFTI image.
@@ -247,6 +496,9 @@ def run_msm(
         # Transfomed and reprojected data are stored in temporary directory
         # in dpv (data per voxel) format.
         reprojected_dpv = Path(tmp_dir) / "transformed_and_reprojected.dpv"
+        # pandas is only needed here, and is slow to import
+        import pandas as pd
+
         transformed_data = pd.read_csv(reprojected_dpv, sep=" ", header=None)
 
         # Data of interest (scalar data per voxel) are stored in 4th column
@@ -265,6 +517,58 @@ def run_msm(
 
         # Replace target data by transformed data
         reprojected_contrasts.darrays[0].data = transformed_data
-        mesh_gii = nib.load(mesh_gii_path)
 
         return mesh_gii, reprojected_contrasts
+
+
+def run_msmresample(sphere_in, data_path, sphere_out):
+    """Resample data living on a spherical mesh onto another spherical mesh
+
+    Parameters
+    ----------
+    sphere_in : str
+        Path to the GIFTI spherical mesh on which data from data_path lives.
+        Typically, this is a transformed mesh outputed by run_msm.
+    data_path : str
+        Path to the GIFTI file holding the data to resample.
+        The file should contain at least 2 data arrays
+        (MSM doesn't accept 1-dimensional maps).
+    sphere_out : str
+        Path to the GIFTI spherical mesh onto which data should be projected.
+
+    Returns
+    -------
+    resampled_gii : nibabel.gifti.GiftiImage
+        Image holding the data resampled on the vertices of sphere_out.
+    """
+    msmresample = utils.fsl_tool("msmresample")
+
+    with TemporaryDirectory() as tmp_dir:
+        resampled_path = str(Path(tmp_dir) / "resampled")
+
+        cmd = shlex.split(
+            " ".join(
+                [
+                    msmresample,
+                    f"{sphere_in}",
+                    resampled_path,
+                    f"-labels {data_path}",
+                    f"-project {sphere_out}",
+                ]
+            )
+        )
+
+        exit_code = utils.run_command(
+            cmd,
+            silence=[
+                # Silence this false warning from msmresample
+                "** DA[1] has coordsys with intent NIFTI_INTENT_TRIANGLE (should be NIFTI_INTENT_POINTSET)"
+            ],
+        )
+
+        if exit_code != 0:
+            raise RuntimeError(f"Failed to run msmresample with command:\n{cmd}")
+
+        resampled_gii = nib.load(f"{resampled_path}.func.gii")
+
+        return resampled_gii
@@ -0,0 +1,393 @@
+from collections import deque
+from concurrent.futures import Future
+import json
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import resource
+import threading
+
+from msm.geometry import get_cache_dir
+from msm.run import MSMConfig
+from msm import utils
+
+# Grid levels used by default in run.run_msm
+DATAGRID = MSMConfig().datagrid
+CPGRID = MSMConfig().cpgrid
+
+# Rough memory footprint of msm, in bytes:
+# fixed overhead, per input mesh vertex, per input mesh vertex and feature,
+# per data grid vertex and feature, and per control point
+# (labels of the discrete optimisation).
+# They are only used until actual peak memory of similar runs is measured.
+MEMORY_OVERHEAD = 256 * 2**20
+MEMORY_PER_VERTEX = 1024
+MEMORY_PER_FEATURE_VERTEX = 200
+MEMORY_PER_GRID_VERTEX = 400
+MEMORY_PER_CONTROL_POINT = 100 * 1024
+
+# Margin applied to memory estimates
+SAFETY_FACTOR = 1.2
+
+# Number of most recent measurements kept for each job signature
+MAX_RECORDS = 20
+
+
+def ico_vertices(level):
+    """Number of vertices of a regular icosphere of given level."""
+
+    return 10 * 4**level + 2
+
+
+def estimate_msm_memory(n_vertices, n_features=1, datagrid=DATAGRID, cpgrid=CPGRID):
+    """
+    Estimate peak memory of a msm registration from problem size.
+
+    Parameters
+    ----------
+    n_vertices: int
+        Number of vertices of source and target meshes.
+    n_features: int
+        Number of contrast maps used for registration.
+    datagrid, cpgrid: tuple of int
+        Icosphere levels of data and control point grids
+        at each resolution level (--datagrid and --CPgrid).
+
+    Returns
+    -------
+    memory: int
+        Estimated peak memory, in bytes.
+    """
+    mesh_memory = 2 * n_vertices * (
+        MEMORY_PER_VERTEX + n_features * MEMORY_PER_FEATURE_VERTEX
+    )
+    grid_memory = (
+        max(ico_vertices(level) for level in datagrid)
+        * n_features
+        * MEMORY_PER_GRID_VERTEX
+    )
+    control_point_memory = (
+        max(ico_vertices(level) for level in cpgrid) * MEMORY_PER_CONTROL_POINT
+    )
+
+    return int(MEMORY_OVERHEAD + mesh_memory + grid_memory + control_point_memory)
+
+
+def msm_signature(n_vertices, n_features=1, datagrid=DATAGRID, cpgrid=CPGRID):
+    """Key identifying registrations of the same size."""
+
+    return f"{n_vertices}-{n_features}-{list(datagrid)}-{list(cpgrid)}"
+
+
+class MemoryHistory:
+    def __init__(self, path=None):
+        """
+        Initialize history of measured peak memory of past jobs.
+
+        Parameters
+        ----------
+        path: str or None
+            JSON file in which history is persisted.
+            Defaults to memory_history.json in the cache directory
+            (see geometry.get_cache_dir).
+        """
+
+        if path is None:
+            path = get_cache_dir() / "memory_history.json"
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.records = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.records = dict(json.load(f))
+            except (OSError, ValueError, TypeError) as e:
+                # History is only a hint, start afresh
+                logging.getLogger("msm").warning(
+                    f"Ignoring unreadable memory history {path}: {e}"
+                )
+
+    def record(self, signature, estimate, peak):
+        """Record estimated and measured peak memory of a job.
+
+        Only the MAX_RECORDS most recent measurements of each signature
+        are kept.
+        """
+
+        with self.lock:
+            runs = self.records.setdefault(signature, [])
+            runs.append([estimate, peak])
+            del runs[:-MAX_RECORDS]
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                # Concurrent schedulers may write history at the same time
+                with utils.atomic_path(self.path) as tmp_path:
+                    with open(tmp_path, "w") as f:
+                        json.dump(self.records, f)
+            except OSError:
+                pass
+
+    def refine(self, signature, estimate):
+        """
+        Refine memory estimate of a job.
+
+        Jobs of the same signature are expected to use as much memory
+        as the largest measured peak. Otherwise, the estimate is corrected
+        by the median ratio between measured and estimated peaks
+        of all past jobs.
+        """
+        with self.lock:
+            if signature in self.records:
+                return int(SAFETY_FACTOR * max(p for _, p in self.records[signature]))
+
+            ratios = sorted(
+                p / e for runs in self.records.values() for e, p in runs if e > 0
+            )
+
+        if len(ratios) == 0:
+            return int(SAFETY_FACTOR * estimate)
+
+        return int(SAFETY_FACTOR * estimate * ratios[len(ratios) // 2])
+
+
+def available_memory():
+    """Memory available for new processes on this node, in bytes."""
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def _reset_peak_memory():
+    # Peak resident memory of a forked process starts from that of
+    # its parent. On Linux, it is reset to current resident memory,
+    # which is returned, in bytes. Elsewhere, growth of the peak
+    # inherited from the parent is measured instead.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_job(conn, fn, args, kwargs):
+    # Memory held by the parent when it forked is not used by the job
+    baseline = _reset_peak_memory()
+    try:
+        result = ("done", fn(*args, **kwargs))
+    except BaseException as e:
+        result = ("failed", e)
+
+    # ru_maxrss is given in kB on Linux
+    job_peak = 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    # Subprocesses spawned by the job, such as msm, start afresh
+    children_peak = 1024 * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak = max(job_peak, 0) + children_peak
+    try:
+        conn.send((*result, peak))
+    except Exception as e:
+        # Result or exception could not be pickled
+        conn.send(("failed", RuntimeError(repr(e)), peak))
+    conn.close()
+
+
+class Scheduler:
+    def __init__(
+        self, max_cpus=None, memory_budget=None, history=None, poll_interval=0.1
+    ):
+        """
+        Initialize scheduler of concurrent jobs.
+
+        Jobs are admitted only while their reserved CPUs and memory
+        fit within the node budgets. Each job runs in its own process,
+        so that its peak memory (including that of msm subprocesses)
+        can be measured and used to refine further estimates.
+
+        Parameters
+        ----------
+        max_cpus: int or None
+            Number of CPUs which can be used at once.
+            Defaults to the number of CPUs of the node.
+        memory_budget: int or None
+            Memory which can be used at once, in bytes.
+            Defaults to 90% of memory available when
+            the scheduler is created.
+        history: MemoryHistory or None
+            History of peak memory of past jobs.
+        poll_interval: float
+            Delay between checks of running jobs, in seconds.
+        """
+
+        self.max_cpus = os.cpu_count() if max_cpus is None else max_cpus
+        self.memory_budget = (
+            int(0.9 * available_memory()) if memory_budget is None else memory_budget
+        )
+        self.history = MemoryHistory() if history is None else history
+        self.poll_interval = poll_interval
+
+        self.pending = deque()
+        self.running = {}
+        self.used_cpus = 0
+        self.used_memory = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._dispatch, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def submit(self, fn, *args, memory=0, signature=None, cpus=1, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) to be run in a separate process.
+
+        Parameters
+        ----------
+        fn: callable
+            Function to run. It should be picklable.
+        memory: int
+            Estimated peak memory of the job, in bytes,
+            for instance given by estimate_msm_memory.
+        signature: str or None
+            Key identifying jobs of similar size, for instance given by
+            msm_signature. If specified, the memory estimate is refined
+            with measured peak memory of past jobs.
+        cpus: int
+            Number of CPUs used by the job.
+
+        Returns
+        -------
+        future: concurrent.futures.Future
+            Future of the result of fn. Once done, its max_rss attribute
+            holds the measured peak memory of the job, in bytes.
+        """
+        estimate = memory
+        if signature is not None:
+            memory = self.history.refine(signature, estimate)
+
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Cannot submit jobs after shutdown")
+            self.pending.append(
+                (future, fn, args, kwargs, estimate, memory, signature, cpus)
+            )
+            self.condition.notify()
+
+        return future
+
+    def map(self, fn, iterable, **kwargs):
+        """Run fn on each element of iterable and return results in order."""
+
+        futures = [self.submit(fn, x, **kwargs) for x in iterable]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if wait:
+            self.thread.join()
+
+    def _fits(self, memory, cpus):
+        # A job exceeding budgets on its own is run alone
+        if len(self.running) == 0:
+            return True
+        return (
+            self.used_cpus + cpus <= self.max_cpus
+            and self.used_memory + memory <= self.memory_budget
+        )
+
+    def _admit(self):
+        # Start every pending job which fits in budgets,
+        # letting smaller jobs overtake larger ones
+        for job in list(self.pending):
+            future, fn, args, kwargs, estimate, memory, signature, cpus = job
+            if not self._fits(memory, cpus):
+                continue
+            self.pending.remove(job)
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=_run_job, args=(child_conn, fn, args, kwargs)
+            )
+            process.start()
+            child_conn.close()
+
+            self.running[parent_conn] = (
+                process,
+                future,
+                estimate,
+                memory,
+                signature,
+                cpus,
+            )
+            self.used_cpus += cpus
+            self.used_memory += memory
+
+    def _dispatch(self):
+        logger = logging.getLogger("msm")
+
+        while True:
+            with self.condition:
+                self._admit()
+                if self.closed and not self.pending and not self.running:
+                    return
+                if not self.running:
+                    self.condition.wait()
+                    continue
+                conns = list(self.running)
+
+            for conn in wait(conns, timeout=self.poll_interval):
+                try:
+                    status, result, peak = conn.recv()
+                except EOFError:
+                    status, result, peak = (
+                        "failed",
+                        RuntimeError("Job process died unexpectedly"),
+                        None,
+                    )
+
+                with self.condition:
+                    (
+                        process,
+                        future,
+                        estimate,
+                        memory,
+                        signature,
+                        cpus,
+                    ) = self.running.pop(conn)
+                    self.used_cpus -= cpus
+                    self.used_memory -= memory
+                process.join()
+                conn.close()
+
+                if peak is not None and signature is not None:
+                    self.history.record(signature, estimate, peak)
+                logger.info(
+                    f"Job finished ({status}), "
+                    f"estimated memory {memory / 2**20:.0f} MB, "
+                    f"peak memory {(peak or 0) / 2**20:.0f} MB"
+                )
+
+                future.max_rss = peak
+                if status == "done":
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
@@ -0,0 +1,351 @@
+"""Serve fitted MSM models from a long-lived local process.
+
+Usage::
+
+    python -m msm.serve [--port 8765 | --socket /tmp/msm.sock] [--max-models 8]
+
+Fitted models are loaded on first use, and kept in memory
+(along with the resampling operators they compute lazily)
+in a bounded least recently used cache shared by all clients.
+
+Requests are HTTP POST requests to /transform, /inverse_transform
+or /score, whose query string identifies the model
+(model, source_mesh and optionally target_mesh, as passed to
+MSM.load_model) and gives the number of contrast maps n_samples.
+Contrast maps are sent as the raw buffer of a C-contiguous
+float32 array, and /score expects source maps followed by target maps.
+Transformed maps are answered in the same format, with their shape in
+the X-Shape header, while scores are answered as JSON.
+GET /models lists models held in cache.
+
+Client wraps this protocol::
+
+    client = Client(port=8765)
+    predicted_data = client.transform(data, "model.surf.gii", "lh.sphere.gii")
+"""
+
+import argparse
+from collections import OrderedDict
+from concurrent.futures import Future
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import numpy as np
+import os
+import socket
+import socketserver
+import threading
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from msm.model import MSM
+
+
+class ModelCache:
+    def __init__(self, max_models=8):
+        """
+        Initialize least recently used cache of fitted models.
+
+        Parameters
+        ----------
+        max_models: int
+            Number of models held in memory at once.
+        """
+
+        self.max_models = max_models
+        self.models = OrderedDict()
+        # Futures of models being loaded
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, model_path, source_mesh, target_mesh=None):
+        """Get fitted model, loading it if it is not in cache.
+
+        Models are loaded outside of the cache lock, so that requests
+        of other models are not blocked meanwhile, and only once
+        if several requests need the same model.
+        """
+
+        key = (model_path, source_mesh, target_mesh)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            future = self.loading.get(key)
+            is_loader = future is None
+            if is_loader:
+                future = self.loading[key] = Future()
+
+        if not is_loader:
+            return future.result()
+
+        try:
+            model = MSM().load_model(model_path, source_mesh, target_mesh)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.loading[key]
+            self.models[key] = model
+            while len(self.models) > self.max_models:
+                self.models.popitem(last=False)
+        future.set_result(model)
+
+        return model
+
+    def keys(self):
+        with self.lock:
+            return list(self.models)
+
+
+class ModelRequestHandler(BaseHTTPRequestHandler):
+    # Set by make_server
+    cache = None
+
+    def address_string(self):
+        # Clients of Unix sockets have no address
+        return str(self.client_address[0]) if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        logging.getLogger("msm").info(format % args)
+
+    def _send(self, body, content_type, headers={}):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, content):
+        self._send(json.dumps(content).encode(), "application/json")
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/models":
+            self.send_error(404)
+            return
+
+        self._send_json([list(key) for key in self.cache.keys()])
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        action = url.path.strip("/")
+        if action not in ["transform", "inverse_transform", "score"]:
+            self.send_error(404)
+            return
+
+        try:
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            model = self.cache.get(
+                params.pop("model"),
+                params.pop("source_mesh"),
+                params.pop("target_mesh", None),
+            )
+            n_samples = int(params.pop("n_samples"))
+
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            data = np.frombuffer(body, dtype=np.float32).reshape(n_samples, -1)
+            if action == "score":
+                source_data, target_data = np.split(data, 2)
+                self._send_json({"score": model.score(source_data, target_data)})
+                return
+
+            if action == "transform":
+                predicted_data = model.transform(data, **params)
+            else:
+                predicted_data = model.inverse_transform(data)
+        except Exception as e:
+            # The reason phrase of the response holds the error
+            self.send_error(400, message=" ".join(repr(e).split()))
+            return
+
+        predicted_data = np.ascontiguousarray(predicted_data, dtype=np.float32)
+        self._send(
+            predicted_data.tobytes(),
+            "application/octet-stream",
+            {"X-Shape": ",".join(str(n) for n in predicted_data.shape)},
+        )
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(port=8765, socket_path=None, cache=None):
+    """
+    Create server answering requests with models of cache.
+
+    Parameters
+    ----------
+    port: int
+        Port on which the server listens on localhost.
+        0 picks any free port.
+    socket_path: str or None
+        If specified, the server rather listens on this Unix socket.
+    cache: ModelCache or None
+        Cache of models. Defaults to a new ModelCache.
+
+    Returns
+    -------
+    server: socketserver.BaseServer
+        Server, which should be run with serve_forever.
+    """
+    handler = type(
+        "Handler",
+        (ModelRequestHandler,),
+        {"cache": ModelCache() if cache is None else cache},
+    )
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return UnixHTTPServer(socket_path, handler)
+
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class Client:
+    def __init__(self, port=8765, socket_path=None, timeout=None):
+        """
+        Initialize client of a model server started with msm.serve.
+
+        Parameters
+        ----------
+        port: int
+            Port on which the server listens on localhost.
+        socket_path: str or None
+            If specified, Unix socket on which the server listens.
+        timeout: float or None
+            Timeout of requests, in seconds.
+        """
+
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _request(self, action, data, model, source_mesh, target_mesh, **params):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        query = {
+            "model": os.path.abspath(model),
+            "source_mesh": os.path.abspath(source_mesh),
+            "n_samples": data.shape[0],
+            **params,
+        }
+        if target_mesh is not None:
+            query["target_mesh"] = os.path.abspath(target_mesh)
+
+        if self.socket_path is not None:
+            connection = _UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(
+                "127.0.0.1", self.port, timeout=self.timeout
+            )
+        try:
+            connection.request(
+                "POST",
+                f"/{action}?{urlencode(query)}",
+                body=data.tobytes(),
+                headers={"Content-Type": "application/octet-stream"},
+            )
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise RuntimeError(f"Failed to {action} with server: {response.reason}")
+            if action == "score":
+                return json.loads(body)["score"]
+
+            shape = [int(n) for n in response.getheader("X-Shape").split(",")]
+            return np.frombuffer(body, dtype=np.float32).reshape(shape)
+        finally:
+            connection.close()
+
+    def transform(self, source_data, model, source_mesh, target_mesh=None, **params):
+        """
+        Transform contrast maps with a model held by the server.
+
+        Parameters
+        ----------
+        source_data: ndarray(n_samples, n_features)
+        model, source_mesh, target_mesh: str
+            Paths passed to MSM.load_model.
+        **params:
+            Additional arguments of MSM.transform, such as mode.
+
+        Returns
+        -------
+        predicted_data: ndarray(n_samples, n_target_features) of float32
+        """
+        source_data = np.atleast_2d(source_data)
+        return self._request(
+            "transform", source_data, model, source_mesh, target_mesh, **params
+        )
+
+    def inverse_transform(self, target_data, model, source_mesh, target_mesh=None):
+        """Inverse transform contrast maps with a model held by the server."""
+
+        target_data = np.atleast_2d(target_data)
+        return self._request(
+            "inverse_transform", target_data, model, source_mesh, target_mesh
+        )
+
+    def score(self, source_data, target_data, model, source_mesh, target_mesh=None):
+        """Score a model held by the server, see MSM.score."""
+
+        data = np.concatenate([np.atleast_2d(source_data), np.atleast_2d(target_data)])
+        return self._request("score", data, model, source_mesh, target_mesh)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve fitted MSM models from a long-lived local process."
+    )
+    parser.add_argument(
+        "--port", type=int, default=8765, help="Port to listen on localhost"
+    )
+    parser.add_argument(
+        "--socket", default=None, help="Unix socket to listen on, instead of a port"
+    )
+    parser.add_argument(
+        "--max-models", type=int, default=8, help="Number of models kept in memory"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("msm").setLevel(logging.INFO)
+
+    server = make_server(
+        port=args.port,
+        socket_path=args.socket,
+        cache=ModelCache(max_models=args.max_models),
+    )
+    address = args.socket or f"127.0.0.1:{server.server_address[1]}"
+    logging.getLogger("msm").info(f"Serving models on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
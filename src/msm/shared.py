@@ -0,0 +1,185 @@
+from multiprocessing import shared_memory
+import nibabel as nib
+import numpy as np
+from scipy import sparse
+
+from msm.model import MSM
+
+MESHES = ["source_mesh", "target_mesh", "transformed_mesh"]
+
+# Getter of each operator which can be shared,
+# and whether it is a sparse matrix
+OPERATORS = {
+    "inverse": ("_get_inverse_operator", True),
+    "forward": ("_get_forward_operator", True),
+    "nearest": ("_get_nearest_indices", False),
+}
+
+
+def _open(name):
+    # Workers attaching to a block should not unlink it when they exit,
+    # which can only be prevented from python 3.13.
+    # Before that, attaching from processes started by the publishing one,
+    # which share its resource tracker, is safe.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedModel:
+    def __init__(self, model, operators=("inverse",)):
+        """
+        Publish arrays of a fitted model into shared memory.
+
+        Vertices and faces of meshes of the model, as well as
+        requested resampling operators (computed if needed),
+        are copied once into shared memory blocks.
+        Workers can then attach to them, and get a model
+        whose arrays are views of these blocks, without any copy.
+
+        Instances are picklable, and only hold names of blocks
+        once pickled, so they can be cheaply sent to workers
+        of a process pool, which call attach.
+        The publishing instance owns the blocks, which are
+        freed by unlink (or when leaving a with block).
+
+        Parameters
+        ----------
+        model: MSM
+            Fitted model.
+        operators: tuple of str
+            Operators to share among "inverse" (used by inverse_transform),
+            "forward" (used by transform with a parcellation)
+            and "nearest" (used by transform in nearest mode).
+        """
+
+        arrays = {}
+        self.coordsys = {}
+        for mesh_name in MESHES:
+            mesh = getattr(model, mesh_name)
+            arrays[f"{mesh_name}_vertices"] = mesh.darrays[0].data
+            arrays[f"{mesh_name}_faces"] = mesh.darrays[1].data
+            self.coordsys[mesh_name] = mesh.darrays[0].coordsys
+
+        self.operator_shapes = {}
+        for operator_name in operators:
+            getter, is_sparse = OPERATORS[operator_name]
+            operator = getattr(model, getter)()
+            if is_sparse:
+                arrays[f"{operator_name}_data"] = operator.data
+                arrays[f"{operator_name}_indices"] = operator.indices
+                arrays[f"{operator_name}_indptr"] = operator.indptr
+                self.operator_shapes[operator_name] = operator.shape
+            else:
+                arrays[operator_name] = operator
+
+        self.blocks = {}
+        self.spec = {}
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks[key] = block
+            self.spec[key] = (block.name, array.shape, array.dtype.str)
+
+        self.owner = True
+
+    def __getstate__(self):
+        return {
+            "coordsys": self.coordsys,
+            "operator_shapes": self.operator_shapes,
+            "spec": self.spec,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.blocks = {}
+        self.owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.owner:
+            self.unlink()
+
+    def _array(self, key):
+        name, shape, dtype = self.spec[key]
+        if key not in self.blocks:
+            self.blocks[key] = _open(name)
+
+        return np.ndarray(shape, dtype=dtype, buffer=self.blocks[key].buf)
+
+    def attach(self):
+        """
+        Get model whose arrays are views of shared memory blocks.
+
+        Returns
+        -------
+        model: MSM
+            Fitted model, with shared operators already computed.
+            Its arrays are read-only views, which should not be
+            used after the publishing instance unlinked blocks.
+        """
+        model = MSM()
+        for mesh_name in MESHES:
+            vertices = self._array(f"{mesh_name}_vertices")
+            faces = self._array(f"{mesh_name}_faces")
+            vertices.flags.writeable = False
+            faces.flags.writeable = False
+
+            mesh = nib.gifti.gifti.GiftiImage()
+            mesh.add_gifti_data_array(
+                nib.gifti.gifti.GiftiDataArray(
+                    data=vertices,
+                    intent=nib.nifti1.intent_codes.code["NIFTI_INTENT_POINTSET"],
+                    coordsys=self.coordsys[mesh_name],
+                )
+            )
+            mesh.add_gifti_data_array(
+                nib.gifti.gifti.GiftiDataArray(
+                    data=faces,
+                    intent=nib.nifti1.intent_codes.code["NIFTI_INTENT_TRIANGLE"],
+                )
+            )
+            setattr(model, mesh_name, mesh)
+
+        model._reset_operators()
+        for operator_name, (getter, is_sparse) in OPERATORS.items():
+            if is_sparse and operator_name in self.operator_shapes:
+                operator = sparse.csr_matrix(
+                    (
+                        self._array(f"{operator_name}_data"),
+                        self._array(f"{operator_name}_indices"),
+                        self._array(f"{operator_name}_indptr"),
+                    ),
+                    shape=self.operator_shapes[operator_name],
+                    copy=False,
+                )
+            elif not is_sparse and operator_name in self.spec:
+                operator = self._array(operator_name)
+            else:
+                continue
+            # Attributes read by getters of the model
+            setattr(model, getter.replace("_get", "", 1), operator)
+
+        # Keep blocks open as long as the model is used
+        model._shared_model = self
+
+        return model
+
+    def close(self):
+        """Close blocks opened by this instance."""
+
+        for block in self.blocks.values():
+            block.close()
+        self.blocks = {}
+
+    def unlink(self):
+        """Free shared memory blocks, which only the publisher should do."""
+
+        blocks = list(self.blocks.values())
+        self.close()
+        for block in blocks:
+            block.unlink()
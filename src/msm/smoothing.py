@@ -0,0 +1,179 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import os
+
+from msm.geometry import get_cache_dir, get_geometry, mesh_hash, prune_cache
+
+
+class SurfaceSmoother:
+    def __init__(self, geometry, sigma):
+        """
+        Initialize Gaussian smoothing of data living on a spherical mesh.
+
+        Smoothing is performed by repeatedly averaging each vertex
+        with its 1-ring neighbours, weighted by a Gaussian of
+        their geodesic distance. The number of steps is chosen such that
+        variances of all steps add up to sigma**2, which approximates
+        a Gaussian kernel of geodesic width sigma without materializing
+        its (dense at large sigma) matrix.
+
+        Parameters
+        ----------
+        geometry: geometry.MeshGeometry
+            Geometry of the mesh, as returned by geometry.get_geometry.
+        sigma: float
+            Standard deviation of the Gaussian kernel,
+            in the units of mesh coordinates (as sigma_in in msm).
+        """
+
+        self.sigma = sigma
+
+        vertices = np.asarray(geometry.vertices, dtype=np.float64)
+        vertices = vertices / np.linalg.norm(vertices, axis=1, keepdims=True)
+        adjacency = geometry.adjacency.tocoo()
+        rows, cols = adjacency.row, adjacency.col
+
+        # Geodesic distance between neighbours on the sphere
+        cosines = np.sum(vertices[rows] * vertices[cols], axis=1)
+        distances = geometry.radius * np.arccos(np.clip(cosines, -1, 1))
+        n_vertices = geometry.n_vertices
+
+        def step_variance(width):
+            # Variance along each direction of the tangent plane
+            # added by one averaging step, averaged over vertices
+            weights = np.exp(-(distances**2) / (2 * width**2))
+            normalization = 1 + np.bincount(rows, weights=weights, minlength=n_vertices)
+            variance = np.bincount(
+                rows, weights=weights * distances**2, minlength=n_vertices
+            ) / (2 * normalization)
+            return np.mean(variance), weights
+
+        # Use as few steps as possible with kernels no wider than edges,
+        # then adjust their width so that variances add up to sigma**2
+        max_variance, _ = step_variance(np.mean(distances))
+        self.n_steps = int(np.ceil(sigma**2 / max_variance))
+        low, high = 0, np.mean(distances)
+        for _ in range(50):
+            width = (low + high) / 2
+            variance, _ = step_variance(width)
+            if variance * self.n_steps < sigma**2:
+                low = width
+            else:
+                high = width
+        _, weights = step_variance((low + high) / 2)
+
+        from scipy import sparse
+
+        operator = sparse.csr_matrix(
+            (
+                np.concatenate([weights, np.ones(n_vertices)]),
+                (
+                    np.concatenate([rows, np.arange(n_vertices)]),
+                    np.concatenate([cols, np.arange(n_vertices)]),
+                ),
+            ),
+            shape=(n_vertices, n_vertices),
+        )
+        normalization = np.asarray(operator.sum(axis=1)).ravel()
+        self.operator = (sparse.diags(1 / normalization) @ operator).tocsr()
+
+    def transform(self, data):
+        """
+        Smooth data.
+
+        Parameters
+        ----------
+        data: ndarray(n_samples, n_vertices) or ndarray(n_vertices)
+
+        Returns
+        -------
+        smoothed_data: ndarray of same shape as data
+        """
+        smoothed_data = np.asarray(data, dtype=np.float64).T
+        for _ in range(self.n_steps):
+            smoothed_data = self.operator @ smoothed_data
+
+        return smoothed_data.T.astype(np.float32)
+
+
+# Number of smoothers kept in memory by get_smoother
+MAX_SMOOTHERS = 8
+
+_smoothers = OrderedDict()
+
+
+def get_smoother(mesh, sigma):
+    """Get smoother of a mesh, building it only once per process.
+
+    Only the MAX_SMOOTHERS most recently used smoothers are kept.
+    """
+
+    key = (mesh_hash(mesh), float(sigma))
+    if key in _smoothers:
+        _smoothers.move_to_end(key)
+    else:
+        _smoothers[key] = SurfaceSmoother(get_geometry(mesh, persist=True), sigma)
+        while len(_smoothers) > MAX_SMOOTHERS:
+            _smoothers.popitem(last=False)
+
+    return _smoothers[key]
+
+
+def smooth_cached(data, mesh, sigma, cache_dir=None):
+    """
+    Smooth contrast maps, reusing results of previous calls.
+
+    Smoothed maps are stored in the cache directory,
+    keyed by content of data, mesh and sigma, so that repeated fits
+    on the same data (for instance in a sweep over epsilon)
+    only smooth it once. Least recently used maps are removed
+    once they exceed the size of the cache (see geometry.prune_cache).
+
+    Parameters
+    ----------
+    data: ndarray(n_samples, n_vertices)
+        Contrast maps.
+    mesh: nibabel.gifti.GiftiImage
+        Spherical mesh on which data lives.
+    sigma: float
+        Standard deviation of the Gaussian kernel.
+    cache_dir: str or None
+        See geometry.get_cache_dir for default value.
+
+    Returns
+    -------
+    smoothed_data: ndarray(n_samples, n_vertices)
+    """
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    if sigma == 0:
+        return data
+
+    h = hashlib.sha1()
+    h.update(str(data.shape).encode())
+    h.update(data.tobytes())
+    h.update(mesh_hash(mesh).encode())
+    h.update(str(float(sigma)).encode())
+    path = get_cache_dir(cache_dir) / "smoothed" / f"{h.hexdigest()}.npy"
+
+    if path.exists():
+        try:
+            smoothed_data = np.load(path)
+            # Mark maps as recently used
+            os.utime(path)
+            return smoothed_data
+        except OSError:
+            # Maps were pruned by another process
+            pass
+
+    smoothed_data = get_smoother(mesh, sigma).transform(data)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{os.getpid()}.{path.name}")
+        np.save(tmp_path, smoothed_data)
+        os.replace(tmp_path, path)
+        prune_cache(path.parent)
+    except OSError:
+        pass
+
+    return smoothed_data
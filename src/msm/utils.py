@@ -1,11 +1,119 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import functools
 import gzip
+import hashlib
+import inspect
 import logging
 import nibabel as nib
+import numpy as np
 import os
+import subprocess
 from tempfile import TemporaryDirectory
+import threading
 import shutil
 
 
+class Estimator:
+    """
+    Parameters handling of scikit-learn estimators.
+
+    Parameters are the arguments of __init__, stored as attributes
+    of the same name, as required by scikit-learn, and estimator tags
+    are those of sklearn.base.BaseEstimator.
+    This keeps estimators compatible with sklearn.base.clone
+    and model selection tools, while scikit-learn, which takes
+    about a second to import, is only imported by these tools.
+    """
+
+    @classmethod
+    def _get_param_names(cls):
+        return [
+            name
+            for name, parameter in inspect.signature(cls.__init__).parameters.items()
+            if name != "self" and parameter.kind != parameter.VAR_KEYWORD
+        ]
+
+    def get_params(self, deep=True):
+        """
+        Get parameters of this estimator.
+
+        Parameters
+        ----------
+        deep: bool
+            Whether parameters of nested estimators should be returned too,
+            with keys of the form <parameter>__<nested parameter>.
+
+        Returns
+        -------
+        params: dict
+        """
+        params = {}
+        for name in self._get_param_names():
+            value = getattr(self, name)
+            if deep and hasattr(value, "get_params") and not isinstance(value, type):
+                for key, nested_value in value.get_params().items():
+                    params[f"{name}__{key}"] = nested_value
+            params[name] = value
+
+        return params
+
+    def set_params(self, **params):
+        """Set parameters of this estimator, and of nested ones."""
+
+        valid_params = self._get_param_names()
+        nested_params = {}
+        for key, value in params.items():
+            name, _, nested_key = key.partition("__")
+            if name not in valid_params:
+                raise ValueError(
+                    f"Invalid parameter {name} for {type(self).__name__}, "
+                    f"should be one of {valid_params}"
+                )
+            if nested_key:
+                nested_params.setdefault(name, {})[nested_key] = value
+            else:
+                setattr(self, name, value)
+
+        for name, nested in nested_params.items():
+            getattr(self, name).set_params(**nested)
+
+        return self
+
+    def __sklearn_tags__(self):
+        # Only called by scikit-learn >= 1.6, which provides Tags
+        from sklearn.utils import Tags, TargetTags
+
+        return Tags(
+            estimator_type=None,
+            target_tags=TargetTags(required=False),
+            transformer_tags=None,
+            regressor_tags=None,
+            classifier_tags=None,
+        )
+
+    def __repr__(self):
+        params = ", ".join(
+            f"{key}={value!r}" for key, value in self.get_params(deep=False).items()
+        )
+        return f"{type(self).__name__}({params})"
+
+
+class TransformerMixin:
+    """fit_transform and tags of scikit-learn transformers."""
+
+    def fit_transform(self, X, y=None, **fit_params):
+        return self.fit(X, y, **fit_params).transform(X)
+
+    def __sklearn_tags__(self):
+        from sklearn.utils import TransformerTags
+
+        tags = super().__sklearn_tags__()
+        tags.transformer_tags = TransformerTags()
+        return tags
+
+
 def log_subprocess_output(pipe, err=False, silence=[]):
     """Util function to log information throughout this package
     using a common logger.
@@ -29,19 +137,207 @@ def log_subprocess_output(pipe, err=False, silence=[]):
                 logging.info(message)
 
 
-def check_fsl():
+def run_command(cmd, timeout=None, silence=[], log_stdout=True):
+    """Run command while logging its outputs.
+
+    Parameters
+    ----------
+    cmd: list of str
+        Command to run.
+    timeout: float or None
+        Time after which the command is killed, in seconds.
+    silence: list of strings,
+        list of messages from stderr which should not be printed
+    log_stdout: bool
+        Whether standard output should be logged.
+        If False, it is discarded without being decoded.
+
+    Returns
+    -------
+    exit_code: int
+
+    Raises
+    ------
+    subprocess.TimeoutExpired
+        If the command did not finish before timeout.
+    """
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE if log_stdout else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+    # Outputs are logged from separate threads
+    # so that the process can be waited for with a timeout
+    loggers = [
+        threading.Thread(
+            target=log_subprocess_output,
+            args=(process.stderr,),
+            kwargs={"err": True, "silence": silence},
+        ),
+    ]
+    if log_stdout:
+        loggers.append(
+            threading.Thread(target=log_subprocess_output, args=(process.stdout,))
+        )
+    for logger in loggers:
+        logger.start()
+
+    try:
+        exit_code = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        for logger in loggers:
+            logger.join()
+        if log_stdout:
+            process.stdout.close()
+        process.stderr.close()
+
+    return exit_code
+
+
+@contextmanager
+def working_directory(path=None):
+    """Context manager yielding a working directory.
+
+    If path is None, a temporary directory is created and deleted on exit.
+    Otherwise, path is created if needed and kept on exit,
+    so that its content can be reused by further runs.
+    """
+    if path is None:
+        with TemporaryDirectory() as tmp_dir:
+            yield tmp_dir
+    else:
+        os.makedirs(path, exist_ok=True)
+        yield str(path)
+
+
+@contextmanager
+def atomic_path(path):
+    """Context manager yielding a temporary path, renamed to path on exit.
+
+    The temporary file lives in the same directory, and keeps the
+    extension of path. It is only renamed if the block succeeds,
+    so that path never holds a partially written file,
+    for instance if the process is killed while writing it.
+    """
+    directory, filename = os.path.split(str(path))
+    tmp_path = os.path.join(
+        directory, f".tmp{os.getpid()}_{threading.get_ident()}_{filename}"
+    )
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def files_hash(paths, *extra):
+    """SHA-1 of the content of files, and of extra values."""
+
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+    for value in extra:
+        sha1.update(repr(value).encode())
+
+    return sha1.hexdigest()
+
+
+# Tools of FSL called by this package
+FSL_TOOLS = ["msm", "msmresample", "surf2surf"]
+
+FSLToolchain = namedtuple(
+    "FSLToolchain", ["fsl_dir", "config_path", "version", *FSL_TOOLS]
+)
+
+
+@functools.lru_cache(maxsize=None)
+def fsl_toolchain():
+    """
+    Locate FSL and the tools used by this package.
+
+    FSL is only looked up once per process,
+    call fsl_toolchain.cache_clear() to look it up again.
+    FSLDIR and FSL_CONFIG_PATH environment variables,
+    read by tools of FSL, are set at the same time.
+
+    Returns
+    -------
+    toolchain: FSLToolchain
+        fsl_dir: str
+            Root directory of FSL.
+        config_path: str
+            Default msm config of FSL.
+        version: str or None
+            Version of FSL, if it could be found.
+        msm, msmresample, surf2surf: str or None
+            Path to each tool, or None if it is not installed.
+    """
     fsl_bin_path = shutil.which("fsl")
     if fsl_bin_path is None:
-        raise ("FSL is not installed or is not in PATH")
-    else:
-        fsl_path = os.path.join(os.path.dirname(fsl_bin_path), "../")
-        fsl_config_path = os.path.join(
-            fsl_path, "config/basic_configs/config_standard_MSM_strain"
+        raise RuntimeError("FSL is not installed or is not in PATH")
+
+    fsl_dir = os.path.normpath(os.path.join(os.path.dirname(fsl_bin_path), ".."))
+    config_path = os.path.join(
+        fsl_dir, "config/basic_configs/config_standard_MSM_strain"
+    )
+
+    version = None
+    version_path = os.path.join(fsl_dir, "etc", "fslversion")
+    if os.path.exists(version_path):
+        with open(version_path) as f:
+            version = f.read().strip().split(":")[0] or None
+
+    tools = {}
+    for tool in FSL_TOOLS:
+        tool_path = os.path.join(fsl_dir, "bin", tool)
+        tools[tool] = tool_path if os.path.exists(tool_path) else shutil.which(tool)
+
+    os.environ["FSLDIR"] = fsl_dir
+    os.environ["FSL_CONFIG_PATH"] = config_path
+
+    return FSLToolchain(fsl_dir, config_path, version, **tools)
+
+
+def fsl_tool(tool):
+    """
+    Path to a tool of FSL.
+
+    Raises
+    ------
+    RuntimeError
+        If FSL or the tool is not installed.
+    """
+    toolchain = fsl_toolchain()
+    tool_path = getattr(toolchain, tool)
+    if tool_path is None:
+        raise RuntimeError(
+            f"{tool} is not installed in {os.path.join(toolchain.fsl_dir, 'bin')} "
+            "nor in PATH"
         )
-        os.environ["FSLDIR"] = fsl_path
-        os.environ["FSL_CONFIG_PATH"] = fsl_config_path
 
-        return fsl_path, fsl_config_path
+    return tool_path
+
+
+def check_fsl():
+    toolchain = fsl_toolchain()
+
+    return toolchain.fsl_dir, toolchain.config_path
+
+
+def is_same_coordsys(c1, c2):
+    return (
+        c1.dataspace == c2.dataspace
+        and c1.xformspace == c2.xformspace
+        and np.all(c1.xform == c2.xform)
+    )
 
 
 def gifti_from_file(mesh_path):
@@ -51,9 +347,7 @@ def gifti_from_file(mesh_path):
         # If mesh is gzipped, create a new file
         # with uncompressed data and load mesh from this file instead
         if mesh_path.endswith(".gz"):
-            tmp_mesh_path = os.path.join(
-                tmp_dir, os.path.basename(mesh_path[:-3])
-            )
+            tmp_mesh_path = os.path.join(tmp_dir, os.path.basename(mesh_path[:-3]))
             ungzip(mesh_path, tmp_mesh_path)
             mesh = nib.load(tmp_mesh_path)
         else:
@@ -68,3 +362,96 @@ def ungzip(input_path, output_path):
             shutil.copyfileobj(f_in, f_out)
 
     return output_path
+
+
+def load_contrasts(paths, mesh=None, n_jobs=1, out=None, on_error="raise"):
+    """Load contrast maps from GIFTI files into a single array.
+
+    Files are decoded in a pool of threads, and each map is written
+    directly into its row of the output array.
+
+    Parameters
+    ----------
+    paths: list of str
+        Paths to GIFTI files, whose first data array is loaded.
+    mesh: str or None
+        Path to the mesh on which contrast maps live.
+        If specified, coordinate systems of contrast maps are checked
+        against that of the mesh, as done in run.prepare_darrays.
+    n_jobs: int
+        Number of threads used to decode files.
+    out: ndarray(n_files, n_vertices) or None
+        Array in which contrast maps are written.
+        If None, a float32 array is allocated, whose number of vertices
+        is that of mesh if specified, and of the first loaded map otherwise.
+    on_error: "raise" or "warn"
+        Whether to raise an error listing all files which
+        could not be loaded, or to log a warning for each of them
+        and leave their rows filled with NaNs, in which case
+        out must have a floating point dtype.
+
+    Returns
+    -------
+    out: ndarray(n_files, n_vertices)
+        Loaded contrast maps.
+    """
+    if on_error not in ["raise", "warn"]:
+        raise ValueError(f"on_error should be 'raise' or 'warn', got {on_error!r}.")
+    if out is not None:
+        if out.shape[0] != len(paths):
+            raise ValueError(
+                f"Output array has {out.shape[0]} rows for {len(paths)} files."
+            )
+        if on_error == "warn" and not np.issubdtype(out.dtype, np.floating):
+            raise ValueError(
+                f"Output array of dtype {out.dtype} cannot be filled with NaNs "
+                "for files which fail to load, use a floating point dtype."
+            )
+
+    coordsys = None
+    if mesh is not None:
+        mesh_darray = gifti_from_file(mesh).darrays[0]
+        coordsys = mesh_darray.coordsys
+        if out is None:
+            n_vertices = mesh_darray.data.shape[0]
+            out = np.empty((len(paths), n_vertices), dtype=np.float32)
+
+    # Without mesh, output is allocated once the first map is loaded
+    lock = threading.Lock()
+    outputs = [out]
+
+    def load(i):
+        darray = gifti_from_file(paths[i]).darrays[0]
+        if coordsys is not None and darray.coordsys is not None:
+            if not is_same_coordsys(darray.coordsys, coordsys):
+                raise ValueError(
+                    "Provided data is in different coordsys than the mesh."
+                )
+        with lock:
+            if outputs[0] is None:
+                outputs[0] = np.empty(
+                    (len(paths),) + darray.data.shape, dtype=np.float32
+                )
+        out = outputs[0]
+        if darray.data.shape != out.shape[1:]:
+            raise ValueError(f"Expected {out.shape[1:]} map, got {darray.data.shape}.")
+        out[i] = darray.data
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(load, i): i for i in range(len(paths))}
+        for future, i in futures.items():
+            error = future.exception()
+            if error is not None:
+                failures[i] = error
+
+    out = outputs[0]
+    if len(failures) > 0:
+        messages = [f"{paths[i]}: {error}" for i, error in failures.items()]
+        if on_error == "raise" or out is None:
+            raise ValueError("Failed to load contrast maps:\n" + "\n".join(messages))
+        for i, message in zip(failures, messages):
+            out[i] = np.nan
+            logging.warning(f"Failed to load contrast map {message}")
+
+    return out
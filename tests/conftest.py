@@ -0,0 +1,88 @@
+import copy
+from nilearn import datasets
+import numpy as np
+import pytest
+
+from msm import model
+from msm import utils
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path_factory):
+    """Keep geometry, smoothed data and memory history out of the user cache"""
+
+    cache_dir = tmp_path_factory.mktemp("cache")
+    monkeypatch.setenv("MSM_CACHE_DIR", str(cache_dir))
+
+    return cache_dir
+
+
+@pytest.fixture
+def rotated_model():
+    """Factory of models whose deformation is a rotation around the z axis"""
+
+    def make_model(theta=0.3):
+        fs5 = datasets.fetch_surf_fsaverage()
+        mesh = utils.gifti_from_file(fs5.sphere_left)
+        rotation = np.array(
+            [
+                [np.cos(theta), -np.sin(theta), 0],
+                [np.sin(theta), np.cos(theta), 0],
+                [0, 0, 1],
+            ]
+        )
+        transformed_mesh = copy.deepcopy(mesh)
+        transformed_mesh.darrays[0].data = (mesh.darrays[0].data @ rotation.T).astype(
+            np.float32
+        )
+
+        m = model.MSM()
+        m.source_mesh = mesh
+        m.target_mesh = mesh
+        m.transformed_mesh = transformed_mesh
+
+        return m
+
+    return make_model
+
+
+class FakeDataset:
+    """Minimal HDF5-like dataset, supporting only row slicing"""
+
+    def __init__(self, data, name="/data", parent=None):
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.name = name
+        self.parent = parent
+
+    def __getitem__(self, index):
+        return self.data[index].copy()
+
+    def __setitem__(self, index, value):
+        self.data[index] = value
+
+
+class FakeGroup:
+    """Minimal HDF5-like group, creating FakeDataset"""
+
+    def __init__(self):
+        self.datasets = {}
+
+    def create_dataset(self, name, shape, dtype, chunks=None):
+        self.datasets[name] = FakeDataset(np.zeros(shape, dtype), name, self)
+        return self.datasets[name]
+
+
+@pytest.fixture
+def fake_dataset():
+    """Factory of HDF5-like datasets wrapping in-memory arrays"""
+
+    return FakeDataset
+
+
+@pytest.fixture
+def fake_group():
+    """Factory of HDF5-like groups"""
+
+    return FakeGroup
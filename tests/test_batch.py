@@ -0,0 +1,114 @@
+import json
+import numpy as np
+import os
+import pytest
+from tempfile import TemporaryDirectory
+
+from msm import batch
+from msm.benchmark import icosphere, mesh_gifti
+
+
+def write_manifest(tmp_dir):
+    paths = {}
+    for name in ["source.gii", "target.gii", "mesh.gii"]:
+        paths[name] = os.path.join(tmp_dir, name)
+        with open(paths[name], "w") as f:
+            f.write(name)
+
+    manifest = {
+        "n_jobs": 2,
+        "defaults": {"mesh": paths["mesh.gii"], "epsilon": 0.1},
+        "jobs": [
+            {
+                "source": [paths["source.gii"]],
+                "target": [paths["target.gii"]],
+                "output": os.path.join(tmp_dir, "out", "transformed.surf.gii"),
+                "iterations": 5,
+            }
+        ],
+    }
+    manifest_path = os.path.join(tmp_dir, "manifest.json")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+
+    return manifest_path
+
+
+def test_load_manifest():
+    """Defaults should be applied to all jobs."""
+
+    with TemporaryDirectory() as tmp_dir:
+        n_jobs, jobs = batch.load_manifest(write_manifest(tmp_dir))
+        assert n_jobs == 2
+        assert batch.hyperparameters(jobs[0]) == {"epsilon": 0.1, "iterations": 5}
+
+        with open(os.path.join(tmp_dir, "bad_manifest.json"), "w") as f:
+            json.dump({"jobs": [{"source": []}]}, f)
+        with pytest.raises(ValueError):
+            batch.load_manifest(os.path.join(tmp_dir, "bad_manifest.json"))
+
+        # Single paths are accepted, but not misspelled hyperparameters
+        job = {**jobs[0], "source": jobs[0]["source"][0]}
+        with open(os.path.join(tmp_dir, "single_manifest.json"), "w") as f:
+            json.dump({"jobs": [job]}, f)
+        _, single_jobs = batch.load_manifest(
+            os.path.join(tmp_dir, "single_manifest.json")
+        )
+        assert single_jobs[0]["source"] == jobs[0]["source"]
+        assert batch.job_hash(single_jobs[0]) == batch.job_hash(jobs[0])
+
+        with open(os.path.join(tmp_dir, "typo_manifest.json"), "w") as f:
+            json.dump({"jobs": [{**jobs[0], "epsilion": 0.1}]}, f)
+        with pytest.raises(ValueError, match="epsilion"):
+            batch.load_manifest(os.path.join(tmp_dir, "typo_manifest.json"))
+
+
+def test_skip_done_jobs():
+    """Jobs with up to date outputs should not be run again."""
+
+    with TemporaryDirectory() as tmp_dir:
+        manifest_path = write_manifest(tmp_dir)
+        _, jobs = batch.load_manifest(manifest_path)
+        job = jobs[0]
+
+        os.makedirs(os.path.dirname(job["output"]))
+        open(job["output"], "w").close()
+        with open(batch.checkpoint_path(job), "w") as f:
+            json.dump({"input_hash": batch.job_hash(job)}, f)
+
+        summary_path = os.path.join(tmp_dir, "summary.json")
+        assert batch.main([manifest_path, "--summary", summary_path]) == 0
+        with open(summary_path) as f:
+            assert json.load(f)["n_skipped"] == 1
+
+        # Changing inputs should invalidate outputs
+        with open(job["source"][0], "w") as f:
+            f.write("modified")
+        assert not batch.is_done(job, batch.job_hash(job))
+
+
+def fake_run_job(job, input_hash):
+    # Allocate some memory, which should be measured
+    np.ones(32 * 2**20 // 8)
+    return {"output": job["output"], "status": "done", "wall_time": 0.0}
+
+
+def test_run_batch(monkeypatch, tmp_path):
+    """Missing inputs should fail their job only, and peak memory be per job."""
+
+    monkeypatch.setattr(batch, "run_job", fake_run_job)
+    _, jobs = batch.load_manifest(write_manifest(str(tmp_path)))
+    mesh_path = str(tmp_path / "mesh.surf.gii")
+    mesh_gifti(*icosphere(1)).to_filename(mesh_path)
+    jobs[0]["mesh"] = mesh_path
+    missing_job = {**jobs[0], "source": [str(tmp_path / "missing.gii")]}
+
+    records = batch.run_batch([missing_job, jobs[0]], n_jobs=2)
+    assert records[0]["status"] == "failed"
+    assert "missing.gii" in records[0]["error"]
+    assert records[1]["status"] == "done"
+    assert 32 * 2**20 <= records[1]["max_rss"] < 96 * 2**20
+
+    summary = batch.summarize(records, 1.0)
+    assert summary["n_failed"] == 1
+    assert summary["max_rss"] == records[1]["max_rss"]
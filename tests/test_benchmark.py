@@ -0,0 +1,46 @@
+import json
+import numpy as np
+import pytest
+
+from msm.benchmark import icosphere, main
+
+
+@pytest.mark.parametrize("level", [0, 1, 3])
+def test_icosphere(level):
+    vertices, faces = icosphere(level, radius=100)
+
+    assert vertices.shape == (10 * 4**level + 2, 3)
+    assert faces.shape == (20 * 4**level, 3)
+    np.testing.assert_allclose(np.linalg.norm(vertices, axis=1), 100)
+    # Each edge is shared by exactly 2 faces
+    edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    _, counts = np.unique(edges, axis=0, return_counts=True)
+    assert np.all(counts == 2)
+
+
+def test_benchmark(tmp_path):
+    report_path = tmp_path / "report.json"
+    main(
+        [
+            "--level",
+            "3",
+            "--n-maps",
+            "2",
+            "--angles",
+            "0.1",
+            "--stub-fsl",
+            "--output",
+            str(report_path),
+        ]
+    )
+
+    with open(report_path) as f:
+        report = json.load(f)
+
+    assert len(report) == 1
+    assert report[0]["n_vertices"] == 642
+    modes = report[0]["modes"]
+    assert set(modes) == {"adaptive", "barycentric"}
+    # The stub of msmresample interpolates like the native mode
+    assert modes["barycentric"]["max_abs_difference"] < 1e-5
+    assert modes["barycentric"]["max_abs_error"] < 0.1
@@ -0,0 +1,72 @@
+import os
+from tempfile import TemporaryDirectory
+
+from msm import catalog
+
+
+def test_parse_contrast_path():
+    """Flat files and IBC derivatives should be parsed."""
+
+    record = catalog.parse_contrast_path(
+        "data/bold_sub-04_ses-03_rsvp_language_consonant_string_lh.gii"
+    )
+    assert record["subject"] == "sub-04"
+    assert record["session"] == "ses-03"
+    assert record["contrast"] == "rsvp_language_consonant_string"
+    assert record["hemisphere"] == "lh"
+
+    record = catalog.parse_contrast_path(
+        "derivatives/sub-07/ses-30/res_fsaverage5_mathlang_ffx/"
+        "stat_surf/visual-auditory_rh.gii"
+    )
+    assert record["subject"] == "sub-07"
+    assert record["session"] == "ses-30"
+    assert record["task"] == "mathlang"
+    assert record["contrast"] == "visual-auditory"
+    assert record["hemisphere"] == "rh"
+
+    assert catalog.parse_contrast_path("data/lh.sphere.gii") is None
+
+
+def test_catalog_pairs():
+    """Contrast maps of two subjects should be matched once indexed."""
+
+    with TemporaryDirectory() as tmp_dir:
+        filenames = [
+            "bold_sub-04_ses-00_archi_standard_audio_lh.gii",
+            "bold_sub-04_ses-00_archi_standard_audio_rh.gii",
+            "bold_sub-04_ses-01_hcp_motor_tongue_lh.gii",
+            "bold_sub-04_ses-02_hcp_motor_foot_lh.gii",
+            "bold_sub-07_ses-00_archi_standard_audio_lh.gii",
+            "bold_sub-07_ses-01_hcp_motor_tongue_lh.gii",
+            "bold_sub-07_ses-01_hcp_motor_foot_lh.gii",
+        ]
+        for filename in filenames:
+            open(os.path.join(tmp_dir, filename), "w").close()
+
+        index_path = os.path.join(tmp_dir, "catalog.csv")
+        c = catalog.Catalog.scan(tmp_dir, index_path=index_path)
+        assert len(c.records) == len(filenames)
+        assert os.path.exists(index_path)
+
+        # Catalog should be loaded from index rather than scanned again,
+        # unless a refresh is requested
+        extra_path = os.path.join(tmp_dir, "bold_sub-07_ses-02_extra_lh.gii")
+        open(extra_path, "w").close()
+        c = catalog.Catalog.scan(tmp_dir, index_path=index_path)
+        assert len(c.records) == len(filenames)
+        c = catalog.Catalog.scan(tmp_dir, index_path=index_path, refresh=True)
+        assert len(c.records) == len(filenames) + 1
+        os.remove(extra_path)
+        c = catalog.Catalog.scan(tmp_dir, index_path=index_path, refresh=True)
+        assert len(c.records) == len(filenames)
+
+        pairs = c.pairs("sub-04", "sub-07", hemisphere="lh")
+        assert list(pairs["contrast"]) == ["archi_standard_audio", "hcp_motor_tongue"]
+        assert all(
+            os.path.basename(path).startswith("bold_sub-07")
+            for path in pairs["target_path"]
+        )
+
+        pairs = c.pairs("sub-04", "sub-07", hemisphere="lh", sessions=["ses-01"])
+        assert len(pairs) == 1
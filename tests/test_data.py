@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from tempfile import TemporaryDirectory
+
+from msm import data
+
+
+def test_feature_store():
+    """Stored contrast maps should be read back as float32 memory maps."""
+
+    n_contrasts, n_vertices = 5, 642
+    source_data = np.random.rand(n_contrasts, n_vertices)
+    contrasts = [f"contrast_{i}" for i in range(n_contrasts)]
+
+    with TemporaryDirectory() as tmp_dir:
+        store = data.FeatureStore(tmp_dir)
+        store.add(
+            "sub-04",
+            "lh",
+            source_data,
+            contrasts,
+            sessions=["ses-00"] * n_contrasts,
+            n_train=4,
+        )
+
+        # Store should be reloaded from its index
+        store = data.FeatureStore(tmp_dir)
+        assert store.keys() == [("sub-04", "lh")]
+        assert store.metadata("sub-04", "lh")["metadata"]["n_train"] == 4
+
+        stored_data = store.get("sub-04", "lh")
+        assert isinstance(stored_data, np.memmap)
+        assert stored_data.dtype == np.float32
+        np.testing.assert_allclose(stored_data, source_data, rtol=1e-6)
+
+        # Slices should be views of the memory map
+        train_data = store.get("sub-04", "lh", rows=slice(None, 4))
+        assert train_data.shape == (4, n_vertices)
+        assert isinstance(train_data, np.memmap)
+
+        selected_data = store.get("sub-04", "lh", rows=["contrast_3", 1])
+        np.testing.assert_array_equal(selected_data, stored_data[[3, 1]])
+
+        with pytest.raises(ValueError):
+            store.add("sub-07", "lh", source_data, contrasts[:2])
+
+        del stored_data, train_data
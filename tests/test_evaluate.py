@@ -0,0 +1,37 @@
+import numpy as np
+from scipy.stats import pearsonr
+
+from msm import evaluate
+
+
+def test_pairwise_similarity():
+    """Batched correlations should match pairwise pearsonr"""
+
+    rng = np.random.RandomState(0)
+    n_subjects, n_contrasts, n_vertices = 4, 3, 1000
+    shared = rng.randn(n_contrasts, n_vertices)
+    data = [shared + rng.randn(n_contrasts, n_vertices) for _ in range(n_subjects)]
+
+    similarity = evaluate.pairwise_similarity(
+        [None] * n_subjects, data, chunk_size=300
+    )
+    assert similarity.shape == (n_subjects, n_subjects, n_contrasts)
+    for i in range(n_subjects):
+        for j in range(n_subjects):
+            for k in range(n_contrasts):
+                np.testing.assert_allclose(
+                    similarity[i, j, k], pearsonr(data[i][k], data[j][k])[0], atol=1e-5
+                )
+
+
+def test_pairwise_similarity_models(rotated_model):
+    """Subjects should be transformed into the shared space first"""
+
+    m = rotated_model()
+    coordinates = m.source_mesh.darrays[0].data
+    parcellation = np.digitize(coordinates[:, 2], np.linspace(-100, 100, 20))
+
+    data = [coordinates.T.copy(), coordinates.T.copy()]
+    similarity = evaluate.pairwise_similarity([m, m], data, parcellation=parcellation)
+    assert similarity.shape == (2, 2, 3)
+    np.testing.assert_allclose(similarity, 1, atol=1e-5)
@@ -0,0 +1,115 @@
+from nilearn import datasets
+import numpy as np
+import os
+from tempfile import TemporaryDirectory
+
+from msm import geometry
+from msm import utils
+
+
+def test_mesh_geometry():
+    """Derived geometry of fsaverage5 sphere should be consistent."""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    mesh = utils.gifti_from_file(fs5.sphere_left)
+    mesh_geometry = geometry.MeshGeometry.from_gifti(mesh)
+
+    # Closed triangulated sphere
+    n_vertices, n_faces = 10242, 20480
+    assert mesh_geometry.face_areas.shape == (n_faces,)
+    np.testing.assert_allclose(
+        mesh_geometry.face_areas.sum(), 4 * np.pi * 100**2, rtol=1e-2
+    )
+    np.testing.assert_allclose(
+        np.linalg.norm(mesh_geometry.face_normals, axis=1), 1, rtol=1e-6
+    )
+    assert np.all(mesh_geometry.face_neighbors >= 0)
+    assert mesh_geometry.adjacency.shape == (n_vertices, n_vertices)
+    # Euler characteristic of a sphere: V - E + F = 2
+    n_edges = mesh_geometry.adjacency_indices.shape[0] // 2
+    assert n_vertices - n_edges + n_faces == 2
+
+
+def test_get_geometry():
+    """Geometry should be stored once as memory-mapped sidecar files."""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    mesh = utils.gifti_from_file(fs5.sphere_left)
+    # Forget geometries computed by other tests
+    geometry._geometries.clear()
+
+    with TemporaryDirectory() as tmp_dir:
+        mesh_geometry = geometry.get_geometry(mesh, cache_dir=tmp_dir, persist=True)
+        sidecar_path = os.path.join(tmp_dir, "geometry", geometry.mesh_hash(mesh))
+        assert os.path.exists(os.path.join(sidecar_path, "face_areas.npy"))
+
+        loaded_geometry = geometry.MeshGeometry.load(sidecar_path)
+        assert isinstance(loaded_geometry.face_areas, np.memmap)
+        np.testing.assert_array_equal(
+            loaded_geometry.face_neighbors, mesh_geometry.face_neighbors
+        )
+        del loaded_geometry
+
+    assert geometry.get_geometry(mesh) is mesh_geometry
+
+
+def test_average_deformations():
+    """Opposite displacements should average to the original mesh."""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    vertices = utils.gifti_from_file(fs5.sphere_left).darrays[0].data
+    vertices = vertices.astype(np.float64)
+    radius = np.mean(np.linalg.norm(vertices, axis=1))
+    vertices *= radius / np.linalg.norm(vertices, axis=1, keepdims=True)
+
+    # Random displacements tangent to the sphere
+    displacements = np.random.RandomState(0).randn(*vertices.shape)
+    displacements -= (
+        np.sum(displacements * vertices, axis=1, keepdims=True) * vertices / radius**2
+    )
+
+    deformed_vertices = []
+    for sign in [1, -1]:
+        deformed = vertices + sign * displacements
+        deformed *= radius / np.linalg.norm(deformed, axis=1, keepdims=True)
+        deformed_vertices.append(deformed)
+
+    mean_vertices, variability = geometry.average_deformations(
+        deformed_vertices, radius
+    )
+    np.testing.assert_allclose(mean_vertices, vertices, atol=1e-6)
+    expected = radius * np.arctan(np.linalg.norm(displacements, axis=1) / radius)
+    np.testing.assert_allclose(variability, expected, rtol=1e-5)
+
+
+def test_get_geometry_persist(cache_dir, monkeypatch):
+    """Only persisted geometries should be stored, within the cache size"""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    mesh = utils.gifti_from_file(fs5.sphere_left)
+    geometry._geometries.clear()
+    sidecar_dir = cache_dir / "geometry"
+
+    geometry.get_geometry(mesh)
+    assert not sidecar_dir.exists()
+    # Nor is geometry kept in memory
+    assert len(geometry._geometries) == 0
+
+    geometry._geometries.clear()
+    geometry.get_geometry(mesh, persist=True)
+    assert os.listdir(sidecar_dir) == [geometry.mesh_hash(mesh)]
+
+    # Least recently used sidecars are removed above the cache size
+    old_sidecar = sidecar_dir / geometry.mesh_hash(mesh)
+    os.utime(old_sidecar, (0, 0))
+    monkeypatch.setenv("MSM_CACHE_SIZE", str(geometry._entry_size(old_sidecar)))
+    mesh.darrays[0].data = mesh.darrays[0].data * 2
+    geometry.get_geometry(mesh, persist=True)
+    assert os.listdir(sidecar_dir) == [geometry.mesh_hash(mesh)]
+
+    # Only the most recently used geometries are kept in memory
+    monkeypatch.setattr(geometry, "MAX_GEOMETRIES", 1)
+    mesh.darrays[0].data = mesh.darrays[0].data * 2
+    geometry.get_geometry(mesh, persist=True)
+    assert list(geometry._geometries) == [geometry.mesh_hash(mesh)]
+    geometry._geometries.clear()
@@ -0,0 +1,88 @@
+from nilearn import datasets
+import numpy as np
+import os
+from tempfile import TemporaryDirectory
+
+from msm import index
+from msm.benchmark import icosphere, mesh_gifti
+from msm import utils
+
+
+def test_query_mesh_vertices():
+    """Mesh vertices should be located with a unit barycentric weight."""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    mesh = utils.gifti_from_file(fs5.sphere_left)
+    idx = index.SphereIndex.from_gifti(mesh)
+
+    face_indices, weights = idx.query(mesh.darrays[0].data, chunk_size=1000)
+    assert face_indices.shape == (10242,)
+    assert weights.shape == (10242, 3)
+
+    operator = idx.interpolation_operator(mesh.darrays[0].data)
+    np.testing.assert_allclose(operator.diagonal(), 1, atol=1e-4)
+
+
+def test_query_random_points():
+    """Random points should lie within their triangle."""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    mesh = utils.gifti_from_file(fs5.sphere_left)
+    idx = index.SphereIndex.from_gifti(mesh, n_candidates=1)
+
+    points = np.random.default_rng(0).normal(size=(5000, 3))
+    face_indices, weights = idx.query(points)
+    assert np.all(weights >= 0)
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+
+    # Radial projection of points onto triangles should be
+    # a positive multiple of points
+    projected = np.einsum(
+        "ij,ijk->ik", weights, idx.vertices[idx.faces[face_indices]]
+    )
+    cosine = np.sum(projected * points, axis=1) / (
+        np.linalg.norm(projected, axis=1) * np.linalg.norm(points, axis=1)
+    )
+    np.testing.assert_allclose(cosine, 1, atol=1e-6)
+
+    nearest = idx.nearest_vertex(idx.vertices[:10] * 1.01)
+    np.testing.assert_array_equal(nearest, np.arange(10))
+
+
+def test_save_load():
+    """Saved index should answer queries identically once reloaded."""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    mesh = utils.gifti_from_file(fs5.sphere_left)
+    idx = index.get_index(mesh)
+    assert index.get_index(utils.gifti_from_file(fs5.sphere_left)) is idx
+
+    with TemporaryDirectory() as tmp_dir:
+        index_path = os.path.join(tmp_dir, "index.npz")
+        idx.save(index_path)
+        loaded_idx = index.SphereIndex.load(index_path)
+
+    points = np.random.default_rng(0).normal(size=(100, 3))
+    np.testing.assert_array_equal(idx.query(points)[0], loaded_idx.query(points)[0])
+
+
+def test_get_index(monkeypatch, rotated_model):
+    """Only the most recently used indices should be kept in memory."""
+
+    monkeypatch.setattr(index, "_indices", index.OrderedDict())
+    monkeypatch.setattr(index, "MAX_INDICES", 2)
+    meshes = [mesh_gifti(*icosphere(level)) for level in range(3)]
+
+    idx = index.get_index(meshes[0])
+    assert index.get_index(meshes[0]) is idx
+    for mesh in meshes[1:]:
+        index.get_index(mesh)
+    assert len(index._indices) == 2
+    assert index.get_index(meshes[0]) is not idx
+
+    # Indices of transformed meshes are kept on their model
+    index._indices.clear()
+    m = rotated_model()
+    m.transform(np.ones((1, 10242)), mode="nearest")
+    assert m._transformed_index is not None
+    assert len(index._indices) == 0
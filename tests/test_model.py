@@ -1,8 +1,13 @@
 import pytest
 
-from msm import model
+from msm import geometry, model
+from msm.benchmark import stub_fsl
+from msm import utils
 from nilearn import datasets
 import numpy as np
+import os
+import pandas as pd
+from scipy import sparse
 
 # from sklearn.utils.estimator_checks import check_estimator
 
@@ -45,6 +50,415 @@ def test_align_random_data():
     assert source_test_data.shape == predicted_data.shape
 
 
+def test_compose_models():
+    """Composition of two fits onto a template should map source to target"""
+
+    fs3 = datasets.fetch_surf_fsaverage(mesh="fsaverage3")
+    n_voxels = 642
+    template_data = np.random.rand(2, n_voxels)
+
+    # fit source and target subjects onto the same template
+    source_model = model.MSM().fit(
+        np.random.rand(2, n_voxels), template_data, source_mesh=fs3.sphere_left
+    )
+    target_model = model.MSM().fit(
+        np.random.rand(2, n_voxels), template_data, source_mesh=fs3.sphere_left
+    )
+
+    m = model.ComposedMSM(source_model, target_model, invert_second=True).fit()
+    assert m.transformed_mesh.darrays[0].data.shape == (n_voxels, 3)
+
+    source_test_data = np.random.rand(4, n_voxels)
+    predicted_data = m.transform(source_test_data)
+    assert source_test_data.shape == predicted_data.shape
+
+    s = m.score(source_test_data, predicted_data)
+    assert isinstance(s, float)
+
+
+@pytest.mark.parametrize("invert_second", [False, True])
+def test_compose_rotations(invert_second, rotated_model):
+    """Composing two rotations should apply their product"""
+
+    first, second = rotated_model(0.3), rotated_model(-0.2)
+    with stub_fsl():
+        m = model.ComposedMSM(first, second, invert_second=invert_second).fit()
+
+    # Rotations around the z axis add up their angles,
+    # and the second one is undone when inverted
+    theta = 0.3 + 0.2 if invert_second else 0.3 - 0.2
+    rotation = np.array(
+        [
+            [np.cos(theta), -np.sin(theta), 0],
+            [np.sin(theta), np.cos(theta), 0],
+            [0, 0, 1],
+        ]
+    )
+    vertices = first.source_mesh.darrays[0].data
+    assert m.source_mesh is first.source_mesh
+    np.testing.assert_allclose(
+        m.transformed_mesh.darrays[0].data, vertices @ rotation.T, atol=0.1
+    )
+
+
+def fake_run_msm(
+    source_contrasts_list, source_mesh, target_contrasts_list, target_mesh, **kwargs
+):
+    """Deform source_mesh by a small rotation depending on contrasts used"""
+
+    mesh = utils.gifti_from_file(source_mesh)
+    sample = [int(path.split("_")[-1].split(".")[0]) for path in source_contrasts_list]
+    theta = 0.01 * np.mean(sample)
+    rotation = np.array(
+        [
+            [np.cos(theta), -np.sin(theta), 0],
+            [np.sin(theta), np.cos(theta), 0],
+            [0, 0, 1],
+        ]
+    )
+    mesh.darrays[0].data = (mesh.darrays[0].data @ rotation.T).astype(np.float32)
+
+    return mesh, None
+
+
+def test_fit_bootstrap(monkeypatch):
+    """Bootstrap registrations should be averaged, reproducibly"""
+
+    monkeypatch.setattr(model, "run_msm", fake_run_msm)
+    mesh_path = datasets.fetch_surf_fsaverage().sphere_left
+    mesh = utils.gifti_from_file(mesh_path)
+    source_data = np.random.rand(4, 10242).astype(np.float32)
+    target_data = np.random.rand(4, 10242).astype(np.float32)
+
+    def fit(random_state):
+        return model.MSM().fit(
+            source_data,
+            target_data,
+            source_mesh=mesh_path,
+            n_bootstrap=3,
+            n_jobs=2,
+            random_state=random_state,
+        )
+
+    m = fit(0)
+    # Bootstrap samples are drawn as in fit
+    rng = np.random.RandomState(0)
+    samples = [rng.choice(4, 4, replace=True) for _ in range(3)]
+    deformed_vertices = [
+        fake_run_msm([f"source_{i}.func.gii" for i in sample], mesh_path, [], None)[0]
+        .darrays[0]
+        .data
+        for sample in samples
+    ]
+    mean_vertices, variability = geometry.average_deformations(
+        deformed_vertices, geometry.get_geometry(mesh).radius
+    )
+    np.testing.assert_allclose(
+        m.transformed_mesh.darrays[0].data, mean_vertices, rtol=1e-5, atol=1e-4
+    )
+    np.testing.assert_allclose(m.deformation_variability, variability, atol=1e-5)
+    assert m.deformation_variability.max() > 0
+
+    np.testing.assert_array_equal(
+        fit(0).transformed_mesh.darrays[0].data, m.transformed_mesh.darrays[0].data
+    )
+    assert not np.allclose(
+        fit(1).transformed_mesh.darrays[0].data, m.transformed_mesh.darrays[0].data
+    )
+
+
+def test_model_selection(monkeypatch):
+    """Models should be usable with scikit-learn model selection tools"""
+
+    from sklearn.base import clone
+    from sklearn.model_selection import GridSearchCV, cross_val_score
+
+    monkeypatch.setattr(model, "run_msm", fake_run_msm)
+    mesh_path = datasets.fetch_surf_fsaverage().sphere_left
+    source_data = np.random.rand(4, 10242).astype(np.float32)
+    target_data = np.random.rand(4, 10242).astype(np.float32)
+
+    with stub_fsl():
+        scores = cross_val_score(
+            model.MSM(),
+            source_data,
+            target_data,
+            cv=2,
+            params={"source_mesh": mesh_path},
+            error_score="raise",
+        )
+        assert scores.shape == (2,)
+
+        search = GridSearchCV(
+            model.MSM(), {"epsilon": [0.1, 1]}, cv=2, error_score="raise"
+        )
+        search.fit(source_data, target_data, source_mesh=mesh_path)
+        assert search.best_params_["epsilon"] in [0.1, 1]
+
+    composed = model.ComposedMSM(model.MSM(epsilon=0.5), model.MSM())
+    assert clone(composed).first.epsilon == 0.5
+    assert clone(model.BilateralMSM(n_jobs=3)).n_jobs == 3
+
+
+def test_inverse_transform(rotated_model):
+    """Inverse transform should pull target maps back onto source vertices"""
+
+    m = rotated_model()
+
+    # target maps are vertex coordinates, which should be interpolated
+    # at the rotated positions of source vertices
+    target_data = m.target_mesh.darrays[0].data.T.copy()
+    predicted_data = m.inverse_transform(target_data)
+    assert predicted_data.shape == target_data.shape
+    np.testing.assert_allclose(
+        predicted_data, m.transformed_mesh.darrays[0].data.T, atol=0.1
+    )
+
+    # transform single contrast map
+    predicted_map = m.inverse_transform(target_data[0])
+    np.testing.assert_array_equal(predicted_map, predicted_data[0])
+
+
+def test_transform_parcellation(rotated_model):
+    """Parcel averages of transformed maps should be computed directly"""
+
+    theta = 0.3
+    m = rotated_model(theta)
+    coordinates = m.source_mesh.darrays[0].data
+
+    # Source vertex at the position of each target vertex
+    # once rotated back are those with rotated coordinates
+    source_data = coordinates.T.copy()
+    rotation = np.array(
+        [
+            [np.cos(theta), np.sin(theta), 0],
+            [-np.sin(theta), np.cos(theta), 0],
+            [0, 0, 1],
+        ]
+    )
+    expected_maps = (coordinates @ rotation.T).T
+
+    parcellation = (coordinates[:, 2] > 0).astype(int) + 2 * (
+        coordinates[:, 0] > 0
+    ).astype(int)
+    predicted_data = m.transform(source_data, parcellation=parcellation)
+    assert predicted_data.shape == (3, 4)
+    expected_data = np.column_stack(
+        [expected_maps[:, parcellation == label].mean(axis=1) for label in range(4)]
+    )
+    np.testing.assert_allclose(predicted_data, expected_data, atol=0.1)
+
+    # Operator is cached for each parcellation
+    predicted_map = m.transform(source_data[0], parcellation=parcellation)
+    np.testing.assert_array_equal(predicted_map, predicted_data[0])
+    assert len(m._parcel_operators) == 1
+
+
+@pytest.mark.parametrize("mode", ["nearest", "majority"])
+def test_transform_labels(mode, rotated_model):
+    """Label maps should be resampled natively without mixing labels"""
+
+    m = rotated_model()
+    coordinates = m.source_mesh.darrays[0].data
+
+    # Quadrants in the xy plane are rotated along with the mesh
+    labels = np.stack(
+        [
+            (coordinates[:, 0] > 0).astype(int) + 2 * (coordinates[:, 1] > 0),
+            (coordinates[:, 2] > 0).astype(int),
+        ]
+    )
+    predicted_labels = m.transform(labels, mode=mode)
+    assert predicted_labels.shape == labels.shape
+    assert predicted_labels.dtype == labels.dtype
+    assert set(np.unique(predicted_labels[0])) == {0, 1, 2, 3}
+    # Rotations around the z axis leave hemispheres unchanged
+    assert np.mean(predicted_labels[1] == labels[1]) > 0.99
+    # Rotation by 0.3 radian moves about 0.3 / (pi / 2) of each quadrant
+    assert 0.7 < np.mean(predicted_labels[0] == labels[0]) < 0.85
+
+    predicted_map = m.transform(labels[1], mode=mode)
+    np.testing.assert_array_equal(predicted_map, predicted_labels[1])
+
+    with pytest.raises(ValueError):
+        m.transform(labels, mode=mode, parcellation=labels[1])
+
+
+def test_transform_out(rotated_model):
+    """Transformed maps should be written in a preallocated output"""
+
+    m = rotated_model()
+    labels = np.random.randint(0, 5, size=(3, 10242))
+    expected_labels = m.transform(labels, mode="nearest")
+
+    out = np.zeros((4, 10242), dtype=np.float32)
+    predicted_labels = m.transform(labels, mode="nearest", out=out[1:])
+    assert predicted_labels.base is out
+    np.testing.assert_array_equal(out[1:], expected_labels)
+    np.testing.assert_array_equal(out[0], 0)
+
+    # 1-dimensional maps are written in 1-dimensional outputs
+    predicted_map = m.transform(labels[0], mode="nearest", out=out[0])
+    assert predicted_map.base is out
+    np.testing.assert_array_equal(out[0], expected_labels[0])
+
+    parcellation = np.arange(10242) % 10
+    predicted_data = m.transform(
+        labels.astype(np.float64), parcellation=parcellation, dtype=np.float32
+    )
+    assert predicted_data.shape == (3, 10)
+    assert predicted_data.dtype == np.float32
+
+    with pytest.raises(ValueError):
+        m.transform(labels, mode="nearest", out=out)
+
+
+def test_transform_out_of_core(
+    tmp_path, caplog, rotated_model, fake_dataset, fake_group
+):
+    """On-disk maps should be streamed by blocks of rows"""
+
+    m = rotated_model()
+    data = np.random.rand(7, 10242).astype(np.float32)
+    expected_data = m.transform(data, mode="barycentric")
+
+    source_data = np.lib.format.open_memmap(
+        tmp_path / "source.npy", mode="w+", dtype=np.float32, shape=data.shape
+    )
+    source_data[:] = data
+    with caplog.at_level("INFO", logger="msm"):
+        predicted_data = m.transform(source_data, mode="barycentric", block_size=3)
+    assert "maps/s" in caplog.text
+    # Outputs are in memory unless a path is given
+    assert not isinstance(predicted_data, np.memmap)
+    np.testing.assert_allclose(predicted_data, expected_data)
+    assert os.listdir(tmp_path) == ["source.npy"]
+
+    out_path = tmp_path / "predicted.npy"
+    predicted_data = m.transform(
+        source_data, mode="barycentric", out=out_path, block_size=3
+    )
+    assert isinstance(predicted_data, np.memmap)
+    np.testing.assert_allclose(np.load(out_path), expected_data, rtol=1e-6)
+
+    # HDF5-like datasets create outputs in their group
+    group = fake_group()
+    source_dataset = fake_dataset(data, parent=group)
+    parcellation = np.arange(10242) % 10
+    predicted_dataset = m.transform(
+        source_dataset, parcellation=parcellation, out="predicted", block_size=2
+    )
+    assert group.datasets["predicted"] is predicted_dataset
+    np.testing.assert_allclose(
+        predicted_dataset.data,
+        m.transform(data, parcellation=parcellation),
+        rtol=1e-6,
+    )
+
+    # Or write in given outputs
+    out = fake_dataset(np.zeros((7, 10242), dtype=np.float32))
+    m.transform(fake_dataset(data), mode="barycentric", out=out, block_size=4)
+    np.testing.assert_allclose(out.data, expected_data)
+
+
+def test_transform_array_likes(rotated_model):
+    """DataFrames and sparse matrices should be transformed in memory"""
+
+    m = rotated_model()
+    data = np.random.rand(3, 10242).astype(np.float32)
+    expected_data = m.transform(data, mode="barycentric")
+
+    assert not model.is_out_of_core(pd.DataFrame(data))
+    np.testing.assert_allclose(
+        m.transform(pd.DataFrame(data), mode="barycentric"), expected_data
+    )
+    assert not model.is_out_of_core(sparse.csr_matrix(data))
+    np.testing.assert_allclose(
+        m.transform(sparse.csr_matrix(data), mode="barycentric"), expected_data
+    )
+
+
+def test_distortion_report(rotated_model):
+    """Rotations should not distort the mesh, while reflections fold it"""
+
+    m = rotated_model()
+    report = m.distortion_report()
+    assert report["areal_distortion"].shape == (20480,)
+    assert report["log_jacobian"].shape == (10242,)
+    assert report["summary"]["n_folded"] == 0
+    np.testing.assert_allclose(report["areal_distortion"], 0, atol=1e-4)
+    np.testing.assert_allclose(report["shape_distortion"], 0, atol=1e-4)
+
+    # Mirror the mesh with respect to the xy plane
+    m.transformed_mesh.darrays[0].data[:, 2] *= -1
+    report = m.distortion_report()
+    assert report["summary"]["folded_fraction"] == 1
+
+
+def test_bilateral_model(rotated_model):
+    """Both hemispheres should be transformed with their own model"""
+
+    lh_model = rotated_model(0.3)
+    rh_model = rotated_model(-0.2)
+    m = model.BilateralMSM()
+    m.models = [lh_model, rh_model]
+    m.source_n_vertices = [10242, 10242]
+    m.target_n_vertices = [10242, 10242]
+
+    lh_data = np.random.rand(3, 10242).astype(np.float32)
+    rh_data = np.random.rand(3, 10242).astype(np.float32)
+    data = np.concatenate([lh_data, rh_data], axis=1)
+
+    predicted_data = m.transform(data, mode="nearest")
+    assert predicted_data.shape == data.shape
+    np.testing.assert_array_equal(
+        predicted_data[:, :10242], lh_model.transform(lh_data, mode="nearest")
+    )
+    np.testing.assert_array_equal(
+        predicted_data[:, 10242:], rh_model.transform(rh_data, mode="nearest")
+    )
+
+    predicted_data = m.inverse_transform(data)
+    np.testing.assert_array_equal(
+        predicted_data[:, 10242:], rh_model.inverse_transform(rh_data)
+    )
+
+    # Each hemisphere has its own parcels
+    parcellation = np.concatenate([np.arange(10242) % 10, np.arange(10242) % 4])
+    predicted_data = m.transform(data, parcellation=parcellation)
+    assert predicted_data.shape == (3, 14)
+    np.testing.assert_allclose(
+        predicted_data[:, 10:],
+        rh_model.transform(rh_data, parcellation=parcellation[10242:]),
+        rtol=1e-6,
+    )
+
+
+def test_bilateral_fit(monkeypatch):
+    """Hemispheres should be fitted and resampled in scheduler jobs"""
+
+    monkeypatch.setattr(model, "run_msm", fake_run_msm)
+    mesh_path = datasets.fetch_surf_fsaverage().sphere_left
+    data = np.random.rand(2, 2 * 10242).astype(np.float32)
+
+    m = model.BilateralMSM(n_jobs=2).fit(data, data, source_mesh=(mesh_path, mesh_path))
+    expected_mesh, _ = fake_run_msm(
+        ["source_0.func.gii", "source_1.func.gii"], mesh_path, [], None
+    )
+    for hemisphere_model in m.models:
+        np.testing.assert_allclose(
+            hemisphere_model.transformed_mesh.darrays[0].data,
+            expected_mesh.darrays[0].data,
+        )
+
+    # msmresample is replaced by a stub resampling data natively
+    with stub_fsl():
+        predicted_data = m.transform(data[:1])
+    np.testing.assert_allclose(
+        predicted_data, m.transform(data[:1], mode="barycentric"), atol=1e-5
+    )
+
+
 # def test_model_is_sklearn_estimator():
 #     """Model should have sklearn compatible API"""
 #
@@ -0,0 +1,50 @@
+from nilearn import datasets
+import numpy as np
+from sklearn.base import BaseEstimator
+from sklearn.model_selection import KFold
+
+from msm import evaluate
+from msm import model_selection
+
+
+class IdentityAlignment(BaseEstimator):
+    """Alignment leaving maps unchanged, which does not require FSL"""
+
+    def fit(self, source_data, target_data, source_mesh=None, **kwargs):
+        self.n_train_ = source_data.shape[0]
+        self.source_mesh = source_mesh
+        return self
+
+    def transform(self, source_data):
+        return source_data
+
+
+def test_cross_validate():
+    """Folds should be fitted in parallel and scored on test contrasts"""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    rng = np.random.RandomState(0)
+    source_data = rng.randn(10, 10242)
+    target_data = source_data + rng.randn(10, 10242)
+
+    cv = KFold(5)
+    results = model_selection.cross_validate(
+        IdentityAlignment(),
+        source_data,
+        target_data,
+        fs5.sphere_left,
+        cv=cv,
+        n_jobs=2,
+        return_estimator=True,
+    )
+
+    assert results["test_score"].shape == (5,)
+    for score, (train, test) in zip(results["test_score"], cv.split(source_data)):
+        expected_score = np.mean(
+            evaluate.correlation(source_data[test], target_data[test])
+        )
+        np.testing.assert_allclose(score, expected_score, rtol=1e-5)
+
+    assert [e.n_train_ for e in results["estimator"]] == [8] * 5
+    # Compressed meshes are decompressed once for all folds
+    assert not results["estimator"][0].source_mesh.endswith(".gz")
@@ -1,13 +1,16 @@
 import nibabel as nib
 from nibabel.gifti.gifti import GiftiDataArray, GiftiImage
 from nilearn import datasets
+import json
 import numpy as np
 import os
 import pytest
+import sys
 from tempfile import TemporaryDirectory
 
 from msm import utils
 from msm import run
+from msm.benchmark import icosphere, mesh_gifti
 
 
 def test_run():
@@ -108,3 +111,170 @@ def test_run_iterations(iterations):
 
         assert mesh_gii.darrays[0].data.shape[0] == n_voxels
         assert transformed_gii.darrays[0].data.shape[0] == n_voxels
+
+
+def test_run_with_retries():
+    """Failing commands should be retried before raising an error."""
+
+    with TemporaryDirectory() as tmp_dir:
+        counter_path = os.path.join(tmp_dir, "counter")
+        # Command failing on its first attempt only
+        cmd = [
+            "sh",
+            "-c",
+            f"if [ -e {counter_path} ]; then exit 0; "
+            f"else touch {counter_path}; exit 1; fi",
+        ]
+        run.run_with_retries(cmd, "run command", retries=1, backoff=0)
+
+        with pytest.raises(RuntimeError, match="Failed to run command"):
+            run.run_with_retries(["false"], "run command", retries=2, backoff=0)
+
+        with pytest.raises(RuntimeError):
+            run.run_with_retries(["sleep", "10"], "run command", timeout=0.1)
+
+
+def test_msm_config():
+    """Config should match MSMpair defaults and select outputs of msm."""
+
+    config = run.MSMConfig()
+    assert config.to_string().split("\n") == [
+        "--sigma_in=6,6,4,2",
+        "--sigma_ref=6,6,4,2",
+        "--lambda=0,0.1,0.2,0.3",
+        "--it=50,5,10,10",
+        "--opt=AFFINE,DISCRETE,DISCRETE,DISCRETE",
+        "--CPgrid=0,2,3,4",
+        "--SGgrid=0,4,5,6",
+        "--datagrid=5,5,5,6",
+    ]
+    assert config.flags() == ["--verbose", "--debug", "--levels=1"]
+
+    config = run.MSMConfig(epsilon=0.5, iterations=3, levels=None, profile="minimal")
+    assert "--lambda=0.5,0.5,0.5,0.5" in config.to_string()
+    assert "--it=3,3,3,3" in config.to_string()
+    assert config.flags() == []
+
+    with pytest.raises(ValueError):
+        run.MSMConfig(profile="unknown").flags()
+
+    # Only the first level is run by default, which is smoothed beforehand
+    config = run.MSMConfig(presmooth=True)
+    assert config.presmoothing() == (6, 6)
+    assert config.to_string().split("\n")[:2] == [
+        "--sigma_in=0.0,0.0,0.0,0.0",
+        "--sigma_ref=0.0,0.0,0.0,0.0",
+    ]
+
+    # Maps smoothed with sigma 2 beforehand only need the remaining smoothing
+    config = run.MSMConfig(presmooth=True, levels=None)
+    assert config.presmoothing() == (2, 2)
+    assert config.to_string().split("\n")[:2] == [
+        "--sigma_in=5.6569,5.6569,3.4641,0.0",
+        "--sigma_ref=5.6569,5.6569,3.4641,0.0",
+    ]
+
+
+FAKE_MSM = """
+import os, sys
+args = dict(arg.split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+output_dir = sys.argv[sys.argv.index("-o") + 1]
+with open(os.environ["FAKE_MSM_CALLS"], "a") as f:
+    f.write(args["--indata"] + "\\n")
+with open(os.path.join(output_dir, "sphere.reg.asc"), "w") as f:
+    f.write(args["--inmesh"])
+"""
+
+FAKE_SURF2SURF = """
+import shutil, sys
+with open(sys.argv[sys.argv.index("-i") + 1]) as f:
+    shutil.copy(f.read(), sys.argv[sys.argv.index("-o") + 1])
+"""
+
+
+@pytest.fixture
+def fake_fsl(tmp_path, monkeypatch):
+    """Stub msm and surf2surf, recording calls of msm"""
+
+    bin_dir = tmp_path / "fsl" / "bin"
+    bin_dir.mkdir(parents=True)
+    for tool, script in [("fsl", ""), ("msm", FAKE_MSM), ("surf2surf", FAKE_SURF2SURF)]:
+        (bin_dir / tool).write_text(f"#!{sys.executable}\n{script}")
+        (bin_dir / tool).chmod(0o755)
+
+    calls_path = tmp_path / "msm_calls"
+    calls_path.touch()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_MSM_CALLS", str(calls_path))
+    monkeypatch.delenv("FSLDIR", raising=False)
+    monkeypatch.delenv("FSL_CONFIG_PATH", raising=False)
+    utils.fsl_toolchain.cache_clear()
+    yield calls_path
+    utils.fsl_toolchain.cache_clear()
+
+
+def test_run_work_dir(tmp_path, fake_fsl):
+    """Files of a work_dir should only be reused for the same inputs"""
+
+    vertices, faces = icosphere(2)
+    mesh_path = str(tmp_path / "sphere.surf.gii")
+    mesh_gifti(vertices, faces).to_filename(mesh_path)
+
+    def write_contrast(path, seed):
+        contrast = GiftiImage()
+        contrast.add_gifti_data_array(
+            GiftiDataArray(
+                np.random.RandomState(seed).rand(162).astype(np.float32),
+                coordsys=nib.gifti.gifti.GiftiCoordSystem(3, 3),
+            )
+        )
+        contrast.to_filename(str(path))
+        return str(path)
+
+    source_path = write_contrast(tmp_path / "source.func.gii", 0)
+    target_path = write_contrast(tmp_path / "target.func.gii", 1)
+    work_dir = str(tmp_path / "work")
+
+    def n_calls():
+        return len(fake_fsl.read_text().splitlines())
+
+    def fit(**kwargs):
+        return run.run_msm(
+            [source_path],
+            mesh_path,
+            [target_path],
+            work_dir=work_dir,
+            profile="minimal",
+            **kwargs,
+        )
+
+    mesh_gii, _ = fit()
+    np.testing.assert_allclose(mesh_gii.darrays[0].data, vertices, rtol=1e-6)
+    assert n_calls() == 1
+    assert not [f for f in os.listdir(work_dir) if f.startswith(".tmp")]
+
+    # Same inputs and config
+    fit()
+    assert n_calls() == 1
+
+    # Same paths, different data
+    write_contrast(source_path, 2)
+    fit()
+    assert n_calls() == 2
+    np.testing.assert_allclose(
+        nib.load(os.path.join(work_dir, "source_subject.func.gii")).darrays[0].data,
+        nib.load(source_path).darrays[0].data,
+    )
+
+    # Different config
+    fit(epsilon=0.5)
+    assert n_calls() == 3
+
+    # msm was interrupted, which left outputs without recording them
+    with open(os.path.join(work_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    del manifest["msm"]
+    with open(os.path.join(work_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    fit(epsilon=0.5)
+    assert n_calls() == 4
@@ -0,0 +1,112 @@
+import numpy as np
+import os
+import pytest
+from tempfile import TemporaryDirectory
+import time
+
+from msm import scheduler
+
+
+def sleep_and_return(x):
+    start = time.time()
+    time.sleep(0.2)
+    return x, start, time.time()
+
+
+def fail():
+    raise ValueError("job failed")
+
+
+def test_estimate_msm_memory():
+    """Larger meshes and grids should require more memory."""
+
+    fs5 = scheduler.estimate_msm_memory(10242, n_features=10)
+    fs7 = scheduler.estimate_msm_memory(163842, n_features=10)
+    assert 0 < fs5 < fs7
+    assert scheduler.estimate_msm_memory(
+        10242, n_features=10, cpgrid=(2, 3, 4, 5)
+    ) > fs5
+
+
+def test_memory_history():
+    """Measured peaks should refine memory estimates."""
+
+    with TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "history.json")
+        history = scheduler.MemoryHistory(path)
+        assert history.refine("a", 100) == 120
+
+        history.record("a", 100, 200)
+        assert history.refine("a", 100) == 240
+        # Other jobs are corrected by the observed ratio
+        assert history.refine("b", 1000) == 2400
+
+        # History should be persisted
+        assert scheduler.MemoryHistory(path).refine("a", 100) == 240
+        assert os.listdir(tmp_dir) == ["history.json"]
+
+        # Only recent measurements are kept
+        for peak in range(scheduler.MAX_RECORDS):
+            history.record("a", 100, peak)
+        assert len(history.records["a"]) == scheduler.MAX_RECORDS
+        assert history.refine("a", 100) == int(1.2 * (scheduler.MAX_RECORDS - 1))
+
+        # Corrupted history should be ignored
+        with open(path, "w") as f:
+            f.write('{"a": [[100,')
+        assert scheduler.MemoryHistory(path).refine("a", 100) == 120
+
+
+def test_scheduler_budgets():
+    """Jobs should only run concurrently while they fit in budgets."""
+
+    with TemporaryDirectory() as tmp_dir:
+        history = scheduler.MemoryHistory(os.path.join(tmp_dir, "history.json"))
+
+        # Memory budget allows a single job at once
+        with scheduler.Scheduler(
+            max_cpus=4, memory_budget=100, history=history
+        ) as s:
+            futures = [s.submit(sleep_and_return, i, memory=60) for i in range(3)]
+            results = [future.result() for future in futures]
+        assert [x for x, _, _ in results] == [0, 1, 2]
+        intervals = sorted((start, end) for _, start, end in results)
+        assert all(
+            intervals[i][1] <= intervals[i + 1][0] for i in range(len(intervals) - 1)
+        )
+        assert futures[0].max_rss > 0
+
+        # CPU budget allows all jobs at once
+        with scheduler.Scheduler(
+            max_cpus=3, memory_budget=100, history=history
+        ) as s:
+            results = s.map(sleep_and_return, range(3), memory=10)
+        starts = [start for _, start, _ in results]
+        ends = [end for _, _, end in results]
+        assert max(starts) < min(ends)
+
+        with scheduler.Scheduler(max_cpus=1, history=history) as s:
+            with pytest.raises(ValueError, match="job failed"):
+                s.submit(fail).result()
+
+
+def allocate(size):
+    return int(np.ones(size // 8).sum())
+
+
+def test_scheduler_peak_memory():
+    """Peak memory of jobs should not include memory held by the parent."""
+
+    # Memory held by the parent is inherited by forked jobs
+    held = np.ones(200 * 2**20 // 8)
+    with TemporaryDirectory() as tmp_dir:
+        history = scheduler.MemoryHistory(os.path.join(tmp_dir, "history.json"))
+        with scheduler.Scheduler(max_cpus=1, history=history) as s:
+            trivial = s.submit(allocate, 0)
+            trivial.result()
+            large = s.submit(allocate, 100 * 2**20)
+            large.result()
+
+    assert held.sum() > 0
+    assert trivial.max_rss < 50 * 2**20
+    assert 100 * 2**20 <= large.max_rss < 150 * 2**20
@@ -0,0 +1,100 @@
+from nilearn import datasets
+import numpy as np
+import os
+import pytest
+import threading
+import time
+
+from msm import geometry, index, serve
+
+
+@pytest.mark.parametrize("unix_socket", [False, True])
+def test_serve(tmp_path, unix_socket, rotated_model):
+    """Models should be loaded once and answer requests of clients"""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    m = rotated_model()
+    model_path = str(tmp_path / "transformed_in_mesh.surf.gii")
+    m.transformed_mesh.to_filename(model_path)
+
+    cache = serve.ModelCache(max_models=1)
+    if unix_socket:
+        socket_path = str(tmp_path / "msm.sock")
+        server = serve.make_server(socket_path=socket_path, cache=cache)
+        client = serve.Client(socket_path=socket_path, timeout=30)
+    else:
+        server = serve.make_server(port=0, cache=cache)
+        client = serve.Client(port=server.server_address[1], timeout=30)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        data = np.random.rand(3, 10242).astype(np.float32)
+        predicted_data = client.transform(
+            data, model_path, fs5.sphere_left, mode="nearest"
+        )
+        np.testing.assert_array_equal(predicted_data, m.transform(data, mode="nearest"))
+        np.testing.assert_allclose(
+            client.inverse_transform(data, model_path, fs5.sphere_left),
+            m.inverse_transform(data),
+            rtol=1e-6,
+        )
+        assert cache.keys() == [
+            (os.path.abspath(model_path), os.path.abspath(fs5.sphere_left), None)
+        ]
+
+        # Errors are reported to clients
+        with pytest.raises(RuntimeError):
+            client.transform(data, model_path, fs5.sphere_left, mode="unknown")
+
+        # Least recently used models are evicted, along with indices
+        # and geometries of their transformed meshes
+        n_indices = len(index._indices)
+        n_geometries = len(geometry._geometries)
+        for theta in [0.1, 0.2]:
+            other_model_path = str(tmp_path / f"other_{theta}.surf.gii")
+            rotated_model(theta).transformed_mesh.to_filename(other_model_path)
+            client.transform(data, other_model_path, fs5.sphere_left, mode="nearest")
+            assert [key[0] for key in cache.keys()] == [other_model_path]
+        assert len(index._indices) == n_indices
+        assert len(geometry._geometries) == n_geometries
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class SlowMSM:
+    loaded = []
+
+    def load_model(self, model_path, source_mesh, target_mesh=None):
+        if model_path == "slow":
+            time.sleep(0.5)
+        if model_path == "missing":
+            raise FileNotFoundError(model_path)
+        self.loaded.append(model_path)
+        return self
+
+
+def test_model_cache(monkeypatch):
+    """Slow loads should neither block cached models nor be repeated"""
+
+    monkeypatch.setattr(serve, "MSM", SlowMSM)
+    cache = serve.ModelCache(max_models=2)
+    fast_model = cache.get("fast", "mesh")
+
+    threads = [
+        threading.Thread(target=cache.get, args=("slow", "mesh")) for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    start = time.time()
+    assert cache.get("fast", "mesh") is fast_model
+    assert time.time() - start < 0.2
+    for thread in threads:
+        thread.join()
+    assert SlowMSM.loaded == ["fast", "slow"]
+
+    with pytest.raises(FileNotFoundError):
+        cache.get("missing", "mesh")
+    assert cache.loading == {}
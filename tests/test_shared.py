@@ -0,0 +1,42 @@
+import multiprocessing
+import numpy as np
+import pickle
+
+from msm import shared
+
+
+def _inverse_transform(shared_model, target_data):
+    model = shared_model.attach()
+    return model.inverse_transform(target_data), model.transform(
+        target_data, mode="nearest"
+    )
+
+
+def test_shared_model(rotated_model):
+    """Workers should use operators published once in shared memory"""
+
+    m = rotated_model()
+    target_data = np.random.rand(2, 10242).astype(np.float32)
+    expected_data = m.inverse_transform(target_data)
+
+    with shared.SharedModel(m, operators=("inverse", "nearest")) as shared_model:
+        # Only names of blocks are pickled
+        assert len(pickle.dumps(shared_model)) < 10000
+        attached = pickle.loads(pickle.dumps(shared_model)).attach()
+        assert not attached.transformed_mesh.darrays[0].data.flags.owndata
+        assert attached._inverse_operator is not None
+        np.testing.assert_array_equal(
+            attached.inverse_transform(target_data), expected_data
+        )
+
+        with multiprocessing.get_context("fork").Pool(2) as pool:
+            results = pool.starmap(
+                _inverse_transform, [(shared_model, target_data)] * 2
+            )
+        for predicted_data, predicted_labels in results:
+            np.testing.assert_array_equal(predicted_data, expected_data)
+            np.testing.assert_array_equal(
+                predicted_labels, m.transform(target_data, mode="nearest")
+            )
+
+        del attached
@@ -0,0 +1,88 @@
+from nilearn import datasets
+import numpy as np
+import os
+from tempfile import TemporaryDirectory
+
+from msm import geometry
+from msm.benchmark import icosphere, mesh_gifti
+from msm import smoothing
+from msm import utils
+
+
+def test_surface_smoother():
+    """Smoothing an impulse should spread it with the requested width."""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    mesh = utils.gifti_from_file(fs5.sphere_left)
+    mesh_geometry = geometry.get_geometry(mesh)
+    vertices = mesh_geometry.vertices / np.linalg.norm(
+        mesh_geometry.vertices, axis=1, keepdims=True
+    )
+
+    for sigma in [4, 6]:
+        smoother = smoothing.SurfaceSmoother(mesh_geometry, sigma)
+        impulse = np.zeros(mesh_geometry.n_vertices)
+        impulse[5000] = 1
+        smoothed = smoother.transform(impulse)
+
+        distances = mesh_geometry.radius * np.arccos(
+            np.clip(vertices @ vertices[5000], -1, 1)
+        )
+        np.testing.assert_allclose(smoothed.sum(), 1, rtol=0.05)
+        np.testing.assert_allclose(
+            np.sqrt(np.sum(smoothed * distances**2) / 2), sigma, rtol=0.05
+        )
+
+        # Constant maps are left unchanged
+        np.testing.assert_allclose(
+            smoother.transform(np.ones((2, mesh_geometry.n_vertices))), 1, rtol=1e-5
+        )
+
+
+def test_smooth_cached(monkeypatch):
+    """Smoothed maps should be computed once and reused afterwards."""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    mesh = utils.gifti_from_file(fs5.sphere_left)
+    n_vertices = mesh.darrays[0].data.shape[0]
+    data = np.random.RandomState(0).rand(3, n_vertices).astype(np.float32)
+
+    with TemporaryDirectory() as tmp_dir:
+        smoothed = smoothing.smooth_cached(data, mesh, 4, cache_dir=tmp_dir)
+        assert smoothed.shape == data.shape
+        assert smoothed.std() < data.std()
+
+        smoothing._smoothers.clear()
+        np.testing.assert_array_equal(
+            smoothing.smooth_cached(data, mesh, 4, cache_dir=tmp_dir), smoothed
+        )
+        # The smoother was not needed again
+        assert len(smoothing._smoothers) == 0
+
+        # Least recently used maps are removed above the cache size
+        smoothed_dir = os.path.join(tmp_dir, "smoothed")
+        (old_path,) = os.listdir(smoothed_dir)
+        os.utime(os.path.join(smoothed_dir, old_path), (0, 0))
+        monkeypatch.setenv("MSM_CACHE_SIZE", str(smoothed.nbytes + 1024))
+        smoothing.smooth_cached(data[::-1], mesh, 4, cache_dir=tmp_dir)
+        assert len(os.listdir(smoothed_dir)) == 1
+        assert old_path not in os.listdir(smoothed_dir)
+
+    np.testing.assert_array_equal(smoothing.smooth_cached(data, mesh, 0), data)
+
+
+def test_get_smoother(monkeypatch):
+    """Only the most recently used smoothers should be kept in memory."""
+
+    monkeypatch.setattr(smoothing, "_smoothers", smoothing.OrderedDict())
+    monkeypatch.setattr(smoothing, "MAX_SMOOTHERS", 2)
+    mesh = mesh_gifti(*icosphere(2))
+
+    smoother = smoothing.get_smoother(mesh, 10)
+    assert smoothing.get_smoother(mesh, 10) is smoother
+    smoothing.get_smoother(mesh, 20)
+    smoothing.get_smoother(mesh, 30)
+    assert list(smoothing._smoothers) == [
+        (geometry.mesh_hash(mesh), 20.0),
+        (geometry.mesh_hash(mesh), 30.0),
+    ]
@@ -1,8 +1,14 @@
+import nibabel as nib
+from nibabel.gifti.gifti import GiftiDataArray, GiftiImage
 from nilearn import datasets
+import numpy as np
 import os
+import pytest
+import subprocess
+import sys
 from tempfile import TemporaryDirectory
 
-from msm import utils
+from msm import model, run, utils
 
 
 def test_check_fsl():
@@ -30,3 +36,140 @@ def test_gifti_from_file():
     fs5 = datasets.fetch_surf_fsaverage()
     mesh = utils.gifti_from_file(fs5.pial_left)
     assert mesh.darrays[0].data.shape == (10242, 3)
+
+
+def test_load_contrasts():
+    """Should load contrast maps into a single float32 array."""
+
+    fs5 = datasets.fetch_surf_fsaverage()
+    mesh_coordsys = utils.gifti_from_file(fs5.sphere_left).darrays[0].coordsys
+    n_voxels = 10242
+
+    with TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i in range(4):
+            img = GiftiImage()
+            img.add_gifti_data_array(
+                GiftiDataArray(
+                    np.full(n_voxels, i, dtype=np.float32), coordsys=mesh_coordsys
+                )
+            )
+            paths.append(os.path.join(tmp_dir, f"contrast_{i}.gii"))
+            nib.save(img, paths[-1])
+
+        data = utils.load_contrasts(paths, mesh=fs5.sphere_left, n_jobs=2)
+        assert data.dtype == np.float32
+        assert data.shape == (4, n_voxels)
+        np.testing.assert_array_equal(data[:, 0], np.arange(4))
+
+        out = np.zeros((4, n_voxels))
+        assert utils.load_contrasts(paths, out=out) is out
+
+        # Missing files should be reported
+        missing_path = os.path.join(tmp_dir, "missing.gii")
+        with pytest.raises(ValueError, match="missing.gii"):
+            utils.load_contrasts(paths + [missing_path])
+        data = utils.load_contrasts([missing_path] + paths, on_error="warn")
+        assert data.shape == (5, n_voxels)
+        assert np.all(np.isnan(data[0]))
+        np.testing.assert_array_equal(data[1:, 0], np.arange(4))
+        with pytest.raises(ValueError, match="dtype"):
+            utils.load_contrasts(
+                paths, out=np.zeros((4, n_voxels), dtype=int), on_error="warn"
+            )
+        with pytest.raises(ValueError, match="missing.gii"):
+            utils.load_contrasts([missing_path], on_error="warn")
+
+
+def test_run_command():
+    """Should return exit code of commands and kill them on timeout."""
+
+    assert utils.run_command(["true"]) == 0
+    assert utils.run_command(["false"]) != 0
+    with pytest.raises(subprocess.TimeoutExpired):
+        utils.run_command(["sleep", "10"], timeout=0.1)
+
+
+def test_working_directory():
+    """Working directories should only be deleted if temporary."""
+
+    with utils.working_directory() as tmp_dir:
+        assert os.path.isdir(tmp_dir)
+    assert not os.path.exists(tmp_dir)
+
+    with TemporaryDirectory() as tmp_dir:
+        work_dir = os.path.join(tmp_dir, "work")
+        with utils.working_directory(work_dir) as d:
+            assert d == work_dir
+        assert os.path.isdir(work_dir)
+
+
+def test_fsl_toolchain(monkeypatch, tmp_path):
+    """FSL tools should be located once per process."""
+
+    for tool in ["fsl", "msm", "msmresample"]:
+        tool_path = tmp_path / "bin" / tool
+        tool_path.parent.mkdir(exist_ok=True)
+        tool_path.write_text("#!/bin/sh\n")
+        tool_path.chmod(0o755)
+    (tmp_path / "etc").mkdir()
+    (tmp_path / "etc" / "fslversion").write_text("6.0.7.4:abcdef\n")
+
+    monkeypatch.setenv("PATH", str(tmp_path / "bin"))
+    # Restored on exit, since the toolchain sets them
+    monkeypatch.delenv("FSLDIR", raising=False)
+    monkeypatch.delenv("FSL_CONFIG_PATH", raising=False)
+    utils.fsl_toolchain.cache_clear()
+    try:
+        toolchain = utils.fsl_toolchain()
+        assert toolchain.fsl_dir == str(tmp_path)
+        assert toolchain.version == "6.0.7.4"
+        assert toolchain.msm == str(tmp_path / "bin" / "msm")
+        assert toolchain.surf2surf is None
+        assert os.environ["FSLDIR"] == str(tmp_path)
+
+        assert utils.fsl_tool("msm") == toolchain.msm
+        with pytest.raises(RuntimeError, match="surf2surf"):
+            utils.fsl_tool("surf2surf")
+
+        # FSL is not looked up again, nor is the environment set again
+        monkeypatch.setenv("PATH", "")
+        monkeypatch.setenv("FSLDIR", "elsewhere")
+        assert utils.fsl_toolchain() is toolchain
+        assert utils.check_fsl() == (toolchain.fsl_dir, toolchain.config_path)
+        assert os.environ["FSLDIR"] == "elsewhere"
+
+        utils.fsl_toolchain.cache_clear()
+        with pytest.raises(RuntimeError):
+            utils.fsl_toolchain()
+    finally:
+        utils.fsl_toolchain.cache_clear()
+
+
+@pytest.mark.parametrize("module", ["msm", "msm.run", "msm.batch", "msm.model"])
+def test_lazy_import(module):
+    """Importing msm modules should not import heavy dependencies."""
+
+    code = (
+        f"import sys, {module}; "
+        "heavy = {'sklearn', 'pandas', 'scipy.sparse', 'scipy.stats'}; "
+        "assert not heavy & set(sys.modules), heavy & set(sys.modules)"
+    )
+    assert subprocess.run([sys.executable, "-c", code]).returncode == 0
+
+
+def test_estimator_params():
+    """Estimators should support scikit-learn parameter handling."""
+
+    from sklearn.base import clone
+
+    m = model.MSM(epsilon=0.2)
+    assert m.get_params()["epsilon"] == 0.2
+    assert clone(m).get_params() == m.get_params()
+    assert m.set_params(epsilon=0.3) is m and m.epsilon == 0.3
+    with pytest.raises(ValueError):
+        m.set_params(foo=1)
+
+    config = run.MSMConfig(levels=2)
+    assert config.set_params(epsilon=0.1).get_params()["epsilon"] == 0.1
+    assert "levels=2" in repr(config)